@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "painted_playlists.settings")
+# Async views keep one Spotify client per worker's event loop (see playlists/spotify_async.py)
+os.environ.setdefault("SPOTIFY_ASYNC_CLIENT", "True")
 
 application = get_asgi_application()
@@ -1,6 +1,7 @@
 # painted_playlists/settings.py
 
 import os
+import django
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -46,6 +47,8 @@ TAILWIND_APP_NAME = 'painted_theme'
 
 # Middleware configuration
 MIDDLEWARE = [
+    'playlists.middleware.RequestIdMiddleware',  # First, so every log line of a request carries its id
+    'playlists.middleware.PerformanceMiddleware',  # Times everything below it
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,14 +85,110 @@ WSGI_APPLICATION = 'painted_playlists.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
-# Database configuration
-DATABASES = {
+# Database configuration, chosen with DB_ENGINE: 'sqlite' (default) or 'postgresql'
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'painted_playlists'),
+            'USER': os.getenv('DB_USER', ''),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', ''),
+            'PORT': os.getenv('DB_PORT', ''),
+            # Keep connections open between requests instead of reconnecting every time
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+            # Check a reused connection is still alive before using it (Django 4.1+)
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5')),
+            },
+        }
+    }
+    if os.getenv('DB_POOL', 'False') == 'True':
+        # psycopg's connection pool (Django 5.1+ with psycopg[pool]); replaces persistent connections
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        }
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Seconds a connection waits for the write lock before "database is locked"
+                'timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', '20')),
+            },
+        }
+    }
+    if django.VERSION >= (5, 1):
+        # Take the write lock when a transaction starts; a read transaction that later writes
+        # cannot wait for the lock in WAL mode and fails at once instead
+        DATABASES['default']['OPTIONS']['transaction_mode'] = 'IMMEDIATE'
+
+# SQLite tuning applied to every new connection (see playlists/db.py): WAL so readers never
+# block the writer, synchronous=NORMAL (durable at each checkpoint rather than each commit)
+# and memory-mapped reads of up to SQLITE_MMAP_SIZE bytes
+SQLITE_TUNING = os.getenv('SQLITE_TUNING', 'True') == 'True'
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+# WAL is recorded in the database file itself, so it is left off for the demo db.sqlite3 checked
+# into the repository unless SQLITE_WAL=True; a database of your own (DB_NAME) gets it by default
+SQLITE_WAL = os.getenv('SQLITE_WAL', str('DB_NAME' in os.environ)) == 'True'
+
+# Cache configuration; local memory per process by default. Set CACHE_BACKEND and CACHE_LOCATION
+# to share it between processes, e.g. django.core.cache.backends.filebased.FileBasedCache with
+# a directory, or a Redis-compatible backend with its URL
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
     }
 }
 
+# Logging: one JSON object per line on stderr, tagged with the request or import job id
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # 'json', or 'text' for reading in a terminal
+# Share of Spotify payloads logged when the playlists logger is at DEBUG, and their maximum length
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', '2000'))
+
+# Per-view performance metrics (see playlists/middleware.py), served at /metrics
+PERF_METRICS_SAMPLE_EVERY = int(os.getenv('PERF_METRICS_SAMPLE_EVERY', '1'))  # Measure 1 in N requests; 0 is off
+PERF_METRICS_WINDOW = int(os.getenv('PERF_METRICS_WINDOW', '1024'))  # Recent requests per view used for quantiles
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # If set, /metrics requires "Authorization: Bearer <token>"
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'correlation': {'()': 'playlists.logging_utils.CorrelationFilter'},
+    },
+    'formatters': {
+        'json': {'()': 'playlists.logging_utils.JSONFormatter'},
+        'text': {'format': '%(asctime)s %(levelname)s %(name)s [%(request_id)s %(job_id)s] %(message)s'},
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'filters': ['correlation'],
+            'formatter': LOG_FORMAT,
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': LOG_LEVEL,
+    },
+    'loggers': {
+        # Replace Django's own console handler so its messages are not written twice
+        'django': {'handlers': ['console'], 'level': LOG_LEVEL, 'propagate': False},
+        # httpx logs every request at INFO; Spotify calls are already counted in /metrics
+        'httpx': {'level': 'WARNING'},
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -133,6 +232,12 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
+# Hand media transfers to the front proxy: '' (Django streams the file), 'x-accel-redirect'
+# (nginx, with an internal location at MEDIA_ACCEL_REDIRECT_PREFIX aliased to MEDIA_ROOT)
+# or 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+MEDIA_OFFLOAD = os.getenv('MEDIA_OFFLOAD', '')
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv('MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+
 
 
 # Default primary key field type
@@ -145,4 +250,43 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 SPOTIPY_CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
 SPOTIPY_REDIRECT_URI = os.getenv('SPOTIPY_REDIRECT_URI')
+# Base URLs of the Spotify Web API and accounts service; point them at a stub server for offline benchmarks
+SPOTIFY_API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1').rstrip('/')
+SPOTIFY_ACCOUNTS_URL = os.getenv('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com').rstrip('/')
+
+# Shared HTTP connection pool for Spotify API calls (see playlists/spotify_http.py)
+# Connections kept alive to each Spotify host; also the limit on concurrent requests per process
+SPOTIFY_HTTP_POOL_SIZE = int(os.getenv('SPOTIFY_HTTP_POOL_SIZE', '20'))
+SPOTIFY_HTTP_TIMEOUT = float(os.getenv('SPOTIFY_HTTP_TIMEOUT', '10'))  # Seconds to connect and per read
+SPOTIFY_HTTP_RETRIES = int(os.getenv('SPOTIFY_HTTP_RETRIES', '3'))  # Retries of failed connections and 5xx
+SPOTIFY_HTTP_BACKOFF = float(os.getenv('SPOTIFY_HTTP_BACKOFF', '0.5'))  # Back-off factor between retries
+# Budget for the Spotify calls of each process on the shared session (see playlists/spotify_http.py):
+# calls a second on average and the burst allowed above it; 0 is no limit. Spotify rate-limits the
+# whole app, so the budgets of all processes together should stay below that limit
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', '20'))
+SPOTIFY_RATE_BURST = int(os.getenv('SPOTIFY_RATE_BURST', '40'))
+
+# Background re-sync of imported playlists by `manage.py sync_playlists` (see playlists/sync_scheduler.py):
+# seconds between syncs of each playlist, and the most a playlist waits for a sync once it is viewed
+PLAYLIST_SYNC_INTERVAL = int(os.getenv('PLAYLIST_SYNC_INTERVAL', str(6 * 60 * 60)))
+PLAYLIST_SYNC_VIEWED_INTERVAL = int(os.getenv('PLAYLIST_SYNC_VIEWED_INTERVAL', str(15 * 60)))
+# Seconds a scheduler process holds the playlists it claimed before another process may take them over
+PLAYLIST_SYNC_LEASE = int(os.getenv('PLAYLIST_SYNC_LEASE', '600'))
+# Spotify calls one ASGI worker can have in flight at once (see playlists/spotify_async.py); further
+# calls wait their turn. Raising it much beyond 50 costs more CPU in the client's pool bookkeeping than it saves
+SPOTIFY_ASYNC_MAX_CONNECTIONS = int(os.getenv('SPOTIFY_ASYNC_MAX_CONNECTIONS', '50'))
+# Whether async views call Spotify on an httpx client kept by each event loop. Only pays off under an
+# ASGI server, whose loop lasts as long as the worker; asgi.py turns it on. Under WSGI each async view
+# runs on a loop of its own, so their calls go through the shared requests session instead.
+# It also picks the async body of the streamed playlist listing, which only ASGI servers stream
+SPOTIFY_ASYNC_CLIENT = os.getenv('SPOTIFY_ASYNC_CLIENT', 'False') == 'True'
+
+# Cached listing of each user's Spotify playlists (see playlists/playlist_cache.py)
+SPOTIFY_PLAYLISTS_CACHE = os.getenv('SPOTIFY_PLAYLISTS_CACHE', 'default')  # Alias in CACHES
+SPOTIFY_PLAYLISTS_CACHE_TTL = int(os.getenv('SPOTIFY_PLAYLISTS_CACHE_TTL', '300'))  # Seconds before a refresh
+
+# Rendered playlist carousels and song grids (see playlists/fragment_cache.py). Fragments are keyed
+# on the playlist's version, so they never go stale and the TTL only bounds the memory they use
+FRAGMENT_CACHE = os.getenv('FRAGMENT_CACHE', 'default')  # Alias in CACHES
+FRAGMENT_CACHE_TTL = int(os.getenv('FRAGMENT_CACHE_TTL', str(24 * 60 * 60)))
 
@@ -17,10 +17,10 @@ Including another URLconf
 # painted_playlists/urls.py
 
 from django.contrib import admin
-from django.urls import path, include
-from playlists.views import home  # Import the home view
+from django.urls import path, include, re_path
+from playlists.views import home, prometheus_metrics  # Import the home view
+from playlists.media import serve_media
 from django.conf import settings
-from django.conf.urls.static import static
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -28,7 +28,7 @@ urlpatterns = [
     path('playlists/', include('playlists.urls', namespace='playlists')),
     path('', home, name='home'),  # Add this line
     path("__reload__/", include("django_browser_reload.urls")),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path('metrics', prometheus_metrics, name='metrics'),  # Prometheus scrape endpoint
+    # Uploaded media, with caching headers and optional X-Accel-Redirect/X-Sendfile offload
+    re_path(r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), serve_media, name='media'),
+]
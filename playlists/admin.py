@@ -1,14 +1,38 @@
 from django.contrib import admin
-from .models import Playlist, Song, SpotifyToken
+from .models import Album, Artist, ImportBatch, ImportJob, Playlist, Song, SpotifyToken, SyncCycle, Track
 
 class SongInline(admin.TabularInline):
     model = Song
     extra = 1
+    raw_id_fields = ('track',)
+
+class TrackAdmin(admin.ModelAdmin):
+    list_display = ('title', 'artist_names', 'spotify_track_id')
+    search_fields = ('title', 'artist_names', 'spotify_track_id')
+    raw_id_fields = ('album', 'artists')
 
 class PlaylistAdmin(admin.ModelAdmin):
-    list_display = ('title', 'user', 'created_at')
+    list_display = ('title', 'user', 'created_at', 'last_synced_at', 'next_sync_at')
     inlines = [SongInline]
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('spotify_playlist_id', 'user', 'state', 'tracks_done', 'tracks_total', 'batch', 'created_at')
+    list_filter = ('state',)
+    raw_id_fields = ('batch', 'playlist')
+
+class ImportBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'created_at')
+
+class SyncCycleAdmin(admin.ModelAdmin):
+    list_display = ('started_at', 'node', 'playlists', 'changed', 'failed', 'spotify_calls', 'lag_max_seconds', 'backlog')
+    list_filter = ('node',)
+
 admin.site.register(Playlist, PlaylistAdmin)
 admin.site.register(Song)
+admin.site.register(Track, TrackAdmin)
+admin.site.register(Artist)
+admin.site.register(Album)
 admin.site.register(SpotifyToken)
+admin.site.register(ImportJob, ImportJobAdmin)
+admin.site.register(ImportBatch, ImportBatchAdmin)
+admin.site.register(SyncCycle, SyncCycleAdmin)
@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class PlaylistsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "playlists"
+
+    def ready(self):
+        from .db import configure_sqlite
+        from .fragment_cache import connect_signals
+        from .image_utils import connect_signals as connect_photo_signals
+        from .metrics import install_query_counter
+
+        connection_created.connect(configure_sqlite)
+        connection_created.connect(install_query_counter)
+        connect_signals()
+        connect_photo_signals()
@@ -0,0 +1,21 @@
+# playlists/db.py
+
+from django.conf import settings
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Tune each new SQLite connection for concurrent imports and uploads (connection_created).
+    WAL lets reads continue while another connection writes, and busy_timeout makes writers
+    wait for the lock instead of failing with "database is locked". WAL persists in the
+    database file, so it is only switched on with settings.SQLITE_WAL.
+    """
+    if connection.vendor != 'sqlite' or not settings.SQLITE_TUNING:
+        return
+    timeout_ms = int(connection.settings_dict['OPTIONS'].get('timeout', 5) * 1000)
+    with connection.cursor() as cursor:
+        if settings.SQLITE_WAL:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={timeout_ms}')
+        cursor.execute(f'PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}')
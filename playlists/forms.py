@@ -47,9 +47,9 @@ class SongForm(forms.ModelForm):
     """
     class Meta:
         model = Song
-        fields = ['title', 'photo']
+        # The title belongs to the song's track in the shared catalog
+        fields = ['photo']
         widgets = {  # Custom widgets for form fields
-            'title': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Song Title'}),
             'photo': forms.FileInput(attrs={'class': 'form-control-file'}),
         }
 
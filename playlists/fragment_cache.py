@@ -0,0 +1,93 @@
+# playlists/fragment_cache.py
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.utils.safestring import mark_safe
+from .metrics import fragment_cache_stats
+from .models import Playlist, Song, Track
+
+
+def fragment_cache():
+    return caches[settings.FRAGMENT_CACHE]
+
+
+def fragment_key(kind, playlist, *parts):
+    """
+    Cache key of a fragment rendered from a playlist's content.
+    The key includes Playlist.version, which is bumped on every change to that content, so
+    fragments rendered before a change are never looked up again and simply expire.
+    """
+    return ':'.join(['fragment', kind, str(playlist.id), str(playlist.version), *map(str, parts)])
+
+
+def cached_fragment(kind, key, render):
+    """
+    Return the fragment cached under key, or render() it and cache it.
+    """
+    cache = fragment_cache()
+    fragment = cache.get(key)
+    fragment_cache_stats.record(kind, hits=int(fragment is not None), misses=int(fragment is None))
+    if fragment is None:
+        fragment = render()
+        cache.set(key, fragment, settings.FRAGMENT_CACHE_TTL)
+    # Rendered by a template, so already escaped
+    return mark_safe(fragment)
+
+
+def cached_fragments(kind, items, key, render):
+    """
+    Return the fragment of each item, looking them all up in the cache at once.
+    render is called once with the items that missed and returns their fragments in the same
+    order, so the data behind them can be loaded in a single query whatever the number of misses.
+    """
+    cache = fragment_cache()
+    keys = [key(item) for item in items]
+    fragments = cache.get_many(keys)
+    missed = [(item, item_key) for item, item_key in zip(items, keys) if item_key not in fragments]
+    fragment_cache_stats.record(kind, hits=len(items) - len(missed), misses=len(missed))
+    if missed:
+        rendered = dict(zip([item_key for _, item_key in missed], render([item for item, _ in missed])))
+        cache.set_many(rendered, settings.FRAGMENT_CACHE_TTL)
+        fragments.update(rendered)
+    return [mark_safe(fragments[item_key]) for item_key in keys]
+
+
+def bump_playlist_versions(playlist_ids):
+    """
+    Make the cached fragments of the given playlists stale. playlist_ids may be a list or a
+    values('playlist_id') queryset. Called from the signal handlers below, and explicitly
+    after the bulk writes and queryset updates that send no signals.
+    """
+    Playlist.objects.filter(id__in=playlist_ids).update(version=F('version') + 1)
+
+
+def song_changed(sender, instance, **kwargs):
+    # Saving or deleting a song changes its playlist's grid and possibly its carousel
+    bump_playlist_versions([instance.playlist_id])
+
+
+def playlist_saved(sender, instance, created, **kwargs):
+    # A new playlist has no fragments yet. The instance is reloaded rather than incremented,
+    # since its version may already be behind the database's
+    if not created:
+        bump_playlist_versions([instance.id])
+        instance.refresh_from_db(fields=['version'])
+
+
+def track_saved(sender, instance, created, **kwargs):
+    # A track's title is shown in every playlist that has it
+    if not created:
+        bump_playlist_versions(Song.objects.filter(track=instance).values('playlist_id'))
+
+
+def connect_signals():
+    """
+    Connect the handlers keeping Playlist.version current. A deleted playlist needs no handler:
+    its fragments are only looked up through the playlist itself.
+    """
+    post_save.connect(song_changed, sender=Song, dispatch_uid='fragment_cache_song_saved')
+    post_delete.connect(song_changed, sender=Song, dispatch_uid='fragment_cache_song_deleted')
+    post_save.connect(playlist_saved, sender=Playlist, dispatch_uid='fragment_cache_playlist_saved')
+    post_save.connect(track_saved, sender=Track, dispatch_uid='fragment_cache_track_saved')
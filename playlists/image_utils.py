@@ -0,0 +1,442 @@
+# playlists/image_utils.py
+
+import base64
+import fcntl
+import os
+import posixpath
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from io import BytesIO
+
+import numpy as np
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.utils import timezone
+from PIL import ExifTags, Image, ImageOps  # Pillow, already required by Song.photo's ImageField
+from .fragment_cache import bump_playlist_versions
+from .models import Song
+from .storage import photo_storage
+
+# Storage directories for song photos and for uploads waiting for the photo worker
+UPLOAD_DIR = 'song_photos'
+STAGING_DIR = 'song_photos/staging'
+# Lock file serializing the reference checks of shared photos (see photo_refs_lock); kept
+# in the staging directory, which is never served
+PHOTO_REFS_LOCK = f'{STAGING_DIR}/.refs.lock'
+
+# Outcomes of complete_staged_photo
+COMPLETE_READY = 'ready'
+COMPLETE_DISCARDED = 'discarded'
+COMPLETE_REQUEUED = 'requeued'
+
+# Widths in pixels of the renditions generated for each photo
+RENDITION_WIDTHS = (320, 640, 1280)
+
+# Output formats as (file extension, Pillow format, save options), most efficient first
+RENDITION_FORMATS = (
+    ('avif', 'AVIF', {'quality': 60, 'speed': 8}),
+    ('webp', 'WEBP', {'quality': 80}),
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+# Content types used in <source type="..."> for each extension
+RENDITION_CONTENT_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpg': 'image/jpeg'}
+
+# Placeholders shown while a photo loads: a preview this many pixels along its longer side,
+# each pixel the average of a block of PLACEHOLDER_BLOCK x PLACEHOLDER_BLOCK sampled pixels
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_BLOCK = 4
+PLACEHOLDER_COLORS = 4  # Colours in the palette, most common first
+PLACEHOLDER_COLOR_BITS = 3  # Bits per channel when counting colours, so 512 colour bins
+
+# Formats for the inline preview as (Pillow format, content type, save options), smallest first
+PLACEHOLDER_FORMATS = (
+    ('WEBP', 'image/webp', {'quality': 50}),
+    ('PNG', 'image/png', {'optimize': True}),
+)
+
+
+def available_formats():
+    """
+    The rendition formats this Pillow build can write; AVIF needs a recent Pillow with libavif.
+    """
+    Image.init()
+    return [fmt for fmt in RENDITION_FORMATS if fmt[1] in Image.SAVE]
+
+
+def rendition_name(name, width, ext):
+    """
+    Storage name of a rendition, next to the original: song_photos/3f/3fa4...e1.jpeg
+    becomes song_photos/3f/3fa4...e1.640w.webp.
+    """
+    root, _ = os.path.splitext(name)
+    return f'{root}.{width}w.{ext}'
+
+
+def rendition_widths(image_width):
+    """
+    Widths generated for an image: never wider than the image itself, and a photo narrower
+    than every rendition width gets a single rendition at its own width.
+    """
+    return [width for width in RENDITION_WIDTHS if width <= image_width] or [image_width]
+
+
+def generate_renditions(name):
+    """
+    Write resized copies of the stored image `name` in every available format.
+    EXIF orientation is applied to the pixels and no metadata is copied to the renditions.
+    Returns the lists of widths and of format extensions that were generated.
+    """
+    largest = max(RENDITION_WIDTHS)
+    with default_storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        # Let JPEGs decode at a reduced scale that is still at least as large as the renditions
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        # Drop alpha and palettes so every format, including JPEG, can be written
+        image = image.convert('RGB')
+
+    widths = rendition_widths(image.width)
+    formats = available_formats()
+    resized = image
+    # Work from the largest width down, resizing each rendition from the previous one
+    for width in sorted(widths, reverse=True):
+        if width != resized.width:
+            resized = resized.resize((width, round(resized.height * width / resized.width)), Image.LANCZOS)
+        for ext, fmt, options in formats:
+            buffer = BytesIO()
+            resized.save(buffer, fmt, **options)
+            path = rendition_name(name, width, ext)
+            # Replace any earlier rendition rather than letting storage pick a new name
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            default_storage.save(path, ContentFile(buffer.getvalue()))
+    return widths, [ext for ext, _, _ in formats]
+
+
+def existing_renditions(name):
+    """
+    The rendition widths and formats of the stored image `name` if all of them already exist
+    in every format available here, else None. Only the image header is read, so this is
+    cheap compared to generating them.
+    """
+    with default_storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        width, height = image.size
+        # Orientations 5-8 are rotated by 90 degrees, which swaps width and height
+        if image.getexif().get(ExifTags.Base.Orientation, 1) >= 5:
+            width = height
+    widths = rendition_widths(width)
+    formats = [ext for ext, _, _ in available_formats()]
+    for width in widths:
+        for ext in formats:
+            if not default_storage.exists(rendition_name(name, width, ext)):
+                return None
+    return widths, formats
+
+
+def delete_renditions(name, widths):
+    """
+    Remove the renditions generated for the stored image `name`.
+    """
+    for width in widths:
+        for ext, _, _ in RENDITION_FORMATS:
+            path = rendition_name(name, width, ext)
+            if default_storage.exists(path):
+                default_storage.delete(path)
+
+
+def stored_renditions(name):
+    """
+    Storage names of the renditions next to the content-addressed photo `name`, whatever
+    their widths and formats: the other files in its directory starting with its hash.
+    """
+    directory, filename = posixpath.split(name)
+    prefix = os.path.splitext(filename)[0] + '.'
+    try:
+        _, files = photo_storage.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [posixpath.join(directory, file) for file in files if file.startswith(prefix) and file != filename]
+
+
+@contextmanager
+def photo_refs_lock():
+    """
+    Hold an exclusive lock, shared by every process using the media directory, around
+    the code that points songs at stored photos and the code that deletes unreferenced ones.
+    Otherwise a photo could be deleted between an upload finding it already stored and its
+    song being updated to refer to it. Writes made under the lock must be committed before
+    it is released, so callers run outside transactions.
+    """
+    path = default_storage.path(PHOTO_REFS_LOCK)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def release_photo(name):
+    """
+    Delete a stored photo and its renditions once no song refers to it any more.
+    Content-addressed photos are shared by every song that uploaded the same image, so the
+    songs referencing a file act as its reference count.
+    """
+    if not name:
+        return False
+    with photo_refs_lock():
+        if Song.objects.filter(photo=name).exists():
+            return False
+        if photo_storage.exists(name):
+            photo_storage.delete(name)
+        for path in stored_renditions(name):
+            photo_storage.delete(path)
+    return True
+
+
+def srgb_to_linear(values):
+    """
+    sRGB values in 0-1 to linear light, where averaging colours matches how they mix.
+    """
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_srgb(values):
+    return np.where(values <= 0.0031308, values * 12.92, 1.055 * np.power(values, 1 / 2.4) - 0.055)
+
+
+def hex_color(rgb):
+    return '#{:02x}{:02x}{:02x}'.format(*(int(value) for value in rgb))
+
+
+def compute_placeholder(name):
+    """
+    The placeholder of the stored image `name`: its dominant colour, a palette of its most
+    common colours and a PLACEHOLDER_SIZE preview as a data URI, a few hundred bytes in all.
+    Pixels are averaged in linear light, so the preview does not darken around edges
+    and highlights the way averaging sRGB values does.
+    """
+    with default_storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        sample = PLACEHOLDER_SIZE * PLACEHOLDER_BLOCK
+        # JPEGs decode at a fraction of their size, which is all a placeholder needs
+        image.draft('RGB', (sample, sample))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    scale = PLACEHOLDER_SIZE / max(image.size)
+    columns = max(1, round(image.width * scale))
+    rows = max(1, round(image.height * scale))
+    image = image.resize((columns * PLACEHOLDER_BLOCK, rows * PLACEHOLDER_BLOCK), Image.BOX)
+    pixels = np.asarray(image, dtype=np.uint8)
+    linear = srgb_to_linear(pixels / 255.0)
+
+    # Average each block into one preview pixel
+    blocks = linear.reshape(rows, PLACEHOLDER_BLOCK, columns, PLACEHOLDER_BLOCK, 3).mean(axis=(1, 3))
+    preview = np.rint(linear_to_srgb(blocks) * 255).astype(np.uint8)
+
+    # Count the sampled pixels per colour bin, and average the colours that fell in each bin
+    shift = 8 - PLACEHOLDER_COLOR_BITS
+    binned = (pixels >> shift).astype(np.intp).reshape(-1, 3)
+    bins = (binned[:, 0] << (2 * PLACEHOLDER_COLOR_BITS)) | (binned[:, 1] << PLACEHOLDER_COLOR_BITS) | binned[:, 2]
+    size = 1 << (3 * PLACEHOLDER_COLOR_BITS)
+    counts = np.bincount(bins, minlength=size)
+    flat = linear.reshape(-1, 3)
+    sums = np.stack([np.bincount(bins, weights=flat[:, channel], minlength=size) for channel in range(3)], axis=1)
+    top = np.argsort(counts, kind='stable')[::-1][:PLACEHOLDER_COLORS]
+    top = top[counts[top] > 0]
+    palette = np.rint(linear_to_srgb(sums[top] / counts[top, None]) * 255)
+    return {
+        'color': hex_color(palette[0]),
+        'palette': [hex_color(rgb) for rgb in palette],
+        'preview': preview_data_uri(Image.fromarray(preview)),
+    }
+
+
+def preview_data_uri(image):
+    Image.init()
+    fmt, content_type, options = next(fmt for fmt in PLACEHOLDER_FORMATS if fmt[0] in Image.SAVE)
+    buffer = BytesIO()
+    image.save(buffer, fmt, **options)
+    return f'data:{content_type};base64,{base64.b64encode(buffer.getvalue()).decode()}'
+
+
+def process_song_photo(song):
+    """
+    Generate the renditions and the placeholder for a song's current photo and record them on the song.
+    """
+    song.photo_renditions, song.photo_rendition_formats = generate_renditions(song.photo.name)
+    song.photo_placeholder = compute_placeholder(song.photo.name)
+    song.save(update_fields=['photo_renditions', 'photo_rendition_formats', 'photo_placeholder'])
+
+
+def stage_upload(uploaded_file):
+    """
+    Save an uploaded photo, unchecked, to the staging area and return its storage name.
+    Large uploads are already on disk as temporary files, so this is usually just a move.
+    """
+    # A directory per upload keeps the client's filename (and extension) for the final placement
+    return default_storage.save(f'{STAGING_DIR}/{uuid.uuid4().hex}/{os.path.basename(uploaded_file.name)}', uploaded_file)
+
+
+def staged_photo_name(staging_name):
+    """
+    The content-addressed storage name a staged upload is stored under.
+    """
+    with default_storage.open(staging_name, 'rb') as f:
+        return photo_storage.hashed_name(f'{UPLOAD_DIR}/{os.path.basename(staging_name)}', f)
+
+
+def process_staged_photo(staging_name):
+    """
+    Validate a staged upload, store it in the content-addressed photo storage and make sure
+    its renditions exist. Runs in the photo worker's process pool, so it only touches files,
+    never the database. Returns the final storage name, the rendition widths and formats
+    and the placeholder; raises OSError if the file is not an image Pillow can decode.
+    The staged file is kept until the result is recorded (see complete_staged_photo).
+    """
+    with default_storage.open(staging_name, 'rb') as f:
+        # verify() checks the file structure without decoding every pixel
+        Image.open(f).verify()
+
+    with default_storage.open(staging_name, 'rb') as f:
+        # Saving content that is already stored writes nothing, see ContentAddressedStorage
+        name = photo_storage.save(f'{UPLOAD_DIR}/{os.path.basename(staging_name)}', f)
+    # Renditions of a photo uploaded before are shared too, so they are only generated once.
+    # Nothing is deleted if this fails: the photo may be shared by now, so it is only
+    # released once the failure is recorded (see fail_staged_photo)
+    widths, formats = existing_renditions(name) or generate_renditions(name)
+    placeholder = compute_placeholder(name)
+    return name, widths, formats, placeholder
+
+
+def delete_staged(staging_name):
+    """
+    Remove a staged upload and its per-upload directory.
+    """
+    if default_storage.exists(staging_name):
+        default_storage.delete(staging_name)
+    try:
+        os.rmdir(default_storage.path(os.path.dirname(staging_name)))
+    except (NotImplementedError, OSError):
+        # Storage without local paths, or the directory is already gone
+        pass
+
+
+def claim_pending_photos(limit):
+    """
+    Move up to `limit` songs with a pending upload to processing and return them.
+    The conditional update stops two workers from claiming the same upload.
+    """
+    claimed = []
+    for song in Song.objects.filter(photo_status=Song.PHOTO_PENDING).only('id', 'photo_staging')[:limit]:
+        if Song.objects.filter(id=song.id, photo_status=Song.PHOTO_PENDING).update(
+            photo_status=Song.PHOTO_PROCESSING, photo_claimed_at=timezone.now()
+        ):
+            claimed.append(song)
+    return claimed
+
+
+def refresh_photo_claims(song_ids):
+    """
+    Heartbeat for the uploads a worker is processing, so requeue_stale_photos leaves them alone.
+    """
+    Song.objects.filter(id__in=song_ids, photo_status=Song.PHOTO_PROCESSING).update(photo_claimed_at=timezone.now())
+
+
+def requeue_stale_photos(stale_after):
+    """
+    Return uploads whose worker stopped refreshing its claim to the pending queue.
+    """
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    # Uploads claimed before claims were timed have none
+    stale = Q(photo_claimed_at__lt=cutoff) | Q(photo_claimed_at__isnull=True)
+    return Song.objects.filter(stale, photo_status=Song.PHOTO_PROCESSING).update(
+        photo_status=Song.PHOTO_PENDING, photo_claimed_at=None
+    )
+
+
+def renditions_exist(name, widths, formats):
+    return all(
+        photo_storage.exists(rendition_name(name, width, ext)) for width in widths for ext in formats
+    )
+
+
+def complete_staged_photo(song_id, staging_name, name, widths, formats, placeholder):
+    """
+    Point a song at its processed photo, then release the photo it replaces and the staged
+    upload. Returns COMPLETE_READY, or COMPLETE_DISCARDED if the song was deleted or another
+    upload replaced this one while it was processed, or COMPLETE_REQUEUED if the photo was
+    released by another song in the meantime (it had no reference from this one yet) and
+    has to be stored again from the staged upload.
+    """
+    song = Song.objects.filter(id=song_id).only('id', 'playlist_id', 'photo').first()
+    current = Song.objects.filter(id=song_id, photo_staging=staging_name)
+    # Checked and referenced under the lock, so the photo cannot be released in between
+    with photo_refs_lock():
+        if not (photo_storage.exists(name) and renditions_exist(name, widths, formats)):
+            if current.update(photo_status=Song.PHOTO_PENDING):
+                return COMPLETE_REQUEUED
+            updated = 0
+        else:
+            updated = current.update(
+                photo=name, photo_renditions=widths, photo_rendition_formats=formats,
+                photo_placeholder=placeholder, photo_status=Song.PHOTO_READY, photo_staging=''
+            )
+
+    delete_staged(staging_name)
+    if not updated:
+        # The song was deleted (with its playlist, or by a re-sync) or has a newer upload
+        release_photo(name)
+        return COMPLETE_DISCARDED
+    # The queryset update sends no signal, so make the playlist's cached grid stale here
+    bump_playlist_versions([song.playlist_id])
+    if song.photo and song.photo.name != name:
+        release_photo(song.photo.name)
+    return COMPLETE_READY
+
+
+def fail_staged_photo(song_id, staging_name):
+    """
+    Drop an upload that could not be processed; the song keeps its previous photo.
+    """
+    # The upload may have been stored before processing failed; release it unless it is shared
+    try:
+        name = staged_photo_name(staging_name)
+    except OSError:
+        name = ''
+    delete_staged(staging_name)
+    release_photo(name)
+    playlist_ids = list(Song.objects.filter(id=song_id).values_list('playlist_id', flat=True))
+    if Song.objects.filter(id=song_id, photo_staging=staging_name).update(
+        photo_status=Song.PHOTO_FAILED, photo_staging=''
+    ):
+        # Only after the update, so no request can cache the old grid under the new version
+        bump_playlist_versions(playlist_ids)
+
+
+def song_deleted(sender, instance, using, **kwargs):
+    """
+    Release a deleted song's photo, and its upload if no worker has claimed it, once the
+    deletion is committed: songs are deleted with their playlist, by re-syncs and from the admin.
+    """
+    if instance.photo:
+        name = instance.photo.name
+        transaction.on_commit(lambda: release_photo(name), using=using)
+    # A claimed upload is cleaned up by the worker, which finds the song gone
+    if instance.photo_staging and instance.photo_status == Song.PHOTO_PENDING:
+        staging_name = instance.photo_staging
+        transaction.on_commit(lambda: delete_staged(staging_name), using=using)
+
+
+def connect_signals():
+    """
+    Connect the handler releasing the photos of deleted songs.
+    """
+    post_delete.connect(song_deleted, sender=Song, dispatch_uid='image_utils_song_deleted')
@@ -0,0 +1,456 @@
+# playlists/import_utils.py
+
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+import spotipy
+from django.conf import settings
+from django.db import transaction  # Import transaction to apply each import atomically
+from django.utils import timezone
+from .fragment_cache import bump_playlist_versions
+from .logging_utils import log_context, log_payload
+from .models import Album, Artist, ImportBatch, ImportJob, Playlist, Song, Track
+from .playlist_cache import invalidate_playlist_listing
+from .spotify_utils import get_spotify_client, get_playlist_header, get_playlist_tracks
+
+logger = logging.getLogger(__name__)
+
+# Playlists of a batch fetched at once. They share one client, and the rate budget of the
+# Spotify session (SPOTIFY_RATE_LIMIT) bounds their calls however many run in parallel
+BATCH_FETCH_WORKERS = 8
+# Playlists of a batch written per transaction, and the longest fetched playlists wait to be written
+BATCH_WRITE_SIZE = 20
+BATCH_WRITE_INTERVAL = 2.0  # Seconds
+
+
+def spotify_ids(model, field, objects):
+    """
+    Map the Spotify ids of a list of artist or album objects to catalog ids, inserting the missing ones.
+    """
+    objects = {obj['id']: obj for obj in objects if obj and obj.get('id')}
+    lookup = f'{field}__in'
+    known = dict(model.objects.filter(**{lookup: list(objects)}).values_list(field, 'id'))
+    missing = [obj for spotify_id, obj in objects.items() if spotify_id not in known]
+    if missing:
+        name_field = 'name' if model is Artist else 'title'
+        # A concurrent import may insert the same entries first, hence ignore_conflicts and the second lookup
+        model.objects.bulk_create(
+            [model(**{field: obj['id'], name_field: obj.get('name') or ''}) for obj in missing],
+            ignore_conflicts=True
+        )
+        known.update(model.objects.filter(**{lookup: [obj['id'] for obj in missing]}).values_list(field, 'id'))
+    return known
+
+
+def catalog_tracks(tracks):
+    """
+    Make sure every Spotify track object is in the shared catalog and map their ids to Track ids.
+    Tracks already in the catalog cost a single lookup: their artists and album are not written
+    again and only a changed title is updated. Entries still missing their artists (carried over
+    from before the catalog existed) get the full metadata.
+    Returns the mapping and the set of Track ids whose metadata was updated.
+    """
+    existing = {
+        track.spotify_track_id: track
+        for track in Track.objects.filter(spotify_track_id__in=list(tracks)).only(
+            'id', 'spotify_track_id', 'title', 'artist_names'
+        )
+    }
+    new = [data for track_id, data in tracks.items() if track_id not in existing]
+    incomplete = [track for track_id, track in existing.items()
+                  if not track.artist_names and tracks[track_id].get('artists')]
+    renamed = [track for track_id, track in existing.items()
+               if track.artist_names and track.title != tracks[track_id]['name'][:200]]
+
+    # Artists and albums are only resolved for the tracks whose metadata is written
+    written = new + [tracks[track.spotify_track_id] for track in incomplete]
+    artist_ids = spotify_ids(Artist, 'spotify_artist_id',
+                             [artist for data in written for artist in data.get('artists') or []])
+    album_ids = spotify_ids(Album, 'spotify_album_id', [data.get('album') for data in written])
+
+    def metadata(data):
+        artists = [artist for artist in data.get('artists') or [] if artist]
+        return {
+            'title': data['name'][:200],
+            'artist_names': ', '.join(artist.get('name') or '' for artist in artists)[:255],
+            'album_id': album_ids.get((data.get('album') or {}).get('id')),
+        }
+
+    Track.objects.bulk_create(
+        [Track(spotify_track_id=data['id'], **metadata(data)) for data in new], ignore_conflicts=True
+    )
+    for track in incomplete:
+        for name, value in metadata(tracks[track.spotify_track_id]).items():
+            setattr(track, name, value)
+    Track.objects.bulk_update(incomplete, ['title', 'artist_names', 'album_id'])
+    for track in renamed:
+        track.title = tracks[track.spotify_track_id]['name'][:200]
+    Track.objects.bulk_update(renamed, ['title'])
+
+    track_ids = {track_id: track.id for track_id, track in existing.items()}
+    track_ids.update(
+        Track.objects.filter(spotify_track_id__in=[data['id'] for data in new]).values_list('spotify_track_id', 'id')
+    )
+    Track.artists.through.objects.bulk_create([
+        Track.artists.through(track_id=track_ids[data['id']], artist_id=artist_ids[artist['id']])
+        for data in written
+        for artist in data.get('artists') or []
+        if artist and artist.get('id') in artist_ids
+    ], ignore_conflicts=True)
+
+    updated = {track.id for track in incomplete + renamed}
+    logger.debug(f'Catalog: {len(new)} tracks added, {len(updated)} updated, {len(existing) - len(updated)} reused')
+    return track_ids, updated
+
+
+def ingest_tracks(playlist, tracks, remove_missing=False):
+    """
+    Apply a list of Spotify track objects to a playlist's songs in one transaction.
+    The tracks are first added to the shared catalog (see catalog_tracks), then the playlist's
+    existing songs are looked up with a single query and the new ones written with bulk_create
+    instead of one update_or_create per track.
+    With remove_missing, Spotify songs of the playlist that are not in tracks are deleted.
+    Returns a dict with 'inserted', 'updated', 'unchanged' and 'removed' counts, where
+    'updated' counts the songs whose title changed on Spotify.
+    """
+    # Deduplicate by Spotify id, keeping the last occurrence of each track
+    # Tracks without an id (local files, removed tracks) cannot be matched and are skipped
+    incoming = {}
+    for track in tracks:
+        if track and track.get('id'):
+            incoming[track['id']] = track
+
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+
+    with transaction.atomic():
+        if remove_missing:
+            # Songs added by hand have no Spotify id and are never removed
+            removed = playlist.songs.exclude(track__spotify_track_id__isnull=True).exclude(
+                track__spotify_track_id__in=list(incoming)
+            )
+            counts['removed'] = removed.delete()[1].get(Song._meta.label, 0)
+        if not incoming:
+            return counts
+
+        track_ids, updated = catalog_tracks(incoming)
+
+        # Fetch the playlist's existing songs for these tracks in a single query
+        existing = set(playlist.songs.filter(track_id__in=list(track_ids.values())).values_list('track_id', flat=True))
+        to_create = [Song(track_id=track_id, playlist=playlist)
+                     for track_id in track_ids.values() if track_id not in existing]
+
+        # Django picks a batch size that fits the backend's parameter limits. A concurrent
+        # import of the same playlist may insert a track first; the unique constraint on
+        # (playlist, track) then makes this insert skip it instead of failing
+        # Photos of existing songs are left untouched so re-imports keep the user's uploads
+        Song.objects.bulk_create(to_create, ignore_conflicts=True)
+        # Bulk writes send no signals, so the cached fragments are made stale here: those of
+        # this playlist when its songs changed, and those of every playlist with a renamed track
+        if to_create or counts['removed']:
+            bump_playlist_versions([playlist.id])
+        if updated:
+            bump_playlist_versions(Song.objects.filter(track_id__in=updated).values('playlist_id'))
+
+    counts['inserted'] = len(to_create)
+    # Renamed tracks are updated once in the catalog, for every playlist that has them
+    counts['updated'] = len(existing & updated)
+    counts['unchanged'] = len(existing) - counts['updated']
+    return counts
+
+
+def fetch_playlist(spotify_client, spotify_playlist_id, snapshot_id=None, on_page=None):
+    """
+    Fetch a playlist's header and, unless its snapshot_id is the one given, all of its tracks.
+    Makes no database queries, so it can run in any thread.
+    Returns the header and the track objects, or None as the tracks when it is unchanged.
+    """
+    header = get_playlist_header(spotify_client, spotify_playlist_id)
+    log_payload(logger, 'Fetched playlist header', header)
+    if snapshot_id and snapshot_id == header.get('snapshot_id'):
+        return header, None
+    return header, get_playlist_tracks(spotify_client, header, on_page)
+
+
+def next_sync_at(synced_at):
+    """
+    When a playlist synced at synced_at is next due for the sync_playlists scheduler.
+    """
+    return synced_at + timedelta(seconds=settings.PLAYLIST_SYNC_INTERVAL)
+
+
+def save_playlist(user, spotify_playlist_id, header, tracks, synced_at):
+    """
+    Create or update a user's playlist from its fetched header and tracks in one transaction.
+    Returns the Playlist and the ingest counts.
+    """
+    with transaction.atomic():
+        # Create or update Playlist in Django with the fetched name and description
+        playlist, created = Playlist.objects.update_or_create(
+            spotify_playlist_id=spotify_playlist_id,
+            user=user,
+            defaults={
+                'title': header.get('name', 'Imported Playlist'),
+                'description': header.get('description', ''),
+                'snapshot_id': header.get('snapshot_id'),
+                'last_synced_at': synced_at,
+                'next_sync_at': next_sync_at(synced_at),
+            }
+        )
+        counts = ingest_tracks(playlist, tracks, remove_missing=True)
+    logger.info(f'Playlist "{playlist.title}" {"created" if created else "updated"}: {counts}')
+    return playlist, counts
+
+
+def import_playlist(user, spotify_playlist_id, spotify_client, on_page=None, force=False):
+    """
+    Sync a Spotify playlist and its tracks into the user's playlists.
+    Only the playlist header is fetched first; if the stored snapshot_id still matches,
+    nothing else is fetched or written (unless force is set). Otherwise every track is
+    fetched and only the added, changed and removed songs are written.
+    Returns the Playlist and the ingest counts, or None as the counts when it was up to date.
+    """
+    playlist = Playlist.objects.filter(spotify_playlist_id=spotify_playlist_id, user=user).first()
+    snapshot_id = playlist.snapshot_id if playlist and not force else None
+    # Every page of tracks is collected before opening a transaction so no lock is held during API calls
+    header, tracks = fetch_playlist(spotify_client, spotify_playlist_id, snapshot_id, on_page)
+    now = timezone.now()
+
+    if tracks is None:
+        Playlist.objects.filter(id=playlist.id).update(last_synced_at=now, next_sync_at=next_sync_at(now))
+        logger.info(f'Playlist "{playlist.title}" is unchanged since snapshot {playlist.snapshot_id}.')
+        return playlist, None
+
+    return save_playlist(user, spotify_playlist_id, header, tracks, now)
+
+
+def pending_jobs():
+    """
+    The import queue, oldest first, which the worker polls every second.
+    """
+    return ImportJob.objects.filter(state=ImportJob.PENDING).order_by('created_at')
+
+
+def claim_next_job():
+    """
+    Move the oldest pending ImportJob to running and return it, or None if the queue is empty.
+    The conditional update makes the claim safe between workers on any database backend.
+    """
+    while True:
+        job = pending_jobs().first()
+        if job is None:
+            return None
+        now = timezone.now()
+        claimed = ImportJob.objects.filter(id=job.id, state=ImportJob.PENDING).update(
+            state=ImportJob.RUNNING, started_at=now, updated_at=now
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+        # Another worker claimed this job first, try the next one
+
+
+def claim_batch_jobs(batch_id):
+    """
+    Claim the pending jobs of a batch, so that one worker runs the whole batch.
+    Each job is claimed with the same conditional update as in claim_next_job, all in one
+    transaction; jobs another worker claimed first are left to it.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = [
+            job_id
+            for job_id in list(ImportJob.objects.filter(batch_id=batch_id, state=ImportJob.PENDING).values_list('id', flat=True))
+            if ImportJob.objects.filter(id=job_id, state=ImportJob.PENDING).update(
+                state=ImportJob.RUNNING, started_at=now, updated_at=now
+            )
+        ]
+    return list(ImportJob.objects.filter(id__in=claimed))
+
+
+def queue_import_batch(user, spotify_playlist_ids):
+    """
+    Create an ImportBatch with a pending ImportJob for each playlist, in one transaction.
+    """
+    with transaction.atomic():
+        batch = ImportBatch.objects.create(user=user)
+        ImportJob.objects.bulk_create([
+            ImportJob(user=user, batch=batch, spotify_playlist_id=spotify_playlist_id)
+            for spotify_playlist_id in spotify_playlist_ids
+        ])
+    return batch
+
+
+def requeue_stale_jobs(stale_after):
+    """
+    Return running jobs whose worker stopped reporting progress to the pending queue.
+    """
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return ImportJob.objects.filter(state=ImportJob.RUNNING, updated_at__lt=cutoff).update(
+        state=ImportJob.PENDING, updated_at=timezone.now()
+    )
+
+
+def run_import_job(job):
+    """
+    Run a claimed ImportJob to completion, recording progress and the outcome on the job.
+    """
+    # Tag every log line written while the job runs with its id
+    with log_context(job_id=job.id):
+        def report_progress(done, total):
+            ImportJob.objects.filter(id=job.id).update(tracks_done=done, tracks_total=total, updated_at=timezone.now())
+
+        spotify_client = get_spotify_client(job.user)
+        if not spotify_client:
+            finish_job(job, ImportJob.FAILED, error='Spotify client not available. Please connect your Spotify account.')
+            return job
+
+        try:
+            playlist, counts = import_playlist(job.user, job.spotify_playlist_id, spotify_client, report_progress)
+        except spotipy.SpotifyException as e:
+            logger.error(f'Spotify API error in import job {job.id}: {e}')
+            finish_job(job, ImportJob.FAILED, error=f'Spotify API error: {e}')
+        except Exception as e:
+            logger.exception(f'Import job {job.id} failed')
+            finish_job(job, ImportJob.FAILED, error=f'An unexpected error occurred: {e}')
+        else:
+            finish_imported_job(job, playlist, counts)
+            # Track counts in the import dropdown may have changed since the listing was cached
+            invalidate_playlist_listing(job.user)
+        return job
+
+
+def run_import_batch(jobs):
+    """
+    Run claimed jobs of one ImportBatch as a single operation.
+    The user's token is looked up once and one Spotify client is shared by every fetch.
+    Up to BATCH_FETCH_WORKERS playlists are fetched at once, all drawing on the Spotify
+    session's rate budget, and the fetched playlists are written BATCH_WRITE_SIZE at a time:
+    one transaction per group, with a savepoint per playlist so a failed write only fails
+    its own job. Each job records its own outcome, which ImportBatch.progress() combines.
+    """
+    user = jobs[0].user
+    spotify_client = get_spotify_client(user)
+    if not spotify_client:
+        ImportJob.objects.filter(id__in=[job.id for job in jobs]).update(
+            state=ImportJob.FAILED, error='Spotify client not available. Please connect your Spotify account.',
+            finished_at=timezone.now(), updated_at=timezone.now(),
+        )
+        return jobs
+
+    # Stored snapshot ids, so unchanged playlists are skipped without a query per playlist
+    snapshots = dict(
+        Playlist.objects.filter(user=user, spotify_playlist_id__in=[job.spotify_playlist_id for job in jobs])
+        .values_list('spotify_playlist_id', 'snapshot_id')
+    )
+
+    def fetch(job):
+        with log_context(job_id=job.id):
+            return fetch_playlist(spotify_client, job.spotify_playlist_id, snapshots.get(job.spotify_playlist_id))
+
+    unfinished = {job.id for job in jobs}
+    fetched = []
+    last_write = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=min(BATCH_FETCH_WORKERS, len(jobs))) as pool:
+            # Each fetch runs in a copy of this context, so its log lines keep the worker's ids
+            futures = {pool.submit(contextvars.copy_context().run, fetch, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    fetched.append((job, *future.result()))
+                except spotipy.SpotifyException as e:
+                    logger.error(f'Spotify API error in import job {job.id}: {e}')
+                    finish_job(job, ImportJob.FAILED, error=f'Spotify API error: {e}')
+                    unfinished.discard(job.id)
+                except Exception as e:
+                    logger.exception(f'Import job {job.id} failed')
+                    finish_job(job, ImportJob.FAILED, error=f'An unexpected error occurred: {e}')
+                    unfinished.discard(job.id)
+
+                if len(fetched) >= BATCH_WRITE_SIZE or (fetched and time.monotonic() - last_write >= BATCH_WRITE_INTERVAL):
+                    unfinished -= write_batch_group(user, fetched)
+                    fetched = []
+                    last_write = time.monotonic()
+                    # Heartbeat, so requeue_stale_jobs leaves the jobs still being fetched alone
+                    ImportJob.objects.filter(id__in=unfinished).update(updated_at=timezone.now())
+        unfinished -= write_batch_group(user, fetched)
+    except Exception as e:
+        # A group's transaction failed as a whole, e.g. the database went away
+        logger.exception(f'Import batch {jobs[0].batch_id} failed')
+        ImportJob.objects.filter(id__in=unfinished).update(
+            state=ImportJob.FAILED, error=f'An unexpected error occurred: {e}',
+            finished_at=timezone.now(), updated_at=timezone.now(),
+        )
+
+    # Track counts in the import dropdown may have changed since the listing was cached
+    invalidate_playlist_listing(user)
+    return jobs
+
+
+def write_batch_group(user, fetched):
+    """
+    Write a group of fetched playlists of a batch in one transaction and finish their jobs.
+    fetched holds (job, header, tracks) tuples, with None as the tracks of unchanged playlists.
+    Returns the ids of the jobs finished.
+    """
+    now = timezone.now()
+    failed = []
+    with transaction.atomic():
+        unchanged = [job.spotify_playlist_id for job, _, tracks in fetched if tracks is None]
+        Playlist.objects.filter(user=user, spotify_playlist_id__in=unchanged).update(
+            last_synced_at=now, next_sync_at=next_sync_at(now)
+        )
+        playlists = {
+            playlist.spotify_playlist_id: playlist
+            for playlist in Playlist.objects.filter(user=user, spotify_playlist_id__in=unchanged)
+        }
+        for job, header, tracks in fetched:
+            try:
+                with log_context(job_id=job.id), transaction.atomic():
+                    if tracks is None:
+                        playlist, counts = playlists[job.spotify_playlist_id], None
+                    else:
+                        playlist, counts = save_playlist(user, job.spotify_playlist_id, header, tracks, now)
+                    finish_imported_job(job, playlist, counts)
+            except Exception as e:
+                # The savepoint is rolled back, the rest of the group is kept
+                logger.exception(f'Import job {job.id} failed')
+                failed.append((job, e))
+    for job, e in failed:
+        finish_job(job, ImportJob.FAILED, error=f'An unexpected error occurred: {e}')
+    return {job.id for job, _, _ in fetched}
+
+
+def finish_imported_job(job, playlist, counts):
+    """
+    Record a successful import on its job, with a summary of what changed.
+    counts are the ingest counts, or None when the playlist was already up to date.
+    """
+    song_count = playlist.songs.count()
+    if counts is None:
+        message = f'Playlist "{playlist.title}" is already up to date with {song_count} songs.'
+    else:
+        message = (
+            f'Playlist "{playlist.title}" imported successfully with {song_count} songs '
+            f'({counts["inserted"]} added, {counts["updated"]} updated, {counts["removed"]} removed, '
+            f'{counts["unchanged"]} unchanged).'
+        )
+    finish_job(job, ImportJob.SUCCEEDED, message=message,
+               playlist=playlist, tracks_done=song_count, tracks_total=song_count)
+
+
+def finish_job(job, state, message='', error='', **fields):
+    """
+    Record the final state of an ImportJob, plus any extra fields given.
+    Only the named fields are saved so progress written by report_progress is kept.
+    """
+    job.state = state
+    job.message = message[:255]
+    job.error = error
+    job.finished_at = timezone.now()
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.save(update_fields=['state', 'message', 'error', 'finished_at', 'updated_at', *fields])
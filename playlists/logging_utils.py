@@ -0,0 +1,83 @@
+# playlists/logging_utils.py
+
+import contextvars
+import json
+import logging
+import random
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+# Correlation ids of the request or import job being handled, added to every log line
+request_id = contextvars.ContextVar('request_id', default=None)
+job_id = contextvars.ContextVar('job_id', default=None)
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Adds the current request_id and job_id to log records.
+    Attached to handlers rather than loggers, so it only runs for records that are emitted.
+    """
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        record.job_id = job_id.get()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats each record as a single line of JSON.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in ('request_id', 'job_id', 'payload'):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+@contextmanager
+def log_context(**ids):
+    """
+    Set correlation ids (request_id and/or job_id) for the log lines written inside the block.
+    """
+    variables = {'request_id': request_id, 'job_id': job_id}
+    tokens = [(variables[name], variables[name].set(value)) for name, value in ids.items()]
+    try:
+        yield
+    finally:
+        for variable, token in reversed(tokens):
+            variable.reset(token)
+
+
+def map_in_context(pool, func, items):
+    """
+    Like pool.map(func, items), but each call runs in a copy of the caller's context, so
+    the caller's correlation ids and request metrics also cover work done in the pool.
+    """
+    items = list(items)
+    # A context can only be entered by one thread at a time, hence a copy per call
+    contexts = [contextvars.copy_context() for _ in items]
+    return pool.map(lambda context, item: context.run(func, item), contexts, items)
+
+
+def log_payload(logger, message, payload):
+    """
+    Log an API payload at DEBUG for a sample of calls (LOG_PAYLOAD_SAMPLE_RATE).
+    When DEBUG is disabled this is a single level check; the payload is only serialized
+    (and truncated to LOG_PAYLOAD_MAX_CHARS) for the calls that are sampled.
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or random.random() >= settings.LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    logger.debug(message, extra={'payload': json.dumps(payload, default=str)[:settings.LOG_PAYLOAD_MAX_CHARS]})
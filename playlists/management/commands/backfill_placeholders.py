@@ -0,0 +1,48 @@
+# playlists/management/commands/backfill_placeholders.py
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from playlists.fragment_cache import bump_playlist_versions
+from playlists.image_utils import compute_placeholder
+from playlists.management.commands.run_photo_worker import init_process
+from playlists.models import SONG_HAS_PHOTO, Song
+
+
+class Command(BaseCommand):
+    help = 'Compute the loading placeholders of song photos stored before they existed, in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of photos to process in parallel (defaults to the CPU count).')
+        parser.add_argument('--force', action='store_true',
+                            help='Recompute placeholders for songs that already have them.')
+
+    def handle(self, *args, **options):
+        songs = Song.objects.filter(SONG_HAS_PHOTO)
+        if not options['force']:
+            songs = songs.filter(photo_placeholder={})
+        # Songs share content-addressed photos, so each file is only read once
+        names = list(songs.order_by().values_list('photo', flat=True).distinct())
+
+        done = failed = 0
+        # The pool only reads files; every database write happens here as results come in
+        with ProcessPoolExecutor(max_workers=options['processes'], initializer=init_process) as pool:
+            futures = {pool.submit(compute_placeholder, name): name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    placeholder = future.result()
+                except OSError as e:
+                    # Missing or undecodable files are reported and skipped
+                    failed += 1
+                    self.stderr.write(f'Skipped {name}: {e}')
+                    continue
+                playlist_ids = list(Song.objects.filter(photo=name).values_list('playlist_id', flat=True))
+                Song.objects.filter(photo=name).update(photo_placeholder=placeholder)
+                # The queryset update sends no signal, so make the cached grids stale here
+                bump_playlist_versions(playlist_ids)
+                done += 1
+                self.stdout.write(f'{name}: {placeholder["color"]} {len(placeholder["preview"])} bytes')
+        self.stdout.write(self.style.SUCCESS(f'Computed {done} placeholder(s), {failed} failed.'))
@@ -0,0 +1,32 @@
+# playlists/management/commands/backfill_renditions.py
+
+from django.core.management.base import BaseCommand
+from playlists.image_utils import process_song_photo
+from playlists.models import SONG_HAS_PHOTO, Song
+
+
+class Command(BaseCommand):
+    help = ('Generate resized photo renditions for songs uploaded before they existed, or before '
+            'the formats they were written in were recorded.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate renditions for songs that already have them.')
+
+    def handle(self, *args, **options):
+        songs = Song.objects.filter(SONG_HAS_PHOTO)
+        if not options['force']:
+            songs = songs.filter(photo_rendition_formats=[])
+
+        done = failed = 0
+        for song in songs.iterator():
+            try:
+                process_song_photo(song)
+            except OSError as e:
+                # Missing or undecodable files are reported and skipped
+                failed += 1
+                self.stderr.write(f'Skipped song {song.id} ({song.photo.name}): {e}')
+            else:
+                done += 1
+                self.stdout.write(f'Generated {song.photo_renditions} {song.photo_rendition_formats} for {song.photo.name}')
+        self.stdout.write(self.style.SUCCESS(f'Processed {done} photo(s), {failed} failed.'))
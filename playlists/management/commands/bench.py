@@ -0,0 +1,261 @@
+# playlists/management/commands/bench.py
+
+import json
+import multiprocessing
+import socket
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from playlists.fragment_cache import bump_playlist_versions
+from playlists.import_utils import claim_batch_jobs, queue_import_batch, run_import_batch, run_import_job
+from playlists.metrics import RequestStats, request_stats
+from playlists.models import Album, Artist, ImportJob, Playlist, SpotifyToken, Track
+from playlists.playlist_cache import forget_playlist_listing
+from playlists.spotify_http import set_rate_budget
+from playlists.spotify_stub import run_spotify_stub, stub_playlist_id
+from playlists.spotify_utils import get_access_token
+
+# Slowdowns smaller than this are noise, whatever the tolerance
+MIN_SLOWDOWN = 0.005  # Seconds
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise CommandError(f'The Spotify stub did not start on port {port}')
+            time.sleep(0.05)
+
+
+def measure(name, func, **extra):
+    """
+    Run func once, counting its database queries and Spotify calls like PerformanceMiddleware
+    does for a request, including those made by the threads it starts.
+    Returns func's result and the measurement.
+    """
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    try:
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+    finally:
+        request_stats.reset(token)
+    return result, {
+        'name': name,
+        'seconds': round(seconds, 4),
+        'queries': stats.db_queries,
+        'spotify_calls': stats.spotify_calls,
+        **extra,
+    }
+
+
+class Command(BaseCommand):
+    help = ('End-to-end benchmark against a local Spotify stub: token refresh, single and batch '
+            'import throughput, re-syncs of unchanged playlists and page render times, each with '
+            'its query and Spotify call counts. Results are saved as JSON and can be compared '
+            'with an earlier run to catch regressions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                            help='Tracks in each playlist imported on its own.')
+        parser.add_argument('--batch', type=int, default=20, help='Playlists in the batch import.')
+        parser.add_argument('--batch-tracks', type=int, default=100, help='Tracks in each playlist of the batch.')
+        parser.add_argument('--repeat', type=int, default=5, help='Renders of each page; the median is reported.')
+        parser.add_argument('--latency', type=float, default=0.02, help='Seconds the stub waits per response.')
+        parser.add_argument('--throttle-every', type=int, default=0,
+                            help='Answer every nth Spotify API call with a 429 (0 never).')
+        parser.add_argument('--page-size', type=int, default=None,
+                            help='Most items the stub returns per page, below what the client asks for.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Spotify calls a second allowed by the rate budget during the run (0 no limit).')
+        parser.add_argument('--output', default=None,
+                            help='JSON file for the results (default bench-results/bench-<time>.json).')
+        parser.add_argument('--baseline', default=None,
+                            help='Results of an earlier run to compare with; fails on any regression.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Slowdown against the baseline accepted as noise, as a fraction.')
+
+    def handle(self, *args, **options):
+        started_at = timezone.now()
+        # Ids of everything the run creates start with the seed, so it all starts cold and is easy to remove
+        seed = uuid.uuid4().hex[:6]
+        sizes = options['sizes'] + [options['batch_tracks']] * options['batch']
+        stub_port = free_port()
+        # In its own process, so its threads do not compete with the code being measured
+        stub = multiprocessing.Process(target=run_spotify_stub, args=(stub_port, sizes), kwargs={
+            'seed': seed,
+            'latency': options['latency'],
+            'throttle_every': options['throttle_every'],
+            'retry_after': 1,
+            'page_size': options['page_size'],
+        })
+        stub.start()
+        wait_for_port(stub_port)
+        stub_url = f'http://127.0.0.1:{stub_port}'
+        set_rate_budget(options['rate'])
+
+        user = User.objects.create(username=f'bench-{seed}')
+        # Already expired, so the run starts with a token refresh
+        SpotifyToken.objects.create(
+            user=user, access_token='expired', refresh_token='bench', token_type='Bearer', expires_in=3600,
+            expires_at=timezone.now() - timedelta(hours=1), scope='',
+        )
+        stub_settings = override_settings(
+            SPOTIFY_API_URL=f'{stub_url}/v1',
+            SPOTIFY_ACCOUNTS_URL=stub_url,
+            SPOTIPY_CLIENT_ID=settings.SPOTIPY_CLIENT_ID or 'bench',
+            SPOTIPY_CLIENT_SECRET=settings.SPOTIPY_CLIENT_SECRET or 'bench',
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            # Counted here instead; a sampled request would count its queries on its own
+            PERF_METRICS_SAMPLE_EVERY=0,
+        )
+        try:
+            with stub_settings:
+                results = self.run_imports(user, seed, options) + self.run_pages(user, options['repeat'])
+        finally:
+            stub.terminate()
+            stub.join()
+            user.delete()
+            Track.objects.filter(spotify_track_id__startswith=seed).delete()
+            Album.objects.filter(spotify_album_id__startswith=seed).delete()
+            Artist.objects.filter(spotify_artist_id__startswith=seed).delete()
+
+        for result in results:
+            throughput = f'{result["tracks_per_second"]:>9,.0f} tracks/s' if 'tracks_per_second' in result else ''
+            self.stdout.write(
+                f'{result["name"]:<32} {result["seconds"] * 1000:>9.1f} ms  {result["queries"]:>5} queries  '
+                f'{result["spotify_calls"]:>5} Spotify calls  {throughput}'
+            )
+
+        report = {
+            'started_at': started_at.isoformat(),
+            'database': connection.vendor,
+            'options': {name: options[name] for name in (
+                'sizes', 'batch', 'batch_tracks', 'repeat', 'latency', 'throttle_every', 'page_size', 'rate')},
+            'results': results,
+        }
+        output = Path(options['output'] or settings.BASE_DIR / 'bench-results' / f'bench-{time.strftime("%Y%m%d-%H%M%S")}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2) + '\n')
+        self.stdout.write(f'Results saved to {output}')
+
+        if options['baseline']:
+            baseline = json.loads(Path(options['baseline']).read_text())
+            if baseline['options'] != report['options'] or baseline['database'] != report['database']:
+                self.stdout.write(self.style.WARNING('The baseline ran with other options or on another database.'))
+            self.compare(results, baseline, options['tolerance'])
+
+    def run_imports(self, user, seed, options):
+        """
+        The token refresh, then each playlist imported on its own and re-synced unchanged,
+        then the batch, all through the code the import worker runs.
+        """
+        _, token = measure('token refresh', lambda: get_access_token(user))
+        results = [token]
+
+        for index, size in enumerate(options['sizes']):
+            playlist_id = stub_playlist_id(seed, index, size)
+            for label in ('import', 're-sync unchanged'):
+                job = ImportJob.objects.create(user=user, spotify_playlist_id=playlist_id)
+                job, result = measure(f'{label} {size} tracks', lambda: run_import_job(job), tracks=size)
+                if job.state != ImportJob.SUCCEEDED:
+                    raise CommandError(f'Import of {playlist_id} failed: {job.error}')
+                if label == 'import':
+                    result['tracks_per_second'] = round(size / result['seconds'])
+                results.append(result)
+
+        if options['batch']:
+            first = len(options['sizes'])
+            playlist_ids = [stub_playlist_id(seed, first + i, options['batch_tracks']) for i in range(options['batch'])]
+            batch = queue_import_batch(user, playlist_ids)
+            tracks = options['batch'] * options['batch_tracks']
+            _, result = measure(
+                f'batch import {options["batch"]} playlists', lambda: run_import_batch(claim_batch_jobs(batch.id)),
+                tracks=tracks,
+            )
+            failed = batch.progress()[ImportJob.FAILED]
+            if failed:
+                raise CommandError(f'{failed} playlists of the batch import failed')
+            result['tracks_per_second'] = round(tracks / result['seconds'])
+            results.append(result)
+        return results
+
+    def run_pages(self, user, repeat):
+        """
+        Render the home page and the largest playlist, and load the import page's listing of
+        Spotify playlists: once cold (fragments and the listing not cached) and `repeat` times
+        warm, reporting the median.
+        """
+        client = Client()
+        client.force_login(user)
+        largest = Playlist.objects.filter(user=user).annotate(song_count=Count('songs')).order_by('-song_count').first()
+        playlist_ids = list(Playlist.objects.filter(user=user).values_list('id', flat=True))
+        pages = [
+            ('home', reverse('playlists:home'), {}, lambda: bump_playlist_versions(playlist_ids)),
+            ('playlist detail', reverse('playlists:playlist_detail', args=[largest.id]), {},
+             lambda: bump_playlist_versions([largest.id])),
+            # The dropdown's XHR, the only one of them that calls Spotify
+            ('import listing', reverse('playlists:import_spotify_playlist'),
+             {'X-Requested-With': 'XMLHttpRequest'}, lambda: forget_playlist_listing(user)),
+        ]
+
+        results = []
+        for name, url, headers, make_cold in pages:
+            # Unmeasured, so the first request's one-off costs (imports, connections) are left out
+            client.get(url, headers=headers)
+            make_cold()
+            results.append(self.render(client, f'{name} (cold)', url, headers))
+            warm = sorted((self.render(client, f'{name} (warm)', url, headers) for _ in range(repeat)),
+                          key=lambda result: result['seconds'])
+            results.append(warm[len(warm) // 2])
+        return results
+
+    def render(self, client, name, url, headers):
+        response, result = measure(name, lambda: client.get(url, headers=headers))
+        if response.status_code != 200:
+            raise CommandError(f'{url} answered {response.status_code}')
+        return result
+
+    def compare(self, results, baseline, tolerance):
+        """
+        Report every result slower than the baseline by more than the tolerance, or with more
+        queries or Spotify calls (which do not vary between runs), and fail if there are any.
+        """
+        previous = {result['name']: result for result in baseline['results']}
+        regressions = []
+        for result in results:
+            before = previous.get(result['name'])
+            if before is None:
+                continue
+            slowdown = result['seconds'] - before['seconds']
+            if slowdown > MIN_SLOWDOWN and result['seconds'] > before['seconds'] * (1 + tolerance):
+                regressions.append(f'{result["name"]}: {before["seconds"] * 1000:.1f} ms -> {result["seconds"] * 1000:.1f} ms')
+            for counter in ('queries', 'spotify_calls'):
+                if result[counter] > before[counter]:
+                    regressions.append(f'{result["name"]}: {before[counter]} -> {result[counter]} {counter}')
+
+        if regressions:
+            raise CommandError('Regressions against the baseline:\n  ' + '\n  '.join(regressions))
+        self.stdout.write(self.style.SUCCESS(f'No regressions against the baseline ({len(previous)} results).'))
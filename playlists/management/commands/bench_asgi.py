@@ -0,0 +1,217 @@
+# playlists/management/commands/bench_asgi.py
+
+import asyncio
+import importlib.util
+import multiprocessing
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.http import JsonResponse
+from django.urls import include, path, reverse
+from django.utils import timezone
+from playlists.models import SpotifyToken
+from playlists.playlist_cache import PLAYLISTS_PAGE_SIZE, get_playlists
+from playlists.spotify_stub import run_spotify_stub
+
+
+@login_required
+def sync_playlists(request):
+    """
+    The import dropdown's XHR as it was before the view became async: the listing is
+    fetched on the shared requests session, holding the worker thread until Spotify answers.
+    """
+    return JsonResponse({'spotify_playlists': get_playlists(request.user)})
+
+
+# URLs served by the benchmark servers: the project's, plus the sync version of the view
+urlpatterns = [
+    path('bench/sync_playlists/', sync_playlists, name='bench_sync_playlists'),
+    path('', include(settings.ROOT_URLCONF)),
+]
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    A WSGI server handling requests on a fixed pool of threads, like gunicorn's gthread
+    worker: at most `threads` requests are in progress and the others wait for a thread.
+    """
+    request_queue_size = 1024
+
+    def __init__(self, address, threads):
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        super().__init__(address, QuietWSGIRequestHandler)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve(server_type, port, stub_url, threads):
+    """
+    Run the project in one worker process with the benchmark's URLs and the Spotify stub.
+    """
+    settings.ROOT_URLCONF = __name__
+    settings.SPOTIFY_API_URL = stub_url
+    settings.ALLOWED_HOSTS = ['127.0.0.1']
+    settings.PERF_METRICS_SAMPLE_EVERY = 0
+    # As asgi.py does for the ASGI server
+    settings.SPOTIFY_ASYNC_CLIENT = server_type == 'asgi'
+    # The forked process must not share the parent's database connection
+    connections.close_all()
+    if server_type == 'wsgi':
+        from django.core.wsgi import get_wsgi_application
+
+        server = PooledWSGIServer(('127.0.0.1', port), threads)
+        server.set_app(get_wsgi_application())
+        server.serve_forever()
+    else:
+        import uvicorn
+        from django.core.asgi import get_asgi_application
+
+        uvicorn.run(get_asgi_application(), host='127.0.0.1', port=port, log_level='warning', backlog=2048)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = ('Load test the Spotify-bound import dropdown XHR: the sync view under a threaded WSGI '
+            'worker against the async view under a single ASGI (uvicorn) worker, both calling a '
+            'local Spotify stub with injected latency.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=400,
+                            help='Requests per server, each for a different user with nothing cached.')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200],
+                            help='Requests in flight at once.')
+        parser.add_argument('--threads', type=int, default=8, help='Threads of the WSGI worker.')
+        parser.add_argument('--latency', type=float, default=0.1, help='Seconds the stub waits per response.')
+        parser.add_argument('--playlists', type=int, default=120,
+                            help=f'Playlists per user; one Spotify call per {PLAYLISTS_PAGE_SIZE}.')
+
+    def handle(self, *args, **options):
+        # uvicorn is only imported by the ASGI server process, so check for it before starting
+        for module in ('httpx', 'uvicorn'):
+            if importlib.util.find_spec(module) is None:
+                raise CommandError(f'{module} is required for this benchmark: pip install httpx uvicorn')
+        import httpx
+
+        # In its own process, so its threads do not compete with the load client
+        stub_port = free_port()
+        stub = multiprocessing.Process(
+            target=run_spotify_stub, args=(stub_port, range(options['playlists'])), kwargs={'latency': options['latency']}
+        )
+        stub.start()
+        stub_url = f'http://127.0.0.1:{stub_port}/v1'
+
+        users = self.create_users(options['requests'])
+        try:
+            for concurrency in options['concurrency']:
+                for server_type, url_name in (('wsgi', 'bench_sync_playlists'), ('asgi', 'playlists:import_spotify_playlist')):
+                    self.run(httpx, server_type, url_name, stub_url, users, concurrency, options)
+        finally:
+            stub.terminate()
+            stub.join()
+            User.objects.filter(id__in=[user.id for user, _ in users]).delete()
+
+    def create_users(self, count):
+        """
+        Throwaway users with a connected Spotify account and a logged-in session each.
+        """
+        prefix = f'bench-asgi-{int(time.time())}'
+        users = []
+        for i in range(count):
+            user = User.objects.create(username=f'{prefix}-{i}')
+            SpotifyToken.objects.create(
+                user=user, access_token='bench', refresh_token='bench', token_type='Bearer', expires_in=3600,
+                expires_at=timezone.now() + timedelta(hours=1), scope='',
+            )
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            users.append((user, session.session_key))
+        return users
+
+    def run(self, httpx, server_type, url_name, stub_url, users, concurrency, options):
+        port = free_port()
+        connections.close_all()
+        process = multiprocessing.Process(target=serve, args=(server_type, port, stub_url, options['threads']))
+        process.start()
+        try:
+            base_url = f'http://127.0.0.1:{port}'
+            settings.ROOT_URLCONF, urlconf = __name__, settings.ROOT_URLCONF
+            try:
+                url = base_url + reverse(url_name, urlconf=__name__)
+            finally:
+                settings.ROOT_URLCONF = urlconf
+            latencies, errors, elapsed = asyncio.run(self.load(httpx, url, users, concurrency, options['playlists']))
+        finally:
+            process.terminate()
+            process.join()
+
+        latencies.sort()
+        label = f'{server_type} ({options["threads"]} threads)' if server_type == 'wsgi' else f'{server_type} (1 loop)'
+        self.stdout.write(
+            f'{label:<18} concurrency {concurrency:>4}  {len(latencies) / elapsed:>7.1f} req/sec  '
+            f'p50 {latencies[len(latencies) // 2] * 1000:>7.0f} ms  '
+            f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:>7.0f} ms  {errors} errors'
+        )
+
+    async def load(self, httpx, url, users, concurrency, playlists):
+        """
+        Send one request per user, `concurrency` at a time, once the server is up.
+        Responses without all of the stub's playlists count as errors.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(timeout=120, limits=limits, headers=headers) as client:
+            for _ in range(100):
+                try:
+                    await client.get(url)
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+
+            semaphore = asyncio.Semaphore(concurrency)
+            latencies = []
+            errors = 0
+
+            async def request(session_key):
+                nonlocal errors
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.get(url, cookies={settings.SESSION_COOKIE_NAME: session_key})
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200 or len(response.json()['spotify_playlists']) != playlists:
+                        errors += 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(request(session_key) for _, session_key in users))
+            return latencies, errors, time.perf_counter() - start
@@ -0,0 +1,122 @@
+# playlists/management/commands/bench_db_concurrency.py
+
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from playlists.import_utils import ingest_tracks
+from playlists.models import Playlist
+from .bench_ingest import fake_tracks
+
+# Set in each pool process; tells the readers that every importer has finished
+importers_done = None
+
+
+def init_process(done):
+    """
+    Set up Django in each pool process, like the separate web and worker processes of a deployment.
+    """
+    global importers_done
+    importers_done = done
+    django.setup()
+
+
+def run_importer(user_id, index, size, rounds):
+    """
+    Import a playlist of `size` tracks `rounds` times, renaming every track each round.
+    Returns the number of imports that failed because the database was locked.
+    """
+    errors = 0
+    try:
+        playlist = Playlist.objects.create(title=f'Bench importer {index}', user_id=user_id)
+        tracks = fake_tracks(size, uuid.uuid4().hex[:12])
+        for round_number in range(rounds):
+            renamed = [{**t, 'name': f'{t["name"]} v{round_number}'} for t in tracks]
+            try:
+                ingest_tracks(playlist, renamed, remove_missing=True)
+            except OperationalError:
+                # "database is locked": the import is lost, as it would be in production
+                errors += 1
+    except OperationalError:
+        errors += rounds
+    finally:
+        connections.close_all()
+    return errors
+
+
+def run_reader(user_id):
+    """
+    Load the first page of a playlist's songs, as playlist_detail does, until the importers finish.
+    Returns the number of successful and failed reads.
+    """
+    reads = errors = 0
+    try:
+        while not importers_done.is_set():
+            try:
+                playlist = Playlist.objects.filter(user_id=user_id).order_by('?').first()
+                if playlist:
+                    list(playlist.songs.order_by('-added_at', '-id')[:24])
+                reads += 1
+            except OperationalError:
+                errors += 1
+    finally:
+        connections.close_all()
+    return reads, errors
+
+
+class Command(BaseCommand):
+    help = ('Run N importer processes in parallel, alongside reader processes loading playlist pages, '
+            'against the configured database and report throughput and lock errors.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--importers', type=int, nargs='+', default=[1, 4, 8],
+                            help='Numbers of parallel importers to benchmark.')
+        parser.add_argument('--tracks', type=int, default=500, help='Tracks per playlist.')
+        parser.add_argument('--rounds', type=int, default=5,
+                            help='Imports per importer; every round after the first renames all tracks.')
+        parser.add_argument('--readers', type=int, default=4,
+                            help='Processes reading playlist pages while the importers run.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{connection.vendor} {connection.settings_dict["NAME"]}')
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                journal_mode = cursor.fetchone()[0]
+                cursor.execute('PRAGMA synchronous')
+                self.stdout.write(f'journal_mode={journal_mode} synchronous={cursor.fetchone()[0]}')
+
+        # Use a throwaway user so all benchmark rows are removed by the cascade at the end
+        user = User.objects.create(username=f'bench-{uuid.uuid4().hex[:12]}')
+        try:
+            for importers in options['importers']:
+                self.run(user.id, importers, options['tracks'], options['rounds'], options['readers'])
+        finally:
+            user.delete()
+
+    def run(self, user_id, importers, size, rounds, readers):
+        done = multiprocessing.Event()
+        # Forked processes must not share this process's database connection
+        connections.close_all()
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=importers + readers, initializer=init_process, initargs=(done,)) as pool:
+            reader_futures = [pool.submit(run_reader, user_id) for _ in range(readers)]
+            importer_futures = [pool.submit(run_importer, user_id, i, size, rounds) for i in range(importers)]
+            errors = sum(future.result() for future in importer_futures)
+            elapsed = time.perf_counter() - start
+            done.set()
+            results = [future.result() for future in reader_futures]
+        reads = sum(r for r, _ in results)
+        read_errors = sum(e for _, e in results)
+
+        imports = importers * rounds
+        self.stdout.write(
+            f'{importers:>3} importers  {elapsed:8.3f}s  {imports / elapsed:>6.1f} imports/sec  '
+            f'{(imports - errors) * size / elapsed:>8,.0f} rows/sec  {errors} imports failed  |  '
+            f'{readers} readers  {reads / elapsed:>8,.0f} reads/sec  {read_errors} reads failed'
+        )
@@ -0,0 +1,79 @@
+# playlists/management/commands/bench_ingest.py
+
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from playlists.import_utils import ingest_tracks
+from playlists.models import Playlist, Song, Track
+
+
+def fake_tracks(count, prefix):
+    """
+    Build Spotify-like track objects with ids that are unique to this run.
+    Every ten tracks share an album and every fifty an artist.
+    """
+    return [{
+        'id': f'{prefix}{i:06d}',
+        'name': f'Track {i}',
+        'artists': [{'id': f'{prefix}a{i // 50:05d}', 'name': f'Artist {i // 50}'}],
+        'album': {'id': f'{prefix}b{i // 10:05d}', 'name': f'Album {i // 10}'},
+    } for i in range(count)]
+
+
+def legacy_ingest(playlist, tracks):
+    """
+    The original per-track import loop, kept here as the baseline to compare against.
+    """
+    for track in tracks:
+        catalog_track, _ = Track.objects.update_or_create(
+            spotify_track_id=track['id'], defaults={'title': track['name']}
+        )
+        Song.objects.get_or_create(track=catalog_track, playlist=playlist)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark track ingest throughput (rows/sec) against the configured database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                            help='Playlist sizes to benchmark.')
+        parser.add_argument('--legacy', action='store_true',
+                            help='Also time the per-track update_or_create loop.')
+
+    def handle(self, *args, **options):
+        # Use a throwaway user so all benchmark rows are removed by the cascade at the end
+        user = User.objects.create(username=f'bench-{uuid.uuid4().hex[:12]}')
+        try:
+            for size in options['sizes']:
+                self.run_size(user, size, options['legacy'])
+        finally:
+            user.delete()
+
+    def run_size(self, user, size, legacy):
+        prefix = uuid.uuid4().hex[:12]
+        tracks = fake_tracks(size, prefix)
+        playlist = Playlist.objects.create(title=f'Bench {size}', user=user)
+
+        # First import inserts every row, the second finds them all unchanged
+        self.report(size, 'bulk insert', lambda: ingest_tracks(playlist, tracks))
+        self.report(size, 'bulk no-op', lambda: ingest_tracks(playlist, tracks))
+        renamed = [{**t, 'name': t['name'] + ' (Remastered)'} for t in tracks]
+        self.report(size, 'bulk update', lambda: ingest_tracks(playlist, renamed))
+        # Another playlist with the same tracks only adds songs; the catalog already has the metadata
+        other = Playlist.objects.create(title=f'Bench {size} copy', user=user)
+        self.report(size, 'bulk shared', lambda: ingest_tracks(other, renamed))
+
+        if legacy:
+            legacy_tracks = fake_tracks(size, uuid.uuid4().hex[:12])
+            self.report(size, 'legacy insert', lambda: legacy_ingest(playlist, legacy_tracks))
+            self.report(size, 'legacy update', lambda: legacy_ingest(playlist, legacy_tracks))
+
+    def report(self, size, label, func):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        rate = size / elapsed if elapsed else float('inf')
+        suffix = f' {result}' if result else ''
+        self.stdout.write(f'{size:>6} tracks  {label:<14} {elapsed:8.3f}s  {rate:>10,.0f} rows/sec{suffix}')
@@ -0,0 +1,71 @@
+# playlists/management/commands/bench_media.py
+
+import hashlib
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.views.static import serve
+from playlists.media import serve_media
+
+
+def consume(response):
+    """
+    Read the whole body the way a WSGI server would and return its size.
+    """
+    size = sum(len(chunk) for chunk in response)
+    response.close()
+    return size
+
+
+class Command(BaseCommand):
+    help = 'Compare serve_media with django.views.static.serve for full, conditional and range requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Requests per scenario.')
+        parser.add_argument('--size', type=int, default=2_000_000, help='Size in bytes of the test file.')
+
+    def handle(self, *args, **options):
+        # A content-addressed name, so serve_media sends the immutable caching headers
+        data = os.urandom(options['size'])
+        digest = hashlib.sha256(data).hexdigest()
+        path = f'bench/{digest[:2]}/{digest}.jpg'
+        fullpath = os.path.join(settings.MEDIA_ROOT, path)
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        with open(fullpath, 'wb') as f:
+            f.write(data)
+
+        try:
+            factory = RequestFactory()
+            first = serve_media(factory.get('/media/' + path), path)
+            consume(first)
+            etag, last_modified = first.headers['ETag'], first.headers['Last-Modified']
+
+            scenarios = [
+                ('full GET', {}),
+                ('revalidation', {'HTTP_IF_NONE_MATCH': etag, 'HTTP_IF_MODIFIED_SINCE': last_modified}),
+                ('range 64 KiB', {'HTTP_RANGE': 'bytes=0-65535'}),
+            ]
+            views = [
+                ('static.serve', lambda request: serve(request, path, document_root=settings.MEDIA_ROOT)),
+                ('serve_media', lambda request: serve_media(request, path)),
+            ]
+            for label, headers in scenarios:
+                for name, view in views:
+                    self.run(label, name, view, factory.get('/media/' + path, **headers), options['requests'])
+        finally:
+            os.remove(fullpath)
+
+    def run(self, label, name, view, request, count):
+        sent = 0
+        start = time.perf_counter()
+        for _ in range(count):
+            response = view(request)
+            sent += consume(response)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'{label:<13} {name:<13} {count / elapsed:>9,.0f} req/sec  '
+            f'{sent / count / 1024:>9,.1f} KiB/response  status {response.status_code}'
+        )
@@ -0,0 +1,57 @@
+# playlists/management/commands/bench_spotify_http.py
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import spotipy
+from django.core.management.base import BaseCommand
+from playlists.spotify_http import build_session, session_metrics
+from playlists.spotify_stub import SpotifyStubServer, stub_playlist_id
+
+STUB_SEED = 'stub'
+
+
+class Command(BaseCommand):
+    help = 'Compare a new HTTP session per Spotify client with the shared pooled session.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a Spotify stub server; a local one is started by default.')
+        parser.add_argument('--clients', type=int, default=200, help='Spotify clients created, one per simulated view.')
+        parser.add_argument('--calls', type=int, default=3, help='API calls made by each client.')
+        parser.add_argument('--threads', type=int, default=8, help='Clients running at the same time.')
+        parser.add_argument('--latency', type=float, default=0.002, help='Seconds the local stub waits per response.')
+
+    def handle(self, *args, **options):
+        server = None
+        url = options['url']
+        if not url:
+            # Empty playlists, one per call a client makes, so every response is small
+            server = SpotifyStubServer(('127.0.0.1', 0), [0] * options['calls'], seed=STUB_SEED, latency=options['latency'])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f'http://127.0.0.1:{server.server_port}/v1/'
+
+        try:
+            # What get_spotify_client did before: Spotipy builds a fresh session for every client
+            self.run('session per client', url, lambda: True, options)
+            shared = build_session(pool_size=options['threads'])
+            self.run('shared pool', url, lambda: shared, options)
+            self.stdout.write(json.dumps(session_metrics(shared), indent=2))
+        finally:
+            if server:
+                server.shutdown()
+
+    def run(self, label, url, session_factory, options):
+        def view(i):
+            client = spotipy.Spotify(auth='bench', requests_session=session_factory())
+            client.prefix = url
+            for call in range(options['calls']):
+                client.playlist(stub_playlist_id(STUB_SEED, call, 0))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            list(pool.map(view, range(options['clients'])))
+        elapsed = time.perf_counter() - start
+        total = options['clients'] * options['calls']
+        self.stdout.write(f'{label:<20} {total / elapsed:>9,.0f} calls/sec  {elapsed / total * 1000:>7.2f} ms/call')
@@ -0,0 +1,26 @@
+# playlists/management/commands/check_query_plans.py
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from playlists.query_plans import full_scans, hot_queries
+
+
+class Command(BaseCommand):
+    help = ('EXPLAIN the queries behind the main views, imports and workers on the configured database, '
+            'and fail if any of them scans a whole table. The test suite runs the same checks.')
+
+    def handle(self, *args, **options):
+        queries = hot_queries()
+        scanning = []
+        for label, queryset in queries:
+            plan = queryset.explain()
+            scanned = full_scans(plan)
+            status = f'FULL SCAN of {", ".join(scanned)}' if scanned else 'ok'
+            self.stdout.write(f'{label}: {status}')
+            self.stdout.write('    ' + plan.replace('\n', '\n    '))
+            if scanned:
+                scanning.append(label)
+
+        if scanning:
+            raise CommandError(f'{len(scanning)} queries scan a whole table on {connection.vendor}: {", ".join(scanning)}')
+        self.stdout.write(self.style.SUCCESS(f'All {len(queries)} queries use an index.'))
@@ -0,0 +1,40 @@
+# playlists/management/commands/dedupe_photos.py
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from playlists.fragment_cache import bump_playlist_versions
+from playlists.image_utils import delete_renditions, existing_renditions, generate_renditions
+from playlists.models import SONG_HAS_PHOTO, Song
+from playlists.storage import is_hashed_name, photo_storage
+
+
+class Command(BaseCommand):
+    help = 'Move song photos stored under their upload filename into content-addressed storage.'
+
+    def handle(self, *args, **options):
+        names = (
+            Song.objects.filter(SONG_HAS_PHOTO)
+            .values_list('photo', flat=True).distinct()
+        )
+        moved = 0
+        stored = set()
+        for old_name in [name for name in names if not is_hashed_name(name)]:
+            if not default_storage.exists(old_name):
+                self.stderr.write(f'Skipped missing file {old_name}')
+                continue
+            old_widths = Song.objects.filter(photo=old_name).values_list('photo_renditions', flat=True).first()
+            with default_storage.open(old_name, 'rb') as f:
+                name = photo_storage.save(old_name, f)
+            widths, formats = existing_renditions(name) or generate_renditions(name)
+            playlist_ids = list(Song.objects.filter(photo=old_name).values_list('playlist_id', flat=True))
+            Song.objects.filter(photo=old_name).update(
+                photo=name, photo_renditions=widths, photo_rendition_formats=formats
+            )
+            bump_playlist_versions(playlist_ids)
+
+            stored.add(name)
+            default_storage.delete(old_name)
+            delete_renditions(old_name, old_widths or [])
+            moved += 1
+            self.stdout.write(f'{old_name} -> {name}')
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} photo(s) into {len(stored)} unique file(s).'))
@@ -0,0 +1,75 @@
+# playlists/management/commands/run_import_worker.py
+
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from playlists.import_utils import (
+    claim_batch_jobs, claim_next_job, requeue_stale_jobs, run_import_batch, run_import_job,
+)
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of workers that process queued Spotify playlist imports.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of imports to run concurrently.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait before checking an empty queue again.')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Requeue running jobs with no progress for this many seconds.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty instead of polling forever.')
+
+    def handle(self, *args, **options):
+        requeued = requeue_stale_jobs(options['stale_after'])
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale import job(s).')
+
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self.work, args=(stop, options), name=f'import-worker-{i}', daemon=True)
+            for i in range(options['workers'])
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f'Started {len(threads)} import worker(s).')
+
+        try:
+            for thread in threads:
+                # Join with a timeout so Ctrl+C is still delivered to the main thread
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping after the current imports finish...')
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def work(self, stop, options):
+        """
+        Claim and run jobs until asked to stop (or the queue is empty with --once).
+        """
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                job = claim_next_job()
+                if job is None:
+                    if options['once']:
+                        break
+                    stop.wait(options['poll_interval'])
+                    continue
+                if job.batch_id:
+                    # The rest of the batch runs with it, as one operation
+                    jobs = [job, *claim_batch_jobs(job.batch_id)]
+                    self.stdout.write(f'Running import batch {job.batch_id}: {len(jobs)} playlists')
+                    run_import_batch(jobs)
+                    self.stdout.write(f'Import batch {job.batch_id} done')
+                else:
+                    self.stdout.write(f'Running import job {job.id} for playlist {job.spotify_playlist_id}')
+                    run_import_job(job)
+                    self.stdout.write(f'Import job {job.id} {job.state}')
+        finally:
+            # Each thread has its own database connection
+            connection.close()
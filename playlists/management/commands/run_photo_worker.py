@@ -0,0 +1,91 @@
+# playlists/management/commands/run_photo_worker.py
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from playlists.image_utils import (
+    COMPLETE_READY, COMPLETE_REQUEUED, claim_pending_photos, complete_staged_photo, fail_staged_photo,
+    process_staged_photo, refresh_photo_claims, requeue_stale_photos
+)
+
+
+def init_process():
+    """
+    Set up Django in each pool process; needed where processes are spawned rather than forked.
+    """
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = 'Run a process pool that validates, resizes and places uploaded song photos.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of photos to process in parallel (defaults to the CPU count).')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait before checking for new uploads again.')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Requeue uploads whose worker has not refreshed its claim for this many seconds.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no uploads are waiting instead of polling forever.')
+
+    def handle(self, *args, **options):
+        # Uploads being processed when a previous worker stopped are picked up again; those of
+        # workers still running keep being refreshed, well within stale_after
+        requeued = requeue_stale_photos(options['stale_after'])
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} interrupted upload(s).')
+        refresh_every = options['stale_after'] / 3
+        refreshed = time.monotonic()
+
+        processes = options['processes']
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_process) as pool:
+            self.stdout.write(f'Started photo worker with {processes} process(es).')
+            while True:
+                close_old_connections()
+                # Keep a few uploads queued per process so none sits idle between polls
+                for song in claim_pending_photos(processes * 2 - len(in_flight)):
+                    future = pool.submit(process_staged_photo, song.photo_staging)
+                    in_flight[future] = (song.id, song.photo_staging)
+
+                if in_flight and time.monotonic() - refreshed > refresh_every:
+                    refresh_photo_claims([song_id for song_id, _ in in_flight.values()])
+                    refreshed = time.monotonic()
+
+                if not in_flight:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                done, _ = wait(in_flight, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    song_id, staging_name = in_flight.pop(future)
+                    try:
+                        self.finish(future, song_id, staging_name)
+                    except Exception as e:
+                        # Reported rather than raised, so one song's database error cannot stop the worker
+                        self.stderr.write(f'Could not record the photo of song {song_id}: {e}')
+
+    def finish(self, future, song_id, staging_name):
+        """
+        Record the outcome of one processed upload in the database.
+        """
+        try:
+            name, widths, formats, placeholder = future.result()
+        except Exception as e:
+            fail_staged_photo(song_id, staging_name)
+            self.stderr.write(f'Rejected upload for song {song_id}: {e}')
+            return
+        outcome = complete_staged_photo(song_id, staging_name, name, widths, formats, placeholder)
+        if outcome == COMPLETE_READY:
+            self.stdout.write(f'Song {song_id} photo ready: {name} {widths}')
+        elif outcome == COMPLETE_REQUEUED:
+            self.stdout.write(f'Song {song_id} photo {name} was released while processing; requeued')
+        else:
+            self.stdout.write(f'Song {song_id} was deleted or its photo replaced while processing; discarded {name}')
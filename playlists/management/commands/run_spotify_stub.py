@@ -0,0 +1,35 @@
+# playlists/management/commands/run_spotify_stub.py
+
+from django.core.management.base import BaseCommand
+from playlists.spotify_stub import SpotifyStubServer
+
+
+class Command(BaseCommand):
+    help = ('Serve a local stand-in for the Spotify Web API, for working offline. Point '
+            'SPOTIFY_API_URL and SPOTIFY_ACCOUNTS_URL at it; any connected account then sees '
+            'the stub\'s generated playlists.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                            help='Tracks in each of the playlists listed by /me/playlists.')
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds to wait before each response.')
+        parser.add_argument('--throttle-every', type=int, default=0,
+                            help='Answer every nth API call with a 429 (0 never).')
+        parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of the 429 responses, in seconds.')
+        parser.add_argument('--page-size', type=int, default=None,
+                            help='Most items per page, below what the client asks for.')
+
+    def handle(self, *args, **options):
+        server = SpotifyStubServer(
+            ('127.0.0.1', options['port']), options['sizes'], latency=options['latency'],
+            throttle_every=options['throttle_every'], retry_after=options['retry_after'],
+            page_size=options['page_size'],
+        )
+        url = f'http://127.0.0.1:{options["port"]}'
+        self.stdout.write(f'Spotify stub listening: SPOTIFY_API_URL={url}/v1 SPOTIFY_ACCOUNTS_URL={url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(f'Served {server.requests} API calls, {server.throttled} of them throttled, '
+                              f'and issued {server.tokens_issued} tokens.')
@@ -0,0 +1,116 @@
+# playlists/management/commands/sync_playlists.py
+
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.utils import timezone
+from playlists.spotify_http import set_rate_budget, spotify_http_metrics
+from playlists.sync_scheduler import (
+    FAILED, SpotifyClients, claim_due_playlists, record_sync_cycle, release_sync_leases, sync_node_name, sync_playlist,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Keep imported playlists in sync with Spotify: repeatedly lease the playlists due for a sync, '
+            'recently viewed and longest overdue first, and sync them with a pool of workers. '
+            'Several processes, also on different hosts, can run at once.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of playlists synced concurrently.')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Most playlists leased per cycle.')
+        parser.add_argument('--poll-interval', type=float, default=30.0,
+                            help='Seconds to wait before checking again when no playlist is due.')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='Spotify calls a second for this process, shared by its workers '
+                                 '(default SPOTIFY_RATE_LIMIT). Give each process its share of the app limit.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no playlist is due instead of polling forever.')
+
+    def handle(self, *args, **options):
+        if options['rate'] is not None:
+            set_rate_budget(options['rate'], settings.SPOTIFY_RATE_BURST)
+        owner = sync_node_name()
+        stop = threading.Event()
+        tasks = queue.Queue()
+        results = queue.Queue()
+        threads = [
+            threading.Thread(target=self.work, args=(stop, tasks, results, owner), name=f'sync-worker-{i}', daemon=True)
+            for i in range(options['workers'])
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f'Started {len(threads)} sync worker(s) as {owner}.')
+
+        try:
+            while True:
+                if not self.run_cycle(tasks, results, owner, options['batch_size']):
+                    if options['once']:
+                        break
+                    stop.wait(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping after the current syncs finish...')
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            release_sync_leases(owner)
+
+    def run_cycle(self, tasks, results, owner, batch_size):
+        """
+        Lease the due playlists, sync them on the workers and record the cycle's stats.
+        Returns the number of playlists synced.
+        """
+        started_at = timezone.now()
+        spotify_before = spotify_http_metrics()
+        playlists = claim_due_playlists(owner, batch_size)
+        if not playlists:
+            return 0
+
+        self.clients = SpotifyClients()
+        for playlist in playlists:
+            tasks.put(playlist)
+        tasks.join()
+        outcomes = [results.get() for _ in playlists]
+
+        cycle = record_sync_cycle(owner, started_at, playlists, outcomes, spotify_before, spotify_http_metrics())
+        summary = (
+            f'Synced {cycle.playlists} playlists in {cycle.seconds:.1f}s ({cycle.playlists_per_second:.1f}/s): '
+            f'{cycle.changed} changed, {cycle.unchanged} unchanged, {cycle.failed} failed; '
+            f'{cycle.spotify_calls} Spotify calls, {cycle.throttled_seconds:.1f}s throttled; '
+            f'lag avg {cycle.lag_avg_seconds:.0f}s, max {cycle.lag_max_seconds:.0f}s; {cycle.backlog} still due'
+        )
+        logger.info(summary)
+        self.stdout.write(summary)
+        return cycle.playlists
+
+    def work(self, stop, tasks, results, owner):
+        """
+        Sync the playlists put on tasks until asked to stop, putting each outcome on results.
+        """
+        try:
+            while not stop.is_set():
+                try:
+                    playlist = tasks.get(timeout=1)
+                except queue.Empty:
+                    continue
+                outcome = (FAILED, 0)
+                try:
+                    close_old_connections()
+                    outcome = sync_playlist(playlist, self.clients, owner)
+                except Exception:
+                    # e.g. the database went away; the lease runs out and another cycle retries it
+                    logger.exception(f'Sync of playlist {playlist.id} failed')
+                finally:
+                    results.put(outcome)
+                    tasks.task_done()
+        finally:
+            # Each thread has its own database connection
+            connection.close()
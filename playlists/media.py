@@ -0,0 +1,140 @@
+# playlists/media.py
+
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+from .image_utils import STAGING_DIR
+from .storage import is_hashed_name
+
+# Hashed names never change content, so browsers and proxies may keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Other files are revalidated with a conditional request after an hour
+DEFAULT_CACHE_CONTROL = 'public, max-age=3600'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range Range header into an inclusive (start, end) pair.
+    Returns None when the header should be ignored (missing, malformed or multiple ranges,
+    in which case the whole file is sent) and raises ValueError when it cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def read_range(path, start, length):
+    """
+    Yield `length` bytes of the file at path starting at `start`, in chunks.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serve an uploaded file from MEDIA_ROOT with caching headers.
+    Supports conditional GET (ETag/Last-Modified), single byte ranges, and hands the transfer
+    to the front proxy with X-Accel-Redirect or X-Sendfile when MEDIA_OFFLOAD is configured.
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    # Staged uploads have not been validated yet and are never served
+    if path.startswith(STAGING_DIR + '/'):
+        raise Http404('File not found.')
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('File not found.')
+    try:
+        stat = os.stat(fullpath)
+    except OSError:
+        raise Http404('File not found.')
+    if not os.path.isfile(fullpath):
+        raise Http404('File not found.')
+
+    immutable = is_hashed_name(path)
+    # Hashed names identify the content itself; other files change with their size and mtime
+    if immutable:
+        etag = '"%s"' % os.path.basename(path)
+    else:
+        etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+    last_modified = http_date(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=stat.st_mtime)
+    if response is None:
+        response = build_media_response(request, path, fullpath, stat.st_size, etag)
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = last_modified
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if immutable else DEFAULT_CACHE_CONTROL
+    return response
+
+
+def build_media_response(request, path, fullpath, size, etag):
+    """
+    The 200/206/416 response for a file that passed the conditional-request checks.
+    """
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or 'application/octet-stream'
+
+    offload = getattr(settings, 'MEDIA_OFFLOAD', '')
+    if offload:
+        # The proxy reads the file (and handles ranges) itself; Django only sets the headers
+        response = HttpResponse(content_type=content_type)
+        if offload == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(path)
+        else:
+            response.headers['X-Sendfile'] = fullpath
+    else:
+        # A Range is only honoured if If-Range (when sent) still matches the current file
+        if_range = request.headers.get('If-Range')
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size) if if_range in (None, etag) else None
+        except ValueError:
+            response = HttpResponse(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(read_range(fullpath, start, length), status=206, content_type=content_type)
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response.headers['Content-Length'] = str(length)
+        else:
+            # FileResponse lets the WSGI server use sendfile() via wsgi.file_wrapper
+            response = FileResponse(open(fullpath, 'rb'), content_type=content_type)
+        response.headers['Accept-Ranges'] = 'bytes'
+
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
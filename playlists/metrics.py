@@ -0,0 +1,253 @@
+# playlists/metrics.py
+
+import contextvars
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+# Quantiles reported for every view metric
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Metrics recorded for each sampled request, as (name, Prometheus help text)
+VIEW_METRICS = (
+    ('duration_seconds', 'Wall time spent in the view and middleware.'),
+    ('db_queries', 'Database queries per request.'),
+    ('db_duration_seconds', 'Time spent in database queries per request.'),
+    ('spotify_calls', 'Spotify API calls per request.'),
+    ('spotify_duration_seconds', 'Time spent in Spotify API calls per request.'),
+    ('response_bytes', 'Size of the response body; streamed responses without a length are not counted.'),
+)
+
+
+class RequestStats:
+    """
+    Database and Spotify activity of the request being handled.
+    """
+    __slots__ = ('db_queries', 'db_time', 'spotify_calls', 'spotify_time', 'lock')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.spotify_calls = 0
+        self.spotify_time = 0.0
+        # Queries and Spotify calls may come from several threads working for the request
+        self.lock = threading.Lock()
+
+
+# Stats of the current request, set by PerformanceMiddleware for sampled requests only
+request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+def record_spotify_call(seconds):
+    """
+    Count a Spotify API call against the current request, if it is being sampled.
+    """
+    stats = request_stats.get()
+    if stats is not None:
+        with stats.lock:
+            stats.spotify_calls += 1
+            stats.spotify_time += seconds
+
+
+def count_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper counting each query against the current request, if it is being
+    sampled. Installed on every connection (see install_query_counter) rather than per request,
+    so queries made from sync_to_async and pool threads are counted too: they run on other
+    threads' connections but in a copy of the request's context.
+    """
+    stats = request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        with stats.lock:
+            stats.db_queries += 1
+            stats.db_time += elapsed
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """
+    Add count_query to each new database connection (connection_created).
+    """
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class RollingHistogram:
+    """
+    The most recent observations of a value, for quantiles over a sliding window,
+    plus the running count and sum of every observation.
+    """
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self):
+        ordered = sorted(self.samples)
+        return [(q, ordered[min(int(q * len(ordered)), len(ordered) - 1)]) for q in QUANTILES]
+
+
+class ViewMetrics:
+    """
+    Rolling histograms of each VIEW_METRICS value per view, for this process.
+    Every worker process keeps its own; Prometheus scrapes and aggregates them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, view, values):
+        with self.lock:
+            for name, value in values.items():
+                histogram = self.histograms.get((name, view))
+                if histogram is None:
+                    histogram = self.histograms[(name, view)] = RollingHistogram(settings.PERF_METRICS_WINDOW)
+                histogram.observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        """
+        The histograms in the Prometheus text format, as summaries with quantiles.
+        """
+        lines = []
+        with self.lock:
+            for name, help_text in VIEW_METRICS:
+                metric = f'painted_view_{name}'
+                lines.append(f'# HELP {metric} {help_text}')
+                lines.append(f'# TYPE {metric} summary')
+                for (histogram_name, view), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    label = f'view="{escape_label(view)}"'
+                    for q, value in histogram.quantiles():
+                        lines.append(f'{metric}{{{label},quantile="{q}"}} {value:g}')
+                    lines.append(f'{metric}_sum{{{label}}} {histogram.sum:g}')
+                    lines.append(f'{metric}_count{{{label}}} {histogram.count}')
+        return lines
+
+
+view_metrics = ViewMetrics()
+
+
+class FragmentCacheStats:
+    """
+    Hits and misses of the rendered-fragment cache per kind of fragment, for this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, kind, hits, misses):
+        with self.lock:
+            counts = self.counts.setdefault(kind, [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+    def render(self):
+        """
+        The counters and hit ratios in the Prometheus text format.
+        """
+        with self.lock:
+            counts = sorted((kind, hits, misses) for kind, (hits, misses) in self.counts.items())
+        lines = [
+            '# HELP painted_fragment_cache_requests_total Rendered fragments looked up in the cache.',
+            '# TYPE painted_fragment_cache_requests_total counter',
+        ]
+        for kind, hits, misses in counts:
+            label = f'fragment="{escape_label(kind)}"'
+            lines.append(f'painted_fragment_cache_requests_total{{{label},result="hit"}} {hits}')
+            lines.append(f'painted_fragment_cache_requests_total{{{label},result="miss"}} {misses}')
+        lines.append('# HELP painted_fragment_cache_hit_ratio Share of fragment lookups served from the cache.')
+        lines.append('# TYPE painted_fragment_cache_hit_ratio gauge')
+        for kind, hits, misses in counts:
+            if hits + misses:
+                lines.append(f'painted_fragment_cache_hit_ratio{{fragment="{escape_label(kind)}"}} '
+                             f'{hits / (hits + misses):g}')
+        return lines
+
+
+fragment_cache_stats = FragmentCacheStats()
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_spotify_metrics(stats):
+    """
+    Spotify HTTP session metrics (see spotify_http.session_metrics) in the Prometheus text format.
+    """
+    lines = [
+        '# HELP painted_spotify_pool_requests_total Requests sent through the Spotify connection pool.',
+        '# TYPE painted_spotify_pool_requests_total counter',
+        f'painted_spotify_pool_requests_total {stats["pool"]["requests"]}',
+        '# HELP painted_spotify_pool_connections_total Connections opened by the Spotify connection pool.',
+        '# TYPE painted_spotify_pool_connections_total counter',
+        f'painted_spotify_pool_connections_total {stats["pool"]["connections"]}',
+        '# HELP painted_spotify_budget_throttled_total Spotify API calls delayed by the rate budget.',
+        '# TYPE painted_spotify_budget_throttled_total counter',
+        f'painted_spotify_budget_throttled_total {stats["budget"]["throttled"]}',
+        '# HELP painted_spotify_budget_wait_seconds_total Time Spotify API calls waited for the rate budget.',
+        '# TYPE painted_spotify_budget_wait_seconds_total counter',
+        f'painted_spotify_budget_wait_seconds_total {stats["budget"]["wait_seconds"]:g}',
+    ]
+    series = (
+        ('requests_total', 'Spotify API calls per endpoint.', 'count', 1),
+        ('errors_total', 'Failed Spotify API calls per endpoint.', 'errors', 1),
+        ('duration_seconds_total', 'Time spent in Spotify API calls per endpoint.', 'total_ms', 1000),
+    )
+    for name, help_text, key, divisor in series:
+        metric = f'painted_spotify_http_{name}'
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for endpoint, endpoint_stats in sorted(stats['endpoints'].items()):
+            lines.append(f'{metric}{{endpoint="{escape_label(endpoint)}"}} {endpoint_stats[key] / divisor:g}')
+    return lines
+
+
+def render_sync_metrics(cycles):
+    """
+    The last cycle of each sync_playlists scheduler process (see sync_scheduler.latest_sync_cycles)
+    in the Prometheus text format, one gauge per stat labelled with the process.
+    """
+    series = (
+        ('last_cycle_timestamp_seconds', 'When the last sync cycle finished.', lambda c: c.finished_at.timestamp()),
+        ('cycle_seconds', 'Duration of the last sync cycle.', lambda c: c.seconds),
+        ('cycle_playlists', 'Playlists synced in the last cycle.', lambda c: c.playlists),
+        ('cycle_failed', 'Playlists whose sync failed in the last cycle.', lambda c: c.failed),
+        ('cycle_throughput', 'Playlists synced per second in the last cycle.', lambda c: c.playlists_per_second),
+        ('cycle_throttled_seconds', 'Time the last cycle waited for the Spotify rate budget.', lambda c: c.throttled_seconds),
+        ('lag_avg_seconds', 'Average time playlists had been due when the last cycle synced them.', lambda c: c.lag_avg_seconds),
+        ('lag_max_seconds', 'Longest time a playlist had been due when the last cycle synced it.', lambda c: c.lag_max_seconds),
+        ('backlog', 'Playlists still due for a sync after the last cycle.', lambda c: c.backlog),
+    )
+    lines = []
+    for name, help_text, value in series:
+        metric = f'painted_sync_{name}'
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} gauge')
+        for cycle in cycles:
+            lines.append(f'{metric}{{node="{escape_label(cycle.node)}"}} {value(cycle):.12g}')
+    return lines
@@ -0,0 +1,124 @@
+# playlists/middleware.py
+
+import itertools
+import re
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from .logging_utils import log_context
+from .metrics import RequestStats, request_stats, view_metrics
+
+# Request ids accepted from the front proxy; anything else is replaced with a new one
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class RequestIdMiddleware:
+    """
+    Gives every request a correlation id for its log lines.
+    The id is taken from the X-Request-ID header set by the front proxy when present,
+    otherwise generated, and returned in the response's X-Request-ID header.
+    Works under WSGI and ASGI; under ASGI it stays on the event loop so async views do too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with log_context(request_id=self.assign_id(request)):
+            response = self.get_response(request)
+        response.headers['X-Request-ID'] = request.request_id
+        return response
+
+    async def __acall__(self, request):
+        with log_context(request_id=self.assign_id(request)):
+            response = await self.get_response(request)
+        response.headers['X-Request-ID'] = request.request_id
+        return response
+
+    def assign_id(self, request):
+        incoming = request.headers.get('X-Request-ID', '')
+        request.request_id = incoming if REQUEST_ID_RE.match(incoming) else uuid.uuid4().hex
+        return request.request_id
+
+
+class PerformanceMiddleware:
+    """
+    Records wall time, database queries, Spotify API calls and response size per view
+    into the rolling histograms served at /metrics, and reports them to the browser in a
+    Server-Timing header. Only one request in PERF_METRICS_SAMPLE_EVERY is measured
+    (0 turns measuring off); the others pass straight through.
+    Queries and Spotify calls are counted through the request_stats context variable
+    (see metrics.count_query), so the same code measures sync and async views.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.counter = itertools.count()
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def sampled(self):
+        every = settings.PERF_METRICS_SAMPLE_EVERY
+        return every and not next(self.counter) % every
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            request_stats.reset(token)
+        return self.record(request, response, stats, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_stats.reset(token)
+        return self.record(request, response, stats, time.perf_counter() - start)
+
+    def record(self, request, response, stats, duration):
+        values = {
+            'duration_seconds': duration,
+            'db_queries': stats.db_queries,
+            'db_duration_seconds': stats.db_time,
+            'spotify_calls': stats.spotify_calls,
+            'spotify_duration_seconds': stats.spotify_time,
+        }
+        if response.has_header('Content-Length'):
+            values['response_bytes'] = int(response['Content-Length'])
+        elif not response.streaming:
+            values['response_bytes'] = len(response.content)
+        match = request.resolver_match
+        view_metrics.observe(match.view_name if match else '<unresolved>', values)
+
+        response.headers['Server-Timing'] = ', '.join([
+            f'app;dur={duration * 1000:.1f}',
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.db_queries} queries"',
+            f'spotify;dur={stats.spotify_time * 1000:.1f};desc="{stats.spotify_calls} calls"',
+        ])
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0004_playlist_snapshot_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="song",
+            name="photo_renditions",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:16
+
+import playlists.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0006_song_photo_status"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="song",
+            name="photo",
+            field=models.ImageField(
+                blank=True,
+                null=True,
+                storage=playlists.storage.ContentAddressedStorage(),
+                upload_to="song_photos/",
+            ),
+        ),
+    ]
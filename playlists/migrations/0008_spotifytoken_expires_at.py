@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:19
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def set_expires_at(apps, schema_editor):
+    # Existing tokens were last written when created or refreshed; created_at is the best guess
+    SpotifyToken = apps.get_model("playlists", "SpotifyToken")
+    for token in SpotifyToken.objects.all():
+        token.expires_at = token.created_at + timedelta(seconds=token.expires_in)
+        token.save(update_fields=["expires_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0007_song_photo_storage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="spotifytoken",
+            name="expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_expires_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0008_spotifytoken_expires_at"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="playlist",
+            name="spotify_playlist_id",
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name="song",
+            name="spotify_track_id",
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="playlist",
+            index=models.Index(
+                fields=["user", "-created_at", "-id"], name="playlist_user_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="song",
+            index=models.Index(
+                fields=["playlist", "-added_at", "-id"], name="song_playlist_added_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="song",
+            index=models.Index(
+                condition=models.Q(
+                    ("photo__isnull", False), models.Q(("photo", ""), _negated=True)
+                ),
+                fields=["playlist", "-added_at", "-id"],
+                name="song_photo_added_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="song",
+            index=models.Index(
+                condition=models.Q(("photo_status", "pending")),
+                fields=["photo_status"],
+                name="song_photo_pending_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="playlist",
+            constraint=models.UniqueConstraint(
+                fields=("user", "spotify_playlist_id"),
+                name="unique_spotify_playlist_per_user",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="song",
+            constraint=models.UniqueConstraint(
+                fields=("playlist", "spotify_track_id"),
+                name="unique_track_per_playlist",
+            ),
+        ),
+    ]
@@ -0,0 +1,181 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Songs moved to the catalog per query and bulk write
+BATCH_SIZE = 1000
+
+
+def move_songs_to_catalog(apps, schema_editor):
+    # One track per Spotify id, titled as its most recently added song; hand-added songs get their own track
+    Song = apps.get_model("playlists", "Song")
+    Track = apps.get_model("playlists", "Track")
+    track_ids = {}
+    songs = Song.objects.order_by("added_at", "id").only(
+        "id", "title", "spotify_track_id"
+    )
+    for song in songs.iterator(chunk_size=BATCH_SIZE):
+        if song.spotify_track_id:
+            track_ids[song.spotify_track_id] = song.title
+    Track.objects.bulk_create(
+        [
+            Track(spotify_track_id=spotify_id, title=title)
+            for spotify_id, title in track_ids.items()
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    track_ids = dict(Track.objects.values_list("spotify_track_id", "id"))
+
+    batch = []
+    for song in songs.iterator(chunk_size=BATCH_SIZE):
+        if song.spotify_track_id:
+            song.track_id = track_ids[song.spotify_track_id]
+        else:
+            song.track_id = Track.objects.create(title=song.title).id
+        batch.append(song)
+        if len(batch) == BATCH_SIZE:
+            Song.objects.bulk_update(batch, ["track"])
+            batch = []
+    Song.objects.bulk_update(batch, ["track"])
+
+
+def copy_catalog_to_songs(apps, schema_editor):
+    Song = apps.get_model("playlists", "Song")
+    batch = []
+    for song in Song.objects.select_related("track").iterator(chunk_size=BATCH_SIZE):
+        song.title = song.track.title[:80]
+        song.spotify_track_id = song.track.spotify_track_id
+        batch.append(song)
+        if len(batch) == BATCH_SIZE:
+            Song.objects.bulk_update(batch, ["title", "spotify_track_id"])
+            batch = []
+    Song.objects.bulk_update(batch, ["title", "spotify_track_id"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0009_query_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Album",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "spotify_album_id",
+                    models.CharField(blank=True, max_length=50, null=True, unique=True),
+                ),
+                ("title", models.CharField(max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Artist",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "spotify_artist_id",
+                    models.CharField(blank=True, max_length=50, null=True, unique=True),
+                ),
+                ("name", models.CharField(max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Track",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "spotify_track_id",
+                    models.CharField(blank=True, max_length=50, null=True, unique=True),
+                ),
+                ("title", models.CharField(max_length=200)),
+                ("artist_names", models.CharField(blank=True, max_length=255)),
+                (
+                    "album",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="tracks",
+                        to="playlists.album",
+                    ),
+                ),
+                (
+                    "artists",
+                    models.ManyToManyField(
+                        blank=True, related_name="tracks", to="playlists.artist"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="song",
+            name="track",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="songs",
+                to="playlists.track",
+            ),
+        ),
+        migrations.RunPython(move_songs_to_catalog, copy_catalog_to_songs),
+        migrations.RemoveConstraint(
+            model_name="song",
+            name="unique_track_per_playlist",
+        ),
+        # A default lets the column be added back with the track titles when migrating backwards
+        migrations.AlterField(
+            model_name="song",
+            name="title",
+            field=models.CharField(default="", max_length=80),
+        ),
+        migrations.RemoveField(
+            model_name="song",
+            name="spotify_track_id",
+        ),
+        migrations.RemoveField(
+            model_name="song",
+            name="title",
+        ),
+        migrations.AlterField(
+            model_name="song",
+            name="track",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="songs",
+                to="playlists.track",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="song",
+            constraint=models.UniqueConstraint(
+                fields=("playlist", "track"), name="unique_track_per_playlist"
+            ),
+        ),
+    ]
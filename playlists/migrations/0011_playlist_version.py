@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0010_track_catalog"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="playlist",
+            name="version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0012_import_batch"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SyncCycle",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("node", models.CharField(max_length=100)),
+                ("started_at", models.DateTimeField()),
+                ("finished_at", models.DateTimeField()),
+                ("playlists", models.PositiveIntegerField(default=0)),
+                ("changed", models.PositiveIntegerField(default=0)),
+                ("unchanged", models.PositiveIntegerField(default=0)),
+                ("failed", models.PositiveIntegerField(default=0)),
+                ("songs_written", models.PositiveIntegerField(default=0)),
+                ("spotify_calls", models.PositiveIntegerField(default=0)),
+                ("throttled_seconds", models.FloatField(default=0)),
+                ("lag_avg_seconds", models.FloatField(default=0)),
+                ("lag_max_seconds", models.FloatField(default=0)),
+                ("backlog", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="playlist",
+            name="next_sync_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="playlist",
+            name="sync_lease_owner",
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name="playlist",
+            name="sync_lease_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="playlist",
+            index=models.Index(
+                condition=models.Q(("spotify_playlist_id__isnull", False)),
+                fields=["next_sync_at", "id"],
+                name="playlist_next_sync_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="synccycle",
+            index=models.Index(fields=["-started_at"], name="synccycle_started_idx"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0013_playlist_sync_schedule"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="song",
+            name="photo_placeholder",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0014_song_photo_placeholder"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="song",
+            name="photo_rendition_formats",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
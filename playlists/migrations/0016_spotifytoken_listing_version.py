@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0015_song_photo_rendition_formats"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="spotifytoken",
+            name="listing_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0017_importjob_pending_idx"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="playlist",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
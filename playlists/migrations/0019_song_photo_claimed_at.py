@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("playlists", "0018_playlist_version_not_editable"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="song",
+            name="photo_claimed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -2,40 +2,167 @@
 
 from django.db import models  # Import Django's models module
 from django.contrib.auth.models import User  # Import the User model for user associations
+from .storage import photo_storage  # Content-addressed storage for song photos
+
+# Songs with an uploaded photo. Also the condition of the partial index on such songs, which
+# the database only uses for queries that repeat the condition exactly, so always filter with this
+SONG_HAS_PHOTO = models.Q(photo__isnull=False) & ~models.Q(photo='')
 
 class Playlist(models.Model):
     """
     Model representing a music playlist.
     """
-    spotify_playlist_id = models.CharField(max_length=50, unique=True, blank=True, null=True)
-    # Unique identifier for the Spotify playlist, can be blank or null
+    spotify_playlist_id = models.CharField(max_length=50, blank=True, null=True)
+    # Identifier of the Spotify playlist, unique per user, can be blank or null
     title = models.CharField(max_length=120)
     description = models.TextField(max_length=250, blank=True, null=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='playlists')
     # ForeignKey to associate the playlist with a user
     created_at = models.DateTimeField(auto_now_add=True)
     # Timestamp for when the playlist was created
+    snapshot_id = models.CharField(max_length=100, blank=True, null=True)
+    # Spotify's version of the playlist at the last sync, used to skip unchanged playlists
+    last_synced_at = models.DateTimeField(blank=True, null=True)
+    # Timestamp for when the playlist was last checked against Spotify
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped on every change to what the playlist's cached fragments show, see fragment_cache
+    next_sync_at = models.DateTimeField(blank=True, null=True)
+    # When the sync_playlists scheduler should next check the playlist against Spotify; null is due now
+    sync_lease_until = models.DateTimeField(blank=True, null=True)
+    sync_lease_owner = models.CharField(max_length=100, blank=True)
+    # The scheduler process syncing the playlist, which other processes leave alone until the lease ends
+
+    class Meta:
+        constraints = [
+            # Several users may import the same Spotify playlist, each into their own copy
+            models.UniqueConstraint(fields=['user', 'spotify_playlist_id'], name='unique_spotify_playlist_per_user'),
+        ]
+        indexes = [
+            # The home feed: a user's playlists, newest first, paginated on (created_at, id)
+            models.Index(fields=['user', '-created_at', '-id'], name='playlist_user_created_idx'),
+            # The scheduler's queue: imported playlists, the longest overdue first
+            models.Index(fields=['next_sync_at', 'id'], name='playlist_next_sync_idx',
+                         condition=models.Q(spotify_playlist_id__isnull=False)),
+        ]
 
     def __str__(self):
         # String representation of the Playlist model
         return self.title
 
+    def save(self, *args, **kwargs):
+        # version is only ever incremented in the database (see fragment_cache), so saving an
+        # existing playlist never writes the instance's copy, which may be out of date
+        if not self._state.adding:
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            kwargs['update_fields'] = [name for name in update_fields if name != 'version']
+        super().save(*args, **kwargs)
+
+class Artist(models.Model):
+    """
+    Model representing a Spotify artist in the track catalog shared by all users.
+    """
+    spotify_artist_id = models.CharField(max_length=50, unique=True, blank=True, null=True)
+    name = models.CharField(max_length=200)
+
+    def __str__(self):
+        return self.name
+
+class Album(models.Model):
+    """
+    Model representing a Spotify album in the track catalog shared by all users.
+    """
+    spotify_album_id = models.CharField(max_length=50, unique=True, blank=True, null=True)
+    title = models.CharField(max_length=200)
+
+    def __str__(self):
+        return self.title
+
+class Track(models.Model):
+    """
+    Model representing a track in the catalog shared by all playlists and users.
+    Spotify tracks are stored once however many playlists contain them; tracks added by
+    hand have no Spotify id and belong to a single song.
+    """
+    spotify_track_id = models.CharField(max_length=50, unique=True, blank=True, null=True)
+    # Identifier of the Spotify track, unique across the catalog, can be blank or null
+    title = models.CharField(max_length=200)
+    artists = models.ManyToManyField(Artist, blank=True, related_name='tracks')
+    artist_names = models.CharField(max_length=255, blank=True)
+    # The credited artists in Spotify's order, kept on the track so song lists need no join
+    album = models.ForeignKey(Album, on_delete=models.SET_NULL, blank=True, null=True, related_name='tracks')
+
+    def __str__(self):
+        return self.title
+
 class Song(models.Model):
     """
-    Model representing a song within a playlist.
+    Model representing a track's membership of a playlist, with the photo the user gave it there.
+    The track's metadata lives in the shared catalog (Track).
     """
-    title = models.CharField(max_length=80)
-    spotify_track_id = models.CharField(max_length=50, blank=True, null=True, unique=True)
-    # Unique identifier for the Spotify track, can be blank or null
-    photo = models.ImageField(upload_to='song_photos/', blank=True, null=True)
+    PHOTO_READY = 'ready'
+    PHOTO_PENDING = 'pending'
+    PHOTO_PROCESSING = 'processing'
+    PHOTO_FAILED = 'failed'
+    PHOTO_STATUS_CHOICES = [
+        (PHOTO_READY, 'Ready'),
+        (PHOTO_PENDING, 'Pending'),
+        (PHOTO_PROCESSING, 'Processing'),
+        (PHOTO_FAILED, 'Failed'),
+    ]
+
+    track = models.ForeignKey(Track, on_delete=models.PROTECT, related_name='songs')
+    # The catalog entry for the song's title and artists, shared with other playlists
+    photo = models.ImageField(upload_to='song_photos/', storage=photo_storage, blank=True, null=True)
+    # Stored under the hash of its content, so identical photos are kept once
+    photo_renditions = models.JSONField(default=list, blank=True)
+    # Widths of the resized copies generated next to the photo, see image_utils
+    photo_rendition_formats = models.JSONField(default=list, blank=True)
+    # Extensions of the formats the renditions were written in, which depend on the worker's Pillow
+    photo_placeholder = models.JSONField(default=dict, blank=True)
+    # Dominant colour, palette and a tiny blurred preview of the photo, painted until it loads
+    photo_status = models.CharField(max_length=20, choices=PHOTO_STATUS_CHOICES, default=PHOTO_READY)
+    # State of the latest upload, which the photo worker moves from pending to ready or failed
+    photo_staging = models.CharField(max_length=255, blank=True)
+    # Storage name of the uploaded file waiting to be processed
+    photo_claimed_at = models.DateTimeField(blank=True, null=True)
+    # When a photo worker claimed the upload, refreshed while it works on it, so a restarted
+    # worker only requeues the uploads of workers that stopped
     playlist = models.ForeignKey(Playlist, on_delete=models.CASCADE, related_name='songs')
     # ForeignKey to associate the song with a playlist
     added_at = models.DateTimeField(auto_now_add=True)
     # Timestamp for when the song was added to the playlist
 
+    class Meta:
+        constraints = [
+            # The same track may be in several playlists, but only once in each
+            models.UniqueConstraint(fields=['playlist', 'track'], name='unique_track_per_playlist'),
+        ]
+        indexes = [
+            # A playlist's songs, newest first, paginated on (added_at, id)
+            models.Index(fields=['playlist', '-added_at', '-id'], name='song_playlist_added_idx'),
+            # The same for songs with photos only (carousels), skipping the songs without one
+            models.Index(fields=['playlist', '-added_at', '-id'], condition=SONG_HAS_PHOTO, name='song_photo_added_idx'),
+            # Uploads waiting for the photo worker, a handful among all songs
+            models.Index(fields=['photo_status'], condition=models.Q(photo_status='pending'), name='song_photo_pending_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
+    @property
+    def title(self):
+        return self.track.title
+
+    @property
+    def artist(self):
+        return self.track.artist_names
+
+    @property
+    def photo_processing(self):
+        return self.photo_status in (self.PHOTO_PENDING, self.PHOTO_PROCESSING)
+
 
 class SpotifyToken(models.Model):
     """
@@ -47,8 +174,128 @@ class SpotifyToken(models.Model):
     refresh_token = models.CharField(max_length=255)
     token_type = models.CharField(max_length=50)
     expires_in = models.IntegerField()
+    # When access_token stops being valid; set on every refresh, unlike created_at
+    expires_at = models.DateTimeField(null=True, blank=True)
     scope = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
+    listing_version = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped when the user's playlists change, so every process sees its cached listing as stale
 
     def __str__(self):
         return f'Spotify Token for {self.user.username}'
+
+
+class ImportBatch(models.Model):
+    """
+    Model representing several playlist imports queued together, one ImportJob each.
+    A worker runs the jobs of a batch as one operation (see import_utils.run_import_batch).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='import_batches')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Import batch {self.id} of {self.user}'
+
+    def progress(self):
+        """
+        Combined progress of the batch's jobs, in one query: the number of jobs in each
+        state and the tracks imported out of the total known so far.
+        """
+        progress = self.jobs.aggregate(
+            total=models.Count('id'),
+            **{state: models.Count('id', filter=models.Q(state=state)) for state, _ in ImportJob.STATE_CHOICES},
+            tracks_done=models.Sum('tracks_done'),
+            tracks_total=models.Sum('tracks_total'),
+        )
+        # Sums of no rows are None
+        progress['tracks_done'] = progress['tracks_done'] or 0
+        progress['tracks_total'] = progress['tracks_total'] or 0
+        progress['finished'] = progress[ImportJob.SUCCEEDED] + progress[ImportJob.FAILED] == progress['total']
+        return progress
+
+
+class ImportJob(models.Model):
+    """
+    Model representing a queued Spotify playlist import run by the import worker.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATE_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='import_jobs')
+    spotify_playlist_id = models.CharField(max_length=50)
+    # Set when the job was queued as part of a batch import
+    batch = models.ForeignKey(ImportBatch, on_delete=models.CASCADE, blank=True, null=True, related_name='jobs')
+    # ForeignKey to the imported playlist, set once the job has created it
+    playlist = models.ForeignKey(Playlist, on_delete=models.SET_NULL, blank=True, null=True, related_name='import_jobs')
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=PENDING)
+    tracks_done = models.IntegerField(default=0)
+    tracks_total = models.IntegerField(default=0)
+    # Summary shown to the user on success and the failure reason otherwise
+    message = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Doubles as a heartbeat so the worker can requeue jobs abandoned by a crashed process
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # The worker's queue, polled every second: the few pending jobs among all finished ones
+            models.Index(fields=['created_at'], condition=models.Q(state='pending'), name='importjob_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'Import of {self.spotify_playlist_id} ({self.state})'
+
+    @property
+    def is_finished(self):
+        return self.state in (self.SUCCEEDED, self.FAILED)
+
+
+class SyncCycle(models.Model):
+    """
+    Model recording one cycle of the sync_playlists scheduler: what it synced, how fast,
+    and how long the playlists had been due.
+    """
+    node = models.CharField(max_length=100)
+    # The scheduler process that ran the cycle, as host:pid
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField()
+    playlists = models.PositiveIntegerField(default=0)
+    changed = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    songs_written = models.PositiveIntegerField(default=0)
+    spotify_calls = models.PositiveIntegerField(default=0)
+    # Time the cycle's Spotify calls waited for the rate budget
+    throttled_seconds = models.FloatField(default=0)
+    # How long the synced playlists had been due when the cycle claimed them
+    lag_avg_seconds = models.FloatField(default=0)
+    lag_max_seconds = models.FloatField(default=0)
+    # Playlists still due when the cycle finished
+    backlog = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-started_at'], name='synccycle_started_idx'),
+        ]
+
+    def __str__(self):
+        return f'Sync cycle on {self.node} at {self.started_at:%Y-%m-%d %H:%M:%S}'
+
+    @property
+    def seconds(self):
+        return (self.finished_at - self.started_at).total_seconds()
+
+    @property
+    def playlists_per_second(self):
+        return self.playlists / self.seconds if self.seconds else 0.0
@@ -0,0 +1,52 @@
+# playlists/pagination.py
+
+import base64
+from datetime import datetime
+
+from django.core.exceptions import BadRequest  # Raised for cursors that cannot be decoded
+from django.db.models import Q
+
+
+def encode_cursor(obj, field):
+    """
+    Encode the position of obj in a (field, id) ordering as an opaque URL-safe string.
+    """
+    raw = f'{getattr(obj, field).isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor made by encode_cursor back into its (datetime, id) pair.
+    """
+    try:
+        value, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(value), int(pk)
+    except (ValueError, UnicodeError):
+        raise BadRequest('Invalid cursor.')
+
+
+def cursor_page_queryset(queryset, field, cursor, page_size):
+    """
+    The query paginate_by_cursor runs for the page at cursor: one row more than page_size,
+    to find out whether another page follows.
+    """
+    queryset = queryset.order_by(f'-{field}', '-id')
+    if cursor:
+        value, pk = decode_cursor(cursor)
+        # Rows strictly after the cursor; the id breaks ties between equal timestamps
+        queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk}))
+    return queryset[:page_size + 1]
+
+
+def paginate_by_cursor(queryset, field, cursor, page_size):
+    """
+    Return one page of queryset, newest first by field, and the cursor of the next page.
+    Keyset pagination filters on the last row seen instead of using OFFSET, so every page
+    costs the same however deep the user scrolls and rows added meanwhile are not repeated.
+    The next cursor is None on the last page.
+    """
+    rows = list(cursor_page_queryset(queryset, field, cursor, page_size))
+    if len(rows) > page_size:
+        return rows[:page_size], encode_cursor(rows[page_size - 1], field)
+    return rows, None
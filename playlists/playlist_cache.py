@@ -0,0 +1,335 @@
+# playlists/playlist_cache.py
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import spotipy
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.db.models import F
+from .logging_utils import log_payload, map_in_context
+from .models import SpotifyToken
+from .spotify_async import aget_access_token, spotify_request
+from .spotify_http import http_session
+from .spotify_utils import call_with_retry, get_access_token
+
+logger = logging.getLogger(__name__)
+
+PLAYLISTS_PATH = '/me/playlists'  # Under SPOTIFY_API_URL
+PLAYLISTS_PAGE_SIZE = 50  # Maximum page size of the current user's playlists endpoint
+PLAYLIST_FETCH_WORKERS = 4  # Maximum number of listing pages fetched at once
+# Stale listings are kept this long so they can be shown at once and revalidated with ETags
+LISTING_RETENTION = 24 * 60 * 60
+# Seconds after which a background refresh that never finished stops blocking new ones
+REFRESH_LOCK_TIMEOUT = 60
+
+
+def listing_cache():
+    return caches[settings.SPOTIFY_PLAYLISTS_CACHE]
+
+
+def listing_key(user):
+    return f'spotify_playlists:{user.id}'
+
+
+def refresh_lock_key(user):
+    return f'spotify_playlists:{user.id}:refreshing'
+
+
+def listing_version(user):
+    """
+    The version of the user's listing, bumped by invalidate_playlist_listing. It is kept in
+    the database rather than the cache, so the import worker and sync scheduler can make
+    stale the listings cached by web processes even when each process has its own cache.
+    """
+    return SpotifyToken.objects.filter(user=user).values_list('listing_version', flat=True).first() or 0
+
+
+def listing_stale(entry, version):
+    """
+    Whether a cached listing should be refreshed: it is older than SPOTIFY_PLAYLISTS_CACHE_TTL
+    or the user's playlists changed since it was fetched.
+    """
+    return entry.get('version') != version or time.time() - entry['fetched_at'] > settings.SPOTIFY_PLAYLISTS_CACHE_TTL
+
+
+def fetch_playlists_page(access_token, offset, etag=None):
+    """
+    Fetch one page of the user's playlists, conditionally if the page's ETag is known.
+    Spotipy exposes neither request nor response headers, so this calls the API directly
+    on the shared session. Returns the page and its ETag, or None and the same ETag when
+    Spotify answers 304 Not Modified.
+    """
+    headers = {'Authorization': f'Bearer {access_token}'}
+    if etag:
+        headers['If-None-Match'] = etag
+    response = http_session.get(
+        settings.SPOTIFY_API_URL + PLAYLISTS_PATH,
+        params={'limit': PLAYLISTS_PAGE_SIZE, 'offset': offset}, headers=headers, timeout=settings.SPOTIFY_HTTP_TIMEOUT,
+    )
+    if response.status_code == 304:
+        return None, etag
+    if response.status_code >= 400:
+        # Raised like Spotipy's own errors so call_with_retry and the views handle it the same way
+        raise spotipy.SpotifyException(
+            response.status_code, -1, f'{response.url}: {response.text}', headers=response.headers
+        )
+    data = response.json()
+    log_payload(logger, 'Fetched Spotify playlists page', data)
+    return data, response.headers.get('ETag')
+
+
+def summarize_playlists(page):
+    """
+    The fields of each playlist in a page that the import dropdown shows.
+    """
+    return [
+        {
+            'id': pl.get('id', 'Unknown ID'),
+            'name': pl.get('name', 'Unknown Name'),
+            'tracks': (pl.get('tracks') or {}).get('total', 0),
+        }
+        for pl in page['items']
+        # Spotify occasionally returns None in place of a playlist
+        if pl is not None
+    ]
+
+
+def listing_page(offset, etag, data):
+    """
+    A page of the cached listing, made from a page of Spotify's response.
+    """
+    return {'offset': offset, 'etag': etag, 'total': data['total'], 'playlists': summarize_playlists(data)}
+
+
+def iter_playlist_pages(user, cached_pages=()):
+    """
+    Yield every page of the user's playlists in order, each as soon as it is available.
+    The first page gives the total, after which the remaining pages are fetched concurrently.
+    Cached pages that Spotify reports as unchanged are reused; a 304 has no body, so
+    revalidating an unchanged listing costs little.
+    """
+    access_token = get_access_token(user)
+    if access_token is None:
+        raise spotipy.SpotifyException(401, -1, 'Spotify account not connected.')
+
+    cached = {page['offset']: page for page in cached_pages}
+
+    def fetch_page(offset):
+        old = cached.get(offset)
+        data, etag = call_with_retry(fetch_playlists_page, access_token, offset, old and old['etag'])
+        return old if data is None else listing_page(offset, etag, data)
+
+    first_page = fetch_page(0)
+    yield first_page
+    offsets = range(PLAYLISTS_PAGE_SIZE, first_page['total'], PLAYLISTS_PAGE_SIZE)
+    if offsets:
+        with ThreadPoolExecutor(max_workers=min(PLAYLIST_FETCH_WORKERS, len(offsets))) as pool:
+            # map() yields results in offset order regardless of completion order
+            yield from map_in_context(pool, fetch_page, offsets)
+
+
+async def afetch_playlists_page(access_token, offset, etag=None):
+    """
+    fetch_playlists_page for async views, on the event loop's HTTP client.
+    """
+    headers = {'Authorization': f'Bearer {access_token}'}
+    if etag:
+        headers['If-None-Match'] = etag
+    response = await spotify_request(
+        'GET', settings.SPOTIFY_API_URL + PLAYLISTS_PATH,
+        params={'limit': PLAYLISTS_PAGE_SIZE, 'offset': offset}, headers=headers,
+    )
+    if response.status_code == 304:
+        return None, etag
+    data = response.json()
+    log_payload(logger, 'Fetched Spotify playlists page', data)
+    return data, response.headers.get('ETag')
+
+
+async def aiter_playlist_pages(user, cached_pages=()):
+    """
+    iter_playlist_pages for async views: the pages after the first are fetched concurrently
+    on the event loop instead of a thread pool, and still yielded in order.
+    """
+    access_token = await aget_access_token(user)
+    if access_token is None:
+        raise spotipy.SpotifyException(401, -1, 'Spotify account not connected.')
+
+    cached = {page['offset']: page for page in cached_pages}
+    # The same bound on concurrent requests per listing as the thread pool of the sync version
+    limit = asyncio.Semaphore(PLAYLIST_FETCH_WORKERS)
+
+    async def fetch_page(offset):
+        old = cached.get(offset)
+        async with limit:
+            data, etag = await afetch_playlists_page(access_token, offset, old and old['etag'])
+        return old if data is None else listing_page(offset, etag, data)
+
+    first_page = await fetch_page(0)
+    yield first_page
+    offsets = range(PLAYLISTS_PAGE_SIZE, first_page['total'], PLAYLISTS_PAGE_SIZE)
+    tasks = [asyncio.ensure_future(fetch_page(offset)) for offset in offsets]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        # Stop fetching when the caller stops early, e.g. a streaming client disconnected
+        for task in tasks:
+            task.cancel()
+
+
+def store_playlist_pages(user, pages, version):
+    """
+    Store a freshly fetched listing in the cache and return the cache entry.
+    version is the listing version read before fetching it, so a change made meanwhile
+    leaves the new entry stale.
+    """
+    entry = {'pages': pages, 'fetched_at': time.time(), 'version': version}
+    listing_cache().set(listing_key(user), entry, LISTING_RETENTION)
+    return entry
+
+
+def refresh_playlist_listing(user):
+    """
+    Fetch the user's playlists from Spotify and store them in the cache.
+    Returns the new cache entry.
+    """
+    version = listing_version(user)
+    entry = listing_cache().get(listing_key(user))
+    return store_playlist_pages(user, list(iter_playlist_pages(user, entry['pages'] if entry else ())), version)
+
+
+async def arefresh_playlist_listing(user):
+    """
+    refresh_playlist_listing for async views; only the cache access leaves the event loop.
+    """
+    version = await sync_to_async(listing_version)(user)
+    entry = await sync_to_async(listing_cache().get)(listing_key(user))
+    pages = [page async for page in aiter_playlist_pages(user, entry['pages'] if entry else ())]
+    return await sync_to_async(store_playlist_pages)(user, pages, version)
+
+
+def refresh_in_background(user):
+    """
+    Refresh the user's cached listing in a background thread, unless a refresh is running.
+    Returns whether a refresh was started.
+    """
+    # cache.add only succeeds for one caller, so concurrent page loads start one refresh
+    if not listing_cache().add(refresh_lock_key(user), True, REFRESH_LOCK_TIMEOUT):
+        return False
+
+    def run():
+        try:
+            refresh_playlist_listing(user)
+        except Exception:
+            logger.exception(f'Background refresh of Spotify playlists for user {user.id} failed')
+        finally:
+            listing_cache().delete(refresh_lock_key(user))
+            # The token lookup may have opened a database connection in this thread
+            connections.close_all()
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+
+def playlist_listing(entry):
+    return [playlist for page in entry['pages'] for playlist in page['playlists']]
+
+
+def get_cached_playlists(user):
+    """
+    The user's cached playlists, or None if nothing is cached.
+    A stale listing (see listing_stale) is still returned, and refreshed in the background
+    for the next page load.
+    """
+    entry = listing_cache().get(listing_key(user))
+    if entry is None:
+        return None
+    if listing_stale(entry, listing_version(user)):
+        refresh_in_background(user)
+    return playlist_listing(entry)
+
+
+def stream_playlists(user):
+    """
+    Yield the user's playlists a page at a time.
+    A cached listing is yielded at once (and refreshed in the background if stale);
+    otherwise each page is yielded as it arrives from Spotify and the complete listing
+    is cached at the end.
+    """
+    version = listing_version(user)
+    entry = listing_cache().get(listing_key(user))
+    if entry is not None:
+        if listing_stale(entry, version):
+            refresh_in_background(user)
+        for page in entry['pages']:
+            yield page['playlists']
+        return
+
+    pages = []
+    for page in iter_playlist_pages(user):
+        pages.append(page)
+        yield page['playlists']
+    store_playlist_pages(user, pages, version)
+
+
+async def astream_playlists(user):
+    """
+    stream_playlists for ASGI servers; only the cache and database access leave the event loop.
+    """
+    version = await sync_to_async(listing_version)(user)
+    entry = await sync_to_async(listing_cache().get)(listing_key(user))
+    if entry is not None:
+        if listing_stale(entry, version):
+            await sync_to_async(refresh_in_background)(user)
+        for page in entry['pages']:
+            yield page['playlists']
+        return
+
+    pages = []
+    async for page in aiter_playlist_pages(user):
+        pages.append(page)
+        yield page['playlists']
+    await sync_to_async(store_playlist_pages)(user, pages, version)
+
+
+def get_playlists(user):
+    """
+    The user's playlists from the cache, fetching them from Spotify if nothing is cached.
+    """
+    playlists = get_cached_playlists(user)
+    if playlists is None:
+        playlists = playlist_listing(refresh_playlist_listing(user))
+    return playlists
+
+
+async def aget_playlists(user):
+    """
+    get_playlists for async views.
+    """
+    playlists = await sync_to_async(get_cached_playlists)(user)
+    if playlists is None:
+        playlists = playlist_listing(await arefresh_playlist_listing(user))
+    return playlists
+
+
+def invalidate_playlist_listing(user):
+    """
+    Mark the user's cached listing as stale in every process, so the next page load
+    refreshes it. The pages and their ETags are kept, so that refresh can still be
+    answered with 304s.
+    """
+    SpotifyToken.objects.filter(user=user).update(listing_version=F('listing_version') + 1)
+
+
+def forget_playlist_listing(user):
+    """
+    Drop the user's cached listing entirely, e.g. when another Spotify account is connected.
+    """
+    listing_cache().delete(listing_key(user))
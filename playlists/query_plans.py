@@ -0,0 +1,54 @@
+# playlists/query_plans.py
+
+import re
+from datetime import datetime, timezone
+
+from django.contrib.auth.models import User
+from .import_utils import pending_jobs
+from .models import Artist, Playlist, Song, Track
+from .pagination import cursor_page_queryset, encode_cursor
+from .sync_scheduler import due_playlists
+
+# Plan lines that read a whole table: SQLite "SCAN <table>" without an index, PostgreSQL "Seq Scan"
+FULL_SCAN_RE = re.compile(r'\bSCAN (\w+)$|Seq Scan on (\w+)', re.MULTILINE)
+
+
+def later_page(queryset, field, size):
+    """
+    The query paginate_by_cursor runs for a page after the first.
+    """
+    row = queryset.model(id=1, **{field: datetime(2024, 1, 1, tzinfo=timezone.utc)})
+    return cursor_page_queryset(queryset, field, encode_cursor(row, field), size)
+
+
+def hot_queries():
+    """
+    The queries behind the main views, the imports and the background workers, as
+    (label, queryset) pairs. Their plans only depend on the schema, so any ids will do.
+    """
+    # Imported here: the views import this app's models, which must be loaded first
+    from .views import PLAYLIST_PAGE_SIZE, SONG_PAGE_SIZE, carousel_songs, home_playlists, playlist_songs
+
+    user = User(id=1)
+    playlist = Playlist(id=1, user=user)
+    return [
+        ('home: playlists page', later_page(home_playlists(user), 'created_at', PLAYLIST_PAGE_SIZE)),
+        ('home: carousel prefetch', carousel_songs().filter(playlist__in=[1, 2, 3])),
+        ('playlist_detail: songs page', later_page(playlist_songs(playlist), 'added_at', SONG_PAGE_SIZE)),
+        ('song_search', playlist.songs.select_related('track').order_by('track__title').filter(
+            track__title__icontains='a')[:20]),
+        ('import: playlist lookup', Playlist.objects.filter(spotify_playlist_id='x', user=user)),
+        ('import: catalog tracks', Track.objects.filter(spotify_track_id__in=['a', 'b'])),
+        ('import: catalog artists', Artist.objects.filter(spotify_artist_id__in=['a', 'b'])),
+        ('import: existing songs', playlist.songs.filter(track_id__in=[1, 2])),
+        ('import worker: pending jobs', pending_jobs()[:1]),
+        ('photo worker: pending uploads', Song.objects.filter(photo_status=Song.PHOTO_PENDING)[:8]),
+        ('sync scheduler: due playlists', due_playlists(datetime(2024, 1, 1, tzinfo=timezone.utc))[:50]),
+    ]
+
+
+def full_scans(plan):
+    """
+    The tables an EXPLAIN output reads in full.
+    """
+    return [a or b for a, b in FULL_SCAN_RE.findall(plan)]
@@ -0,0 +1,134 @@
+# playlists/spotify_async.py
+
+import asyncio
+import time
+import weakref
+
+import httpx
+import spotipy
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .metrics import record_spotify_call
+from .spotify_http import endpoint_name, http_session
+from .spotify_utils import MAX_RETRY_DELAY, cached_access_token, call_with_retry, get_access_token
+
+# Responses retried with back-off, like build_session's Retry; 429s wait for Retry-After instead
+RETRY_STATUSES = (500, 502, 503, 504)
+# Only these are retried after a 5xx, as urllib3's Retry does: the failed request may still have
+# been processed, e.g. a POST to /api/token that used up its one-time authorization code
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# One client per event loop: httpx connections and asyncio semaphores belong to the loop that used them first.
+# Only used under ASGI (SPOTIFY_ASYNC_CLIENT), where that is one client per worker for its lifetime
+_clients = weakref.WeakKeyDictionary()
+
+
+def async_client():
+    """
+    The HTTP client of the running event loop and the semaphore limiting its requests in
+    flight, created on first use. Waiting requests queue on the semaphore rather than in the
+    client's pool, whose bookkeeping grows with the square of the requests queued in it.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        limit = settings.SPOTIFY_ASYNC_MAX_CONNECTIONS
+        client = httpx.AsyncClient(
+            timeout=settings.SPOTIFY_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+            # Retries failed connections only; error responses are handled in spotify_request
+            transport=httpx.AsyncHTTPTransport(retries=settings.SPOTIFY_HTTP_RETRIES),
+        )
+        _clients[loop] = (client, asyncio.Semaphore(limit))
+    return _clients[loop]
+
+
+def session_request(method, url, **kwargs):
+    """
+    Send a request on the shared requests session, raising SpotifyException for error
+    responses as spotify_request does.
+    """
+    response = http_session.request(method, url, **kwargs)
+    if response.status_code >= 400:
+        raise spotipy.SpotifyException(
+            response.status_code, -1, f'{response.url}: {response.text}', headers=response.headers
+        )
+    return response
+
+
+async def spotify_request(method, url, max_retries=5, **kwargs):
+    """
+    Send a request to Spotify without blocking the event loop and return the response.
+    429 responses are retried after Retry-After as call_with_retry does, and 5xx responses to
+    idempotent requests with exponential back-off. Other errors raise SpotifyException like
+    Spotipy, so views handle both clients the same way; 304 Not Modified is returned to the caller.
+    Every attempt waits for the shared session's rate budget and is recorded in its
+    per-endpoint metrics.
+    """
+    if not settings.SPOTIFY_ASYNC_CLIENT:
+        # Under WSGI each async view runs on an event loop of its own, where a client would
+        # open new connections for every request; the shared session keeps them alive
+        return await sync_to_async(call_with_retry, thread_sensitive=False)(
+            session_request, method, url, max_retries=max_retries, **kwargs
+        )
+
+    adapter = http_session.get_adapter('https://')
+    for attempt in range(max_retries + 1):
+        # Read on every attempt, since set_rate_budget may replace it
+        if adapter.budget:
+            await adapter.budget.aacquire()
+        start = time.perf_counter()
+        response = None
+        client, in_flight = async_client()
+        try:
+            async with in_flight:
+                response = await client.request(method, url, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            adapter.metrics.record(endpoint_name(method, url), elapsed, response is None or response.status_code >= 400)
+            record_spotify_call(elapsed)
+
+        if attempt < max_retries and response.status_code == 429:
+            try:
+                delay = float(response.headers.get('Retry-After', 2 ** attempt))
+            except ValueError:
+                delay = 2 ** attempt
+            await asyncio.sleep(min(delay, MAX_RETRY_DELAY))
+        elif (attempt < settings.SPOTIFY_HTTP_RETRIES and response.status_code in RETRY_STATUSES
+              and method in RETRY_METHODS):
+            await asyncio.sleep(settings.SPOTIFY_HTTP_BACKOFF * 2 ** attempt)
+        elif response.status_code >= 400:
+            raise spotipy.SpotifyException(
+                response.status_code, -1, f'{response.url}: {response.text}', headers=response.headers
+            )
+        else:
+            return response
+
+
+async def aget_access_token(user):
+    """
+    get_access_token for async views. A token this process has cached is returned without
+    leaving the event loop. Otherwise the lookup, and the refresh when one is due, run in
+    Django's sync thread: refresh_token holds a row lock across the Spotify call so that only
+    one process refreshes, which needs a synchronous transaction. That happens at most
+    about once an hour per user and process.
+    """
+    access_token = cached_access_token(user)
+    if access_token is None:
+        access_token = await sync_to_async(get_access_token)(user)
+    return access_token
+
+
+async def exchange_code(code):
+    """
+    Exchange an OAuth authorization code for a token, as SpotifyOAuth.get_access_token does.
+    Returns Spotify's token response; failures raise SpotifyOauthError like Spotipy.
+    """
+    try:
+        response = await spotify_request(
+            'POST', f'{settings.SPOTIFY_ACCOUNTS_URL}/api/token',
+            data={'grant_type': 'authorization_code', 'code': code, 'redirect_uri': settings.SPOTIPY_REDIRECT_URI},
+            auth=(settings.SPOTIPY_CLIENT_ID or '', settings.SPOTIPY_CLIENT_SECRET or ''),
+        )
+    except spotipy.SpotifyException as e:
+        raise spotipy.SpotifyOauthError(e.msg, error=e.http_status)
+    return response.json()
@@ -0,0 +1,246 @@
+# playlists/spotify_http.py
+
+import asyncio
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .metrics import record_spotify_call
+
+# Spotify ids and user names in paths are replaced so latency is grouped per endpoint,
+# e.g. /v1/playlists/37i9dQZF1DXcBWIGoYBM5M/tracks becomes /v1/playlists/{id}/tracks
+ID_SEGMENT_RE = re.compile(r'/(playlists|users|tracks|albums|artists)/[^/]+')
+ID_SEGMENT_REPLACEMENT = r'/\1/{id}'
+
+
+def endpoint_name(method, url):
+    """
+    The metrics label of a request: its method and path with ids replaced.
+    """
+    return f'{method} {ID_SEGMENT_RE.sub(ID_SEGMENT_REPLACEMENT, urlsplit(url).path)}'
+
+
+class HTTPMetrics:
+    """
+    Request counts and latency per endpoint for the Spotify HTTP session.
+    Updated from every thread that makes requests, so all access goes through a lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, seconds, failed):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['errors'] += failed
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+
+    def snapshot(self):
+        """
+        Per-endpoint count, error count, and average, maximum and total latency in milliseconds.
+        """
+        with self.lock:
+            return {
+                endpoint: {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'avg_ms': round(stats['total'] / stats['count'] * 1000, 2),
+                    'max_ms': round(stats['max'] * 1000, 2),
+                    'total_ms': round(stats['total'] * 1000, 2),
+                }
+                for endpoint, stats in self.endpoints.items()
+            }
+
+
+class RateBudget:
+    """
+    Token bucket limiting the rate of Spotify calls across every thread of a process:
+    `rate` calls a second on average, with bursts of up to `burst` calls. A rate of 0 is
+    no limit. Callers are served in the order they ask, each waiting for its own token.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.throttled = 0  # Calls that had to wait for a token
+        self.wait_seconds = 0.0
+
+    def reserve(self):
+        """
+        Take a token and return the seconds to wait before using it.
+        The bucket goes negative while calls are waiting, so later callers queue behind them.
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = max(0.0, -self.tokens / self.rate)
+            if delay:
+                self.throttled += 1
+                self.wait_seconds += delay
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def aacquire(self):
+        """
+        acquire for coroutines, waiting for the token without blocking the event loop.
+        """
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class SpotifyHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that applies a default timeout, waits for the rate budget if it has one and
+    records per-endpoint latency.
+    """
+
+    def __init__(self, metrics, timeout=None, budget=None, **kwargs):
+        self.metrics = metrics
+        self.timeout = timeout
+        self.budget = budget
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        # SpotifyOAuth passes timeout=None unless given requests_timeout, which would wait forever
+        if timeout is None:
+            timeout = self.timeout
+        # Retries made by urllib3 inside this call are not charged; they only follow failures
+        if self.budget:
+            self.budget.acquire()
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = super().send(request, timeout=timeout, **kwargs)
+            failed = response.status_code >= 400
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.record(endpoint_name(request.method, request.url), elapsed, failed)
+            # Also count it against the request that made it, for PerformanceMiddleware
+            record_spotify_call(elapsed)
+
+    def pool_stats(self):
+        """
+        Requests sent and connections opened by this adapter's connection pools.
+        Every request that did not need a new connection reused a kept-alive one.
+        """
+        requests_sent = connections = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        return requests_sent, connections
+
+
+class SharedSession(requests.Session):
+    """
+    A session that outlives the Spotipy objects using it.
+    Spotify and SpotifyOAuth close their session when garbage collected, which would drop
+    every kept-alive connection in the shared pool each time a view's client goes away.
+    """
+
+    def close(self):
+        pass
+
+
+def build_session(pool_size=None, timeout=None, retries=None, backoff_factor=None, budget=None):
+    """
+    Create a requests session with a bounded keep-alive connection pool for the Spotify API.
+    Settings are taken from SPOTIFY_HTTP_* unless given. Failed connections and 5xx responses
+    are retried here with back-off; 429 responses are left to spotify_utils.call_with_retry,
+    which honours Spotify's Retry-After header. Every request waits for a token from budget,
+    a RateBudget, if given.
+    """
+    pool_size = pool_size or settings.SPOTIFY_HTTP_POOL_SIZE
+    retry = Retry(
+        total=settings.SPOTIFY_HTTP_RETRIES if retries is None else retries,
+        backoff_factor=settings.SPOTIFY_HTTP_BACKOFF if backoff_factor is None else backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        # urllib3 would otherwise also retry 429s that carry Retry-After, without waiting for the
+        # budget and for as long as Spotify asks; call_with_retry handles them instead
+        respect_retry_after_header=False,
+        # Hand the last error response to Spotipy, which turns it into a SpotifyException
+        raise_on_status=False,
+    )
+    adapter = SpotifyHTTPAdapter(
+        HTTPMetrics(),
+        timeout=timeout or settings.SPOTIFY_HTTP_TIMEOUT,
+        budget=budget,
+        pool_connections=4,  # Distinct hosts kept: api.spotify.com and accounts.spotify.com
+        pool_maxsize=pool_size,  # Connections kept alive per host
+        pool_block=True,  # Wait for a free connection rather than open one that is thrown away
+        max_retries=retry,
+    )
+    session = SharedSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session_metrics(session):
+    """
+    Connection pool hit rate, rate budget waits and per-endpoint latency of a session made by build_session.
+    """
+    adapter = session.get_adapter('https://')
+    requests_sent, connections = adapter.pool_stats()
+    budget = adapter.budget
+    return {
+        'pool': {
+            'requests': requests_sent,
+            'connections': connections,
+            'hit_rate': round(1 - connections / requests_sent, 4) if requests_sent else None,
+        },
+        'budget': {
+            'rate': budget.rate if budget else 0,
+            'throttled': budget.throttled if budget else 0,
+            'wait_seconds': round(budget.wait_seconds, 3) if budget else 0.0,
+        },
+        'endpoints': adapter.metrics.snapshot(),
+    }
+
+
+# The process-wide session used for all Spotify traffic. urllib3's pools are thread-safe,
+# and the Spotify API sets no cookies, so the threads of a worker can share it.
+# Its budget keeps the process within SPOTIFY_RATE_LIMIT however many threads call Spotify at once
+http_session = build_session(budget=RateBudget(settings.SPOTIFY_RATE_LIMIT, settings.SPOTIFY_RATE_BURST))
+
+
+def set_rate_budget(rate, burst=None):
+    """
+    Replace the rate budget of the process-wide session, e.g. to give each of several
+    worker processes its share of the app's limit.
+    """
+    http_session.get_adapter('https://').budget = RateBudget(rate, burst)
+
+
+def spotify_http_metrics():
+    """
+    Metrics of the process-wide Spotify session.
+    """
+    return session_metrics(http_session)
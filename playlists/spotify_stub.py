@@ -0,0 +1,210 @@
+# playlists/spotify_stub.py
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+# A local stand-in for the parts of the Spotify Web API the project uses, for benchmarks and
+# offline development: point SPOTIFY_API_URL at <stub>/v1 and SPOTIFY_ACCOUNTS_URL at <stub>.
+# Its playlists are generated from their ids, so it keeps no state beyond request counters.
+
+PLAYLISTS_PAGE_MAX = 50  # Largest page of /me/playlists, as on Spotify
+TRACKS_PAGE_MAX = 100  # Largest page of a playlist's tracks, as on Spotify
+# Playlist ids encode the stub's seed, the playlist's position and its number of tracks.
+# Spotipy only accepts base-62 ids, so they are letters and digits only
+PLAYLIST_ID_RE = re.compile(r'^(?P<seed>[0-9a-z]+)p(?P<index>\d+)n(?P<size>\d+)$')
+PLAYLIST_PATH_RE = re.compile(r'^/v1/playlists/(?P<id>[0-9A-Za-z]+)(?P<items>/tracks|/items)?$')
+
+
+def stub_playlist_id(seed, index, size):
+    return f'{seed}p{index:05d}n{size}'
+
+
+def stub_track(seed, index, position):
+    """
+    The track at a position of a stub playlist. Every ten tracks of a playlist share an album
+    and every fifty an artist; the same artists appear in every playlist of the stub.
+    """
+    return {
+        'id': f'{seed}p{index:05d}t{position:06d}',
+        'name': f'Track {position} of playlist {index}',
+        'artists': [{'id': f'{seed}a{position // 50:06d}', 'name': f'Artist {position // 50}'}],
+        'album': {'id': f'{seed}p{index:05d}b{position // 10:05d}', 'name': f'Album {position // 10}'},
+    }
+
+
+class SpotifyStubServer(ThreadingHTTPServer):
+    """
+    Serves the stub on a thread per connection.
+    sizes are the track counts of the user's playlists, in the order /me/playlists lists them.
+    Each response waits `latency` seconds, and if throttle_every is set every nth API request
+    is answered 429 Too Many Requests with a Retry-After of retry_after seconds. Pages hold at
+    most page_size items, whatever the client asks for.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, sizes, seed='stub', latency=0.0, throttle_every=0, retry_after=1, page_size=None):
+        self.sizes = list(sizes)
+        self.seed = seed
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.tokens_issued = 0
+        super().__init__(address, SpotifyStubHandler)
+
+    def should_throttle(self):
+        """
+        Count an API request and whether to answer it with a 429.
+        """
+        with self.lock:
+            self.requests += 1
+            throttle = bool(self.throttle_every) and self.requests % self.throttle_every == 0
+            self.throttled += throttle
+            return throttle
+
+
+class SpotifyStubHandler(BaseHTTPRequestHandler):
+    """
+    GET /v1/me/playlists, /v1/playlists/{id} and /v1/playlists/{id}/tracks (or /items)
+    with offset and limit paging and `next` links, and the accounts service's GET /authorize,
+    which approves straight away, and POST /api/token for codes and token refreshes.
+    """
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the Spotify API
+    # Buffer the response so headers and body go out in one write; separate small writes
+    # on a kept-alive connection stall on Nagle's algorithm and delayed ACKs
+    wbufsize = -1
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == '/authorize':
+            self.authorize(query)
+            return
+        if self.server.should_throttle():
+            self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                           {'Retry-After': str(self.server.retry_after)})
+            return
+
+        if url.path == '/v1/me/playlists':
+            self.send_playlists(url.path, query)
+            return
+        match = PLAYLIST_PATH_RE.match(url.path)
+        playlist = PLAYLIST_ID_RE.match(match['id']) if match else None
+        if playlist is None or playlist['seed'] != self.server.seed:
+            self.send_json(404, {'error': {'status': 404, 'message': 'Resource not found'}})
+        elif match['items']:
+            self.send_json(200, self.tracks_page(url.path, int(playlist['index']), int(playlist['size']), query))
+        else:
+            self.send_playlist(url.path, match['id'], int(playlist['index']), int(playlist['size']), query)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        # Read the form so the connection can be reused; any client and refresh token are accepted
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if urlsplit(self.path).path != '/api/token':
+            self.send_json(404, {'error': 'not_found'})
+            return
+        with self.server.lock:
+            self.server.tokens_issued += 1
+            access_token = f'stub-access-{self.server.tokens_issued}'
+        self.send_json(200, {
+            'access_token': access_token,
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'refresh_token': 'stub-refresh',
+            'scope': 'playlist-read-private playlist-read-collaborative',
+        })
+
+    def authorize(self, query):
+        # Send the user straight back to the app, as if they had approved it
+        params = {'code': 'stub-code', **({'state': query['state']} if 'state' in query else {})}
+        self.send_response(302)
+        self.send_header('Location', f'{query.get("redirect_uri", "/")}?{urlencode(params)}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_playlists(self, path, query):
+        seed, sizes = self.server.seed, self.server.sizes
+        offset, limit = self.paging(query, PLAYLISTS_PAGE_MAX)
+        # Pages never change, so their ETag only depends on where they are
+        etag = f'"{seed}-{offset}-{limit}-{len(sizes)}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_json(304, None, {'ETag': etag})
+            return
+        items = [
+            {'id': stub_playlist_id(seed, index, sizes[index]), 'name': f'Stub playlist {index}',
+             'tracks': {'total': sizes[index]}}
+            for index in range(offset, min(offset + limit, len(sizes)))
+        ]
+        self.send_json(200, self.page(path, items, offset, limit, len(sizes)), {'ETag': etag})
+
+    def send_playlist(self, path, playlist_id, index, size, query):
+        playlist = {
+            'id': playlist_id,
+            'name': f'Stub playlist {index}',
+            'description': f'{size} generated tracks',
+            'snapshot_id': f'{playlist_id}-1',
+        }
+        # Like Spotify, the first page of tracks is embedded unless the fields leave it out
+        if 'fields' in query and 'items' not in query['fields']:
+            playlist['tracks'] = {'total': size}
+        else:
+            playlist['tracks'] = self.tracks_page(f'{path}/tracks', index, size, {'limit': str(TRACKS_PAGE_MAX)})
+        self.send_json(200, playlist)
+
+    def tracks_page(self, path, index, size, query):
+        offset, limit = self.paging(query, TRACKS_PAGE_MAX)
+        items = [
+            {'added_at': '2024-01-01T00:00:00Z', 'track': stub_track(self.server.seed, index, position)}
+            for position in range(offset, min(offset + limit, size))
+        ]
+        return self.page(path, items, offset, limit, size)
+
+    def paging(self, query, page_max):
+        limit = min(int(query.get('limit', page_max)), page_max, self.server.page_size or page_max)
+        return int(query.get('offset', 0)), limit
+
+    def page(self, path, items, offset, limit, total):
+        def link(page_offset):
+            return f'http://{self.headers["Host"]}{path}?{urlencode({"offset": page_offset, "limit": limit})}'
+
+        return {
+            'href': link(offset),
+            'items': items,
+            'limit': limit,
+            'offset': offset,
+            'total': total,
+            'next': link(offset + limit) if offset + limit < total else None,
+            'previous': link(max(0, offset - limit)) if offset else None,
+        }
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if data is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_spotify_stub(port, sizes, **options):
+    """
+    Serve the stub on a local port until the process is stopped, e.g. as a
+    multiprocessing target so its threads do not compete with the code being measured.
+    """
+    SpotifyStubServer(('127.0.0.1', port), sizes, **options).serve_forever()
@@ -1,9 +1,34 @@
 # playlists/spotify_utils.py
 
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+
 import spotipy  # Import the Spotipy library for interacting with the Spotify API
+from spotipy.cache_handler import MemoryCacheHandler
 from spotipy.oauth2 import SpotifyOAuth  # Import SpotifyOAuth for handling authentication
 from django.conf import settings  # Import Django settings to access environment variables
+from django.db import transaction
+from django.utils import timezone
+from .logging_utils import map_in_context
 from .models import SpotifyToken  # Import the SpotifyToken model to manage user tokens
+from .spotify_http import http_session  # Pooled keep-alive session shared by every client
+
+TRACKS_PAGE_SIZE = 100  # Maximum page size of the playlist tracks endpoint
+TRACK_FETCH_WORKERS = 8  # Maximum number of track pages fetched at once
+# Only the parts of each page the catalog stores, instead of full track objects with every market
+TRACK_PAGE_FIELDS = 'total,limit,offset,items(track(id,name,artists(id,name),album(id,name)))'
+MAX_RETRY_DELAY = 60  # Upper bound in seconds on a single rate-limit back-off
+TOKEN_REFRESH_MARGIN = 60  # Seconds before expiry at which an access token is refreshed
+
+# Access tokens by user id as (access_token, expires_at), so most requests skip the database
+_token_cache = {}
+# One lock per user id, so only one thread per process refreshes a user's token at a time
+_token_locks = {}
+_token_locks_guard = threading.Lock()
+
 
 def get_spotify_auth_manager(user):
     """
@@ -12,55 +37,188 @@ def get_spotify_auth_manager(user):
     """
     scope = 'playlist-read-private playlist-read-collaborative'
     # Define the scope of permissions required from the Spotify API
-    # Use a unique cache path for each user to ensure tokens are user-specific
-    return SpotifyOAuth(
+    auth_manager = SpotifyOAuth(
         client_id=settings.SPOTIPY_CLIENT_ID,
         client_secret=settings.SPOTIPY_CLIENT_SECRET,
         redirect_uri=settings.SPOTIPY_REDIRECT_URI,
         scope=scope,
-        cache_path=None  # Manage caching via the SpotifyToken model
+        # Tokens are stored in the SpotifyToken model; a throwaway in-memory cache keeps
+        # Spotipy from writing them to a .cache file shared by every user
+        cache_handler=MemoryCacheHandler(),
+        requests_session=http_session,
     )
+    auth_manager.OAUTH_AUTHORIZE_URL = f'{settings.SPOTIFY_ACCOUNTS_URL}/authorize'
+    auth_manager.OAUTH_TOKEN_URL = f'{settings.SPOTIFY_ACCOUNTS_URL}/api/token'
+    return auth_manager
+
+
+def token_expiring(expires_at):
+    """
+    Whether a token expiring at expires_at should be refreshed now.
+    Tokens are refreshed a little early so they do not expire in the middle of an import.
+    """
+    return expires_at is None or expires_at <= timezone.now() + timedelta(seconds=TOKEN_REFRESH_MARGIN)
+
+
+def _token_lock(user_id):
+    with _token_locks_guard:
+        return _token_locks.setdefault(user_id, threading.Lock())
+
+
+def save_token_info(token, token_info):
+    """
+    Copy a token response from Spotify onto a SpotifyToken and save it.
+    """
+    token.access_token = token_info['access_token']
+    # Spotify only sometimes rotates the refresh token
+    token.refresh_token = token_info.get('refresh_token') or token.refresh_token
+    token.token_type = token_info['token_type']
+    token.expires_in = token_info['expires_in']
+    token.expires_at = timezone.now() + timedelta(seconds=token_info['expires_in'])
+    token.scope = token_info.get('scope') or token.scope
+    # Only the token's own fields, so a listing_version bumped meanwhile is not written back
+    token.save(update_fields=None if token._state.adding else [
+        'access_token', 'refresh_token', 'token_type', 'expires_in', 'expires_at', 'scope'
+    ])
+    _token_cache[token.user_id] = (token.access_token, token.expires_at)
+    return token
+
+
+def refresh_token(token):
+    """
+    Refresh a user's access token, at most once across threads and processes.
+    The token row stays locked with SELECT ... FOR UPDATE while Spotify is called, so a second
+    process that needs the same token waits and then finds it already refreshed.
+    """
+    with transaction.atomic():
+        token = SpotifyToken.objects.select_for_update().get(id=token.id)
+        if not token_expiring(token.expires_at):
+            # Another process refreshed it while this one waited for the lock
+            return token
+        token_info = get_spotify_auth_manager(token.user).refresh_access_token(token.refresh_token)
+        return save_token_info(token, token_info)
+
+
+def cached_access_token(user):
+    """
+    The user's access token if this process has it cached and it is not about to expire,
+    otherwise None. Never touches the database, so async code can call it directly.
+    """
+    cached = _token_cache.get(user.id)
+    if cached and not token_expiring(cached[1]):
+        return cached[0]
+    return None
+
+
+def get_access_token(user):
+    """
+    Return a valid access token for a user, refreshing it if it is about to expire.
+    Returns None if the user hasn't connected Spotify.
+    """
+    access_token = cached_access_token(user)
+    if access_token:
+        return access_token
+
+    with _token_lock(user.id):
+        # Another thread may have refreshed the token while this one waited
+        access_token = cached_access_token(user)
+        if access_token:
+            return access_token
+
+        token = SpotifyToken.objects.filter(user=user).first()
+        if token is None:
+            # Return None if the user hasn't connected their Spotify account
+            return None
+        if token_expiring(token.expires_at):
+            token = refresh_token(token)
+        _token_cache[user.id] = (token.access_token, token.expires_at)
+        return token.access_token
+
 
 def get_spotify_client(user):
     """
     Retrieve a Spotipy client for a user, ensuring the token is valid.
-    Returns None if the user hasn't connected Spotify or if the token is invalid.
+    Returns None if the user hasn't connected Spotify.
     """
-    try:  # Attempt to exchange code for access token
-        token = SpotifyToken.objects.get(user=user)
-    except SpotifyToken.DoesNotExist:
-        # Return None if the user hasn't connected their Spotify account
-        return None  # User hasn't connected Spotify
-
-    # Ensure the token is associated with the correct user
-    # Return None if the token does not belong to the user
-    if token.user != user:
+    access_token = get_access_token(user)
+    if access_token is None:
         return None
+    # Initialize Spotipy client with the token on the shared HTTP session
+    client = spotipy.Spotify(
+        auth=access_token, requests_session=http_session, requests_timeout=settings.SPOTIFY_HTTP_TIMEOUT
+    )
+    client.prefix = f'{settings.SPOTIFY_API_URL}/'
+    return client
+
+
+def call_with_retry(func, *args, max_retries=5, **kwargs):
+    """
+    Call a Spotipy method, backing off and retrying when Spotify answers 429 Too Many Requests.
+    Waits for the Retry-After header when present, otherwise backs off exponentially.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            if e.http_status != 429 or attempt == max_retries:
+                raise
+            headers = getattr(e, 'headers', None) or {}
+            try:
+                delay = float(headers.get('Retry-After', 2 ** attempt))
+            except (TypeError, ValueError):
+                delay = 2 ** attempt
+            time.sleep(min(delay, MAX_RETRY_DELAY))
+
 
-    auth_manager = get_spotify_auth_manager(user)
-
-    # Prepare token_info dictionary for expiration check
-    # This dictionary mimics the structure expected by Spotipy
-    token_info = {
-        'access_token': token.access_token,
-        'refresh_token': token.refresh_token,
-        'expires_in': token.expires_in,
-        'token_type': token.token_type,
-        'scope': token.scope,
-        'expires_at': token.created_at.timestamp() + token.expires_in
-    }
-
-    # Check if token is expired and refresh if necessary
-    # Update the SpotifyToken model with new token info if refreshed
-    if auth_manager.is_token_expired(token_info):
-        token_info = auth_manager.refresh_access_token(token.refresh_token)
-        # Update the SpotifyToken model with new token info
-        token.access_token = token_info['access_token']
-        token.expires_in = token_info['expires_in']
-        token.token_type = token_info['token_type']
-        token.scope = token_info['scope']
-        token.save()
-
-    # Initialize Spotipy client with the token
-    # Return the Spotipy client for making API calls
-    return spotipy.Spotify(auth=token.access_token)
+def get_playlist_tracks(spotify_client, playlist_data, on_page=None, max_workers=TRACK_FETCH_WORKERS):
+    """
+    Collect the track objects from every page of a playlist's tracks.
+    The first page is taken from the playlist response when it is embedded there (otherwise
+    it is fetched); its total and limit give the offsets of the remaining pages, which are
+    fetched concurrently and reassembled in order.
+    If given, on_page is called with the items fetched so far and the total after each page.
+    """
+    def fetch_page(offset, limit):
+        # Match the item types requested by Spotify.playlist() for the first page
+        return call_with_retry(
+            spotify_client.playlist_items, playlist_data['id'], fields=TRACK_PAGE_FIELDS,
+            limit=limit, offset=offset, additional_types=('track',)
+        )
+
+    first_page = playlist_data['tracks']
+    if 'items' not in first_page:
+        first_page = fetch_page(0, TRACKS_PAGE_SIZE)
+    total = first_page['total']
+    limit = first_page['limit'] or TRACKS_PAGE_SIZE
+    offsets = range(first_page['offset'] + limit, total, limit)
+
+    tracks = []
+    fetched = 0
+
+    def add_page(page):
+        nonlocal fetched
+        # Skip empty items, e.g. tracks that are no longer available
+        tracks.extend(item['track'] for item in page['items'] if item.get('track'))
+        fetched += len(page['items'])
+        if on_page:
+            on_page(fetched, total)
+
+    add_page(first_page)
+    if offsets:
+        # A bounded pool keeps the number of in-flight requests within Spotify's rate limits
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(offsets))) as pool:
+            # map() yields results in offset order regardless of completion order
+            for page in map_in_context(pool, partial(fetch_page, limit=limit), offsets):
+                add_page(page)
+    return tracks
+
+
+def get_playlist_header(spotify_client, playlist_id):
+    """
+    Fetch only a playlist's details and snapshot_id, without any tracks.
+    Used to check whether a stored playlist has changed since its last sync.
+    """
+    return call_with_retry(
+        spotify_client.playlist, playlist_id,
+        fields='id,name,description,snapshot_id,tracks.total'
+    )
@@ -0,0 +1,58 @@
+# playlists/storage.py
+
+import hashlib
+import posixpath
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+# Matches names produced by ContentAddressedStorage, e.g. song_photos/3f/3fa4...e1.jpeg, but
+# not the renditions next to them (3fa4...e1.640w.webp), which are rewritten when regenerated
+HASHED_NAME_RE = re.compile(r'(^|/)([0-9a-f]{2})/\2[0-9a-f]{62}(\.[^./]*)?$')
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that names every file after the SHA-256 of its content.
+    Identical files get the same name and are stored once, and the content behind a name
+    never changes, so its URL can be cached forever. Since a file may be shared by several
+    songs, callers delete it only when nothing references it (see image_utils.release_photo).
+    """
+
+    def hashed_name(self, name, content):
+        """
+        The name content is stored under: the directory of name, a two-character fan-out
+        directory, then the hash with the original extension.
+        """
+        sha256 = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            sha256.update(chunk)
+        content.seek(0)
+        digest = sha256.hexdigest()
+        extension = posixpath.splitext(name)[1].lower()
+        return posixpath.join(posixpath.dirname(name), digest[:2], digest + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        # The same content is already stored under this name, so there is nothing to write
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
+
+
+def is_hashed_name(name):
+    """
+    Whether name was produced by ContentAddressedStorage, i.e. its content is immutable.
+    """
+    return bool(HASHED_NAME_RE.search(name))
+
+
+photo_storage = ContentAddressedStorage()
@@ -0,0 +1,191 @@
+# playlists/sync_scheduler.py
+
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+import spotipy
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max, Q
+from django.utils import timezone
+from .import_utils import import_playlist, next_sync_at
+from .models import Playlist, SyncCycle
+from .playlist_cache import invalidate_playlist_listing
+from .spotify_utils import get_spotify_client
+
+logger = logging.getLogger(__name__)
+
+# Per-cycle stats older than this are deleted at the end of each cycle
+SYNC_STATS_RETENTION = timedelta(days=7)
+# Scheduler processes whose last cycle is older than this are left out of /metrics
+SYNC_STATS_WINDOW = timedelta(hours=1)
+
+# Outcomes of syncing one playlist
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+
+def sync_node_name():
+    """
+    Name of this scheduler process in leases and stats: its host and process id.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def due_playlists(now):
+    """
+    Imported playlists whose next sync is due, the longest overdue first.
+    Playlists never scheduled (imported before the scheduler existed) are due straight away.
+    """
+    return (
+        Playlist.objects.filter(spotify_playlist_id__isnull=False)
+        .filter(Q(next_sync_at__isnull=True) | Q(next_sync_at__lte=now))
+        .order_by(F('next_sync_at').asc(nulls_first=True), 'id')
+    )
+
+
+def mark_playlist_viewed(playlist):
+    """
+    Bring a viewed playlist's next sync forward to at most PLAYLIST_SYNC_VIEWED_INTERVAL away,
+    so the playlists people look at are the freshest. Only writes when that moves it, so
+    further views before the next sync cost nothing.
+    """
+    if not playlist.spotify_playlist_id or playlist.next_sync_at is None:
+        return
+    due = timezone.now() + timedelta(seconds=settings.PLAYLIST_SYNC_VIEWED_INTERVAL)
+    if playlist.next_sync_at > due:
+        Playlist.objects.filter(id=playlist.id, next_sync_at__gt=due).update(next_sync_at=due)
+        playlist.next_sync_at = due
+
+
+def claim_due_playlists(owner, limit):
+    """
+    Lease up to limit due playlists to owner for PLAYLIST_SYNC_LEASE seconds and return them.
+    The rows are locked while they are picked, skipping those another scheduler has locked,
+    and the lease is only taken where no live lease exists, so concurrent schedulers never
+    sync the same playlist, also on databases without SELECT ... FOR UPDATE SKIP LOCKED.
+    A lease left by a crashed scheduler runs out and the playlist is claimed again.
+    """
+    now = timezone.now()
+    until = now + timedelta(seconds=settings.PLAYLIST_SYNC_LEASE)
+    unleased = Q(sync_lease_until__isnull=True) | Q(sync_lease_until__lt=now)
+    with transaction.atomic():
+        ids = list(
+            due_playlists(now).filter(unleased).select_for_update(skip_locked=True)
+            .values_list('id', flat=True)[:limit]
+        )
+        Playlist.objects.filter(id__in=ids).filter(unleased).update(sync_lease_until=until, sync_lease_owner=owner)
+    return list(
+        Playlist.objects.filter(id__in=ids, sync_lease_owner=owner, sync_lease_until=until)
+        .select_related('user')
+        .order_by(F('next_sync_at').asc(nulls_first=True), 'id')
+    )
+
+
+def release_sync_leases(owner):
+    """
+    Give up the leases owner still holds, e.g. on shutdown, so other schedulers can sync them.
+    """
+    return Playlist.objects.filter(sync_lease_owner=owner).update(sync_lease_until=None, sync_lease_owner='')
+
+
+class SpotifyClients:
+    """
+    The Spotify clients of the users whose playlists a cycle syncs, made once per user and
+    shared by the scheduler's worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def get(self, user):
+        # Held while the client is made, so a user's token is only refreshed once
+        with self.lock:
+            if user.id not in self.clients:
+                self.clients[user.id] = get_spotify_client(user)
+            return self.clients[user.id]
+
+
+def sync_playlist(playlist, clients, owner):
+    """
+    Sync a leased playlist with Spotify, then schedule its next sync and release the lease.
+    Returns the outcome (CHANGED, UNCHANGED or FAILED) and the number of songs written.
+    """
+    outcome, songs_written = FAILED, 0
+    try:
+        spotify_client = clients.get(playlist.user)
+        if not spotify_client:
+            logger.warning(f'Not syncing playlist {playlist.id}: its user has no Spotify connection.')
+        else:
+            _, counts = import_playlist(playlist.user, playlist.spotify_playlist_id, spotify_client)
+            if counts is None:
+                outcome = UNCHANGED
+            else:
+                outcome = CHANGED
+                songs_written = counts['inserted'] + counts['updated'] + counts['removed']
+                # Track counts in the import dropdown may have changed since the listing was cached
+                invalidate_playlist_listing(playlist.user)
+    except spotipy.SpotifyException as e:
+        logger.error(f'Spotify API error syncing playlist {playlist.id}: {e}')
+    except Exception:
+        logger.exception(f'Sync of playlist {playlist.id} failed')
+
+    # Failed syncs are retried at the normal interval rather than straight away
+    Playlist.objects.filter(id=playlist.id, sync_lease_owner=owner).update(
+        next_sync_at=next_sync_at(timezone.now()), sync_lease_until=None, sync_lease_owner=''
+    )
+    return outcome, songs_written
+
+
+def sync_lag(playlist, claimed_at):
+    """
+    Seconds a playlist had been due for a sync when it was claimed.
+    """
+    due = playlist.next_sync_at or playlist.last_synced_at or playlist.created_at
+    return max(0.0, (claimed_at - due).total_seconds())
+
+
+def record_sync_cycle(owner, started_at, playlists, outcomes, spotify_before, spotify_after):
+    """
+    Save the stats of a finished cycle as a SyncCycle and delete those past SYNC_STATS_RETENTION.
+    outcomes are the (outcome, songs_written) results of sync_playlist for playlists, and the
+    Spotify stats are spotify_http_metrics() from before and after the cycle.
+    """
+    finished_at = timezone.now()
+    lags = [sync_lag(playlist, started_at) for playlist in playlists]
+    states = [outcome for outcome, _ in outcomes]
+    calls = [sum(endpoint['count'] for endpoint in stats['endpoints'].values())
+             for stats in (spotify_before, spotify_after)]
+    cycle = SyncCycle.objects.create(
+        node=owner,
+        started_at=started_at,
+        finished_at=finished_at,
+        playlists=len(playlists),
+        changed=states.count(CHANGED),
+        unchanged=states.count(UNCHANGED),
+        failed=states.count(FAILED),
+        songs_written=sum(songs for _, songs in outcomes),
+        spotify_calls=calls[1] - calls[0],
+        throttled_seconds=spotify_after['budget']['wait_seconds'] - spotify_before['budget']['wait_seconds'],
+        lag_avg_seconds=sum(lags) / len(lags) if lags else 0.0,
+        lag_max_seconds=max(lags, default=0.0),
+        backlog=due_playlists(finished_at).count(),
+    )
+    SyncCycle.objects.filter(started_at__lt=finished_at - SYNC_STATS_RETENTION).delete()
+    return cycle
+
+
+def latest_sync_cycles():
+    """
+    The last cycle of each scheduler process that ran one within SYNC_STATS_WINDOW.
+    """
+    latest = (
+        SyncCycle.objects.filter(started_at__gte=timezone.now() - SYNC_STATS_WINDOW)
+        .values('node').annotate(latest_id=Max('id')).values('latest_id')
+    )
+    return list(SyncCycle.objects.filter(id__in=latest).order_by('node'))
@@ -0,0 +1,52 @@
+# playlists/templatetags/photo_tags.py
+
+from django import template
+from django.utils.html import format_html, format_html_join
+from playlists.image_utils import rendition_name, RENDITION_CONTENT_TYPES, RENDITION_FORMATS
+
+register = template.Library()
+
+
+def placeholder_style(song):
+    """
+    Inline style painting a song's placeholder behind its <img>: the dominant colour at once,
+    then the blurred preview, both hidden by the photo once it has loaded.
+    """
+    placeholder = song.photo_placeholder
+    if not placeholder:
+        return ''
+    # Browsers scale the tiny preview up smoothly, which blurs it
+    return f'background: {placeholder["color"]} url({placeholder["preview"]}) center / cover no-repeat'
+
+
+@register.simple_tag
+def responsive_photo(song, sizes, css_class=''):
+    """
+    Render a song's photo as a <picture> with a srcset per rendition format.
+    Falls back to a plain <img> of the original until the renditions have been generated.
+    Usage: {% responsive_photo song "(min-width: 640px) 50vw, 100vw" "w-full h-48 object-cover" %}
+    """
+    photo = song.photo
+    widths = song.photo_renditions
+    style = placeholder_style(song)
+    if not widths:
+        return format_html(
+            '<img src="{}" alt="{}" class="{}" style="{}" loading="lazy">', photo.url, song.title, css_class, style
+        )
+
+    def srcset(ext):
+        return ', '.join(f'{photo.storage.url(rendition_name(photo.name, width, ext))} {width}w' for width in widths)
+
+    # Only the formats the worker wrote; renditions from before they were recorded are JPEG only
+    formats = song.photo_rendition_formats or ['jpg']
+    # Browsers take the first <source> whose type they support, so list the smallest formats first
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((RENDITION_CONTENT_TYPES[ext], srcset(ext), sizes)
+         for ext, _, _ in RENDITION_FORMATS if ext in formats and ext != 'jpg')
+    )
+    fallback = photo.storage.url(rendition_name(photo.name, widths[-1], 'jpg'))
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" alt="{}" class="{}" style="{}" loading="lazy"></picture>',
+        sources, fallback, srcset('jpg'), sizes, song.title, css_class, style
+    )
@@ -0,0 +1,279 @@
+# playlists/tests.py
+
+import json
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+import spotipy
+from PIL import Image
+from .image_utils import (
+    COMPLETE_READY, COMPLETE_REQUEUED, claim_pending_photos, complete_staged_photo, process_staged_photo,
+    requeue_stale_photos, stored_renditions
+)
+from .models import Playlist, Song, SpotifyToken, Track
+from .playlist_cache import get_cached_playlists, invalidate_playlist_listing, listing_version, store_playlist_pages
+from .query_plans import full_scans, hot_queries
+from .spotify_http import build_session
+from .spotify_stub import SpotifyStubServer, stub_playlist_id
+from .spotify_utils import call_with_retry
+from .storage import photo_storage
+
+
+def create_playlists(user, count, songs=3):
+    """
+    Create count playlists for user, each with songs that have a photo.
+    """
+    for i in range(count):
+        playlist = Playlist.objects.create(user=user, title=f'Playlist {i}', spotify_playlist_id=f'p{i}')
+        for j in range(songs):
+            track = Track.objects.create(spotify_track_id=f'p{i}t{j}', title=f'Track {j}', artist_names='Artist')
+            Song.objects.create(playlist=playlist, track=track, photo=f'song_photos/p{i}t{j}.jpg', photo_renditions=[320])
+
+
+class HomeQueryCountTests(TestCase):
+    """
+    The home feed loads every carousel of a page in one prefetch, so its number of queries
+    does not grow with the number of playlists, and cached cards skip that prefetch.
+    """
+    # Session, user and the page of playlists, plus the carousels' prefetch when cold
+    WARM_QUERIES = 3
+    COLD_QUERIES = 4
+
+    def setUp(self):
+        self.user = User.objects.create(username='listener')
+        self.client.force_login(self.user)
+        caches[settings.FRAGMENT_CACHE].clear()
+
+    def assert_home_queries(self, playlist_count):
+        create_playlists(self.user, playlist_count)
+        url = reverse('playlists:home')
+        with self.assertNumQueries(self.COLD_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Playlist 0')
+        with self.assertNumQueries(self.WARM_QUERIES):
+            self.client.get(url)
+
+    def test_two_playlists(self):
+        self.assert_home_queries(2)
+
+    def test_ten_playlists(self):
+        self.assert_home_queries(10)
+
+
+def stage_image(color):
+    """
+    Stage a small JPEG of a single colour, as an upload waiting for the photo worker.
+    """
+    buffer = BytesIO()
+    Image.new('RGB', (400, 300), color).save(buffer, 'JPEG')
+    return default_storage.save('song_photos/staging/test/photo.jpg', ContentFile(buffer.getvalue()))
+
+
+class PhotoReleaseTests(TestCase):
+    """
+    Content-addressed photos are deleted with their renditions once no song refers to them.
+    """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        user = User.objects.create(username='listener')
+        self.playlist = Playlist.objects.create(user=user, title='Photos')
+        self.songs = [
+            Song.objects.create(playlist=self.playlist, track=Track.objects.create(title=f'Track {i}'))
+            for i in range(2)
+        ]
+
+    def upload(self, song, color):
+        staging_name = stage_image(color)
+        Song.objects.filter(id=song.id).update(photo_staging=staging_name, photo_status=Song.PHOTO_PROCESSING)
+        result = process_staged_photo(staging_name)
+        return staging_name, result
+
+    def test_deleting_songs_releases_unshared_photos(self):
+        for song in self.songs:
+            staging_name, result = self.upload(song, 'red')
+            self.assertEqual(complete_staged_photo(song.id, staging_name, *result), COMPLETE_READY)
+        name = result[0]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.songs[0].delete()
+        # Still shown by the other song
+        self.assertTrue(photo_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.playlist.delete()
+        self.assertFalse(photo_storage.exists(name))
+        self.assertEqual(stored_renditions(name), [])
+
+    def test_photo_released_while_processing_is_requeued(self):
+        song = self.songs[0]
+        staging_name, result = self.upload(song, 'blue')
+        # Another song released the same photo before this one referred to it
+        photo_storage.delete(result[0])
+
+        self.assertEqual(complete_staged_photo(song.id, staging_name, *result), COMPLETE_REQUEUED)
+        song.refresh_from_db()
+        self.assertEqual(song.photo_status, Song.PHOTO_PENDING)
+        self.assertTrue(default_storage.exists(staging_name))
+
+
+class PhotoClaimTests(TestCase):
+    """
+    A starting photo worker only requeues the uploads of workers that stopped refreshing their claims.
+    """
+
+    def test_only_stale_claims_are_requeued(self):
+        playlist = Playlist.objects.create(user=User.objects.create(username='listener'), title='Photos')
+        songs = [
+            Song.objects.create(
+                playlist=playlist, track=Track.objects.create(title=f'Track {i}'),
+                photo_staging=f'song_photos/staging/{i}/photo.jpg', photo_status=Song.PHOTO_PENDING,
+            )
+            for i in range(2)
+        ]
+        self.assertEqual(len(claim_pending_photos(2)), 2)
+        # The first song's worker stopped an hour ago; the second's is still running
+        Song.objects.filter(id=songs[0].id).update(photo_claimed_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(requeue_stale_photos(600), 1)
+        statuses = dict(Song.objects.values_list('id', 'photo_status'))
+        self.assertEqual(statuses, {songs[0].id: Song.PHOTO_PENDING, songs[1].id: Song.PHOTO_PROCESSING})
+
+
+class PlaylistListingTests(TestCase):
+    """
+    Invalidating a user's listing goes through the database, so a listing cached by another
+    process (each with its own LocMemCache) is seen as stale too.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='listener')
+        SpotifyToken.objects.create(
+            user=self.user, access_token='a', refresh_token='r', token_type='Bearer', expires_in=3600, scope=''
+        )
+        page = {'offset': 0, 'etag': '"1"', 'total': 1, 'playlists': [{'id': 'p', 'name': 'Mix', 'tracks': 3}]}
+        store_playlist_pages(self.user, [page], listing_version(self.user))
+
+    @mock.patch('playlists.playlist_cache.refresh_in_background')
+    def test_fresh_listing_is_not_refreshed(self, refresh):
+        self.assertEqual(get_cached_playlists(self.user), [{'id': 'p', 'name': 'Mix', 'tracks': 3}])
+        refresh.assert_not_called()
+
+    @mock.patch('playlists.playlist_cache.refresh_in_background')
+    def test_invalidated_listing_is_refreshed(self, refresh):
+        invalidate_playlist_listing(self.user)
+        # Still shown at once, and refreshed for the next page load
+        self.assertEqual(len(get_cached_playlists(self.user)), 1)
+        refresh.assert_called_once_with(self.user)
+
+
+class StreamPlaylistsTests(TestCase):
+    """
+    The NDJSON listing sends each page as it arrives instead of after the last one.
+    """
+
+    def setUp(self):
+        self.stub = SpotifyStubServer(('127.0.0.1', 0), [1] * 120)
+        threading.Thread(target=self.stub.serve_forever, daemon=True).start()
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+        stub_settings = override_settings(SPOTIFY_API_URL=f'http://127.0.0.1:{self.stub.server_port}/v1')
+        stub_settings.enable()
+        self.addCleanup(stub_settings.disable)
+
+        user = User.objects.create(username='listener')
+        SpotifyToken.objects.create(
+            user=user, access_token='a', refresh_token='r', token_type='Bearer', expires_in=3600, scope='',
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+        caches[settings.SPOTIFY_PLAYLISTS_CACHE].clear()
+        self.client.force_login(user)
+
+    def test_first_page_is_sent_before_the_last_is_fetched(self):
+        response = self.client.get(reverse('playlists:stream_spotify_playlists'))
+        lines = iter(response.streaming_content)
+        self.assertEqual(len(json.loads(next(lines))['playlists']), 50)
+        # Only the first of the three pages has been requested so far
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual([len(json.loads(line)['playlists']) for line in lines], [50, 20])
+
+
+class QueryPlanTests(TestCase):
+    """
+    The hot queries (see check_query_plans) are answered from indexes on the test database.
+    """
+    # Read in index order, so their LIMIT stops early instead of sorting every matching row
+    INDEX_ORDERED = ('home: playlists page', 'playlist_detail: songs page', 'import worker: pending jobs')
+
+    def test_no_full_scans(self):
+        for label, queryset in hot_queries():
+            with self.subTest(label):
+                plan = queryset.explain()
+                self.assertEqual(full_scans(plan), [], plan)
+                if label in self.INDEX_ORDERED:
+                    self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_pages_after_the_first_break_ties_on_id(self):
+        queries = dict(hot_queries())
+        sql = str(queries['playlist_detail: songs page'].query)
+        self.assertIn('"playlists_song"."added_at" <', sql)
+        self.assertIn('"playlists_song"."id" <', sql)
+
+
+class PlaylistVersionTests(TestCase):
+    """
+    Playlist.version only moves forward, so a fragment cached under a version is never served
+    for different content.
+    """
+
+    def test_saving_a_stale_instance_does_not_reuse_a_version(self):
+        playlist = Playlist.objects.create(user=User.objects.create(username='listener'), title='Mix')
+        stale = Playlist.objects.get(id=playlist.id)
+        playlist.title = 'Renamed'
+        playlist.save()
+        self.assertEqual(playlist.version, 1)
+
+        # e.g. an admin form loaded before the rename
+        stale.title = 'Renamed again'
+        stale.save()
+        self.assertEqual(stale.version, 2)
+        self.assertEqual(Playlist.objects.get(id=playlist.id).version, 2)
+
+
+class RateLimitRetryTests(TestCase):
+    """
+    429 responses are retried by call_with_retry alone, not again inside the session.
+    """
+
+    def setUp(self):
+        # Every API request is answered 429 with Retry-After: 0
+        self.stub = SpotifyStubServer(('127.0.0.1', 0), [0], throttle_every=1, retry_after=0)
+        threading.Thread(target=self.stub.serve_forever, daemon=True).start()
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+
+    def test_each_retry_is_one_request(self):
+        client = spotipy.Spotify(auth='test', requests_session=build_session(), retries=0)
+        client.prefix = f'http://127.0.0.1:{self.stub.server_port}/v1/'
+        with self.assertRaises(spotipy.SpotifyException) as raised:
+            call_with_retry(client.playlist, stub_playlist_id('stub', 0, 0), max_retries=2)
+        self.assertEqual(raised.exception.http_status, 429)
+        self.assertEqual(self.stub.requests, 3)
@@ -8,9 +8,14 @@ app_name = 'playlists'
 urlpatterns = [
     path('', views.home, name='home'),
     path('<int:playlist_id>/', views.playlist_detail, name='playlist_detail'),
+    path('<int:playlist_id>/songs/search/', views.song_search, name='song_search'),
+    path('<int:playlist_id>/songs/<int:song_id>/card/', views.song_card, name='song_card'),
     path('import_spotify/', views.import_spotify_playlist, name='import_spotify_playlist'),
+    path('import_spotify/playlists/', views.stream_spotify_playlists, name='stream_spotify_playlists'),
     path('spotify_login/', views.spotify_login, name='spotify_login'),
     path('spotify_callback/', views.spotify_callback, name='spotify_callback'),
     path('import_selected/', views.import_selected_playlist, name='import_selected_playlist'),
+    path('import_jobs/<int:job_id>/', views.import_job_status, name='import_job_status'),
+    path('import_batches/<int:batch_id>/', views.import_batch_status, name='import_batch_status'),
 
 ]
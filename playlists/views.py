@@ -1,79 +1,224 @@
 # playlists/views.py
 
+import json
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from .models import Playlist, Song, SpotifyToken
-from .spotify_utils import get_spotify_client, get_spotify_auth_manager
+from .models import SONG_HAS_PHOTO, ImportBatch, ImportJob, Playlist, Song, SpotifyToken
+from .spotify_utils import get_spotify_auth_manager, save_token_info
+from .spotify_async import aget_access_token, exchange_code
+from .pagination import decode_cursor, paginate_by_cursor
+from .image_utils import delete_staged, stage_upload
+from .import_utils import queue_import_batch
+from .logging_utils import log_payload
+from .fragment_cache import cached_fragment, cached_fragments, fragment_key
+from .metrics import fragment_cache_stats, render_spotify_metrics, render_sync_metrics, view_metrics
+from .spotify_http import spotify_http_metrics
+from .sync_scheduler import latest_sync_cycles, mark_playlist_viewed
+from .playlist_cache import aget_playlists, forget_playlist_listing, get_cached_playlists, astream_playlists, stream_playlists
 
 import spotipy
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.db.models import OuterRef, Prefetch, Q, Subquery, prefetch_related_objects
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
 from django.urls import reverse
 
+logger = logging.getLogger(__name__)
+
+# Number of photos shown in each playlist's carousel on the home page
+CAROUSEL_PHOTO_LIMIT = 12
+# Number of playlists per page of the home feed
+PLAYLIST_PAGE_SIZE = 10
+# Number of photos per page of a playlist's grid
+SONG_PAGE_SIZE = 24
+# Maximum number of songs returned by the upload song search
+SONG_SEARCH_LIMIT = 20
+# Most playlists one batch import may queue, and failures listed in its progress report
+MAX_BATCH_PLAYLISTS = 500
+BATCH_ERRORS_SHOWN = 20
+
+
+def songs_with_photos():
+    """
+    Queryset of songs that have an uploaded photo.
+    """
+    return Song.objects.filter(SONG_HAS_PHOTO)
+
+
+def is_ajax(request):
+    """
+    Whether the request was made by the page's own JavaScript rather than a page load.
+    """
+    return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+
+def home_playlists(user):
+    """
+    Queryset of a user's playlists for the home feed.
+    """
+    return Playlist.objects.filter(user=user).only('id', 'title', 'created_at', 'version')
+
+
+def carousel_songs():
+    """
+    Queryset of the songs in each playlist's carousel, for prefetching onto the playlists.
+    """
+    # Keep only the newest photos of each playlist with a correlated subquery, so every
+    # carousel is loaded by a single prefetch query however many playlists there are
+    newest_photo_ids = songs_with_photos().filter(
+        playlist=OuterRef('playlist')
+    ).order_by('-added_at', '-id').values('id')[:CAROUSEL_PHOTO_LIMIT]
+    return songs_with_photos().filter(
+        id__in=Subquery(newest_photo_ids)
+    ).order_by('-added_at', '-id').select_related('track').only(
+        'id', 'photo', 'photo_renditions', 'photo_rendition_formats', 'photo_placeholder', 'playlist_id',
+        'track__title', 'track__artist_names'
+    )
+
+
+def render_playlist_cards(playlists):
+    """
+    Render the home feed card of each playlist, loading all their carousels in one query.
+    """
+    prefetch_related_objects(playlists, Prefetch('songs', queryset=carousel_songs(), to_attr='carousel_songs'))
+    return [render_to_string('playlists/_playlist_card.html', {'playlist': playlist}) for playlist in playlists]
+
+
+def playlist_songs(playlist):
+    """
+    Queryset of the songs shown in a playlist's grid.
+    """
+    # Songs whose upload is still being processed are shown with a placeholder
+    return Song.objects.filter(playlist=playlist).filter(
+        SONG_HAS_PHOTO | Q(photo_status__in=[Song.PHOTO_PENDING, Song.PHOTO_PROCESSING])
+    ).select_related('track').only(
+        'id', 'photo', 'photo_renditions', 'photo_rendition_formats', 'photo_placeholder', 'photo_status',
+        'playlist_id', 'added_at', 'track__title'
+    )
+
+
+def song_grid(playlist, cursor):
+    """
+    One page of a playlist's song cards as HTML, or an empty string when there are none.
+    Pages are cached per playlist version (see fragment_cache), so a returning visitor's
+    grid costs no song query and no template rendering until the playlist changes.
+    """
+    def render():
+        songs, next_cursor = paginate_by_cursor(playlist_songs(playlist), 'added_at', cursor, SONG_PAGE_SIZE)
+        if not songs:
+            return ''
+        return render_to_string('playlists/_song_cards.html', {'songs': songs, 'next_cursor': next_cursor})
+
+    # Key on the decoded cursor, which also rejects invalid ones before anything is cached
+    position = '-'.join(map(str, decode_cursor(cursor))) if cursor else 'first'
+    return cached_fragment('song_grid', fragment_key('song_grid', playlist, position), render)
+
+
 @login_required
 def home(request):
-    playlists = Playlist.objects.filter(user=request.user).order_by('-created_at')
-    return render(request, 'playlists/home.html', {'playlists': playlists})
+    """
+    Displays the user's playlists, newest first, one page at a time.
+    Infinite scroll requests the following pages with the cursor and gets back only the cards.
+    Each playlist's card is cached per playlist version; only the cards that missed are rendered.
+    """
+    playlists = home_playlists(request.user)
+    playlists, next_cursor = paginate_by_cursor(playlists, 'created_at', request.GET.get('cursor'), PLAYLIST_PAGE_SIZE)
+    cards = cached_fragments(
+        'playlist_card', playlists, lambda playlist: fragment_key('playlist_card', playlist), render_playlist_cards
+    )
+
+    context = {'cards': cards, 'next_cursor': next_cursor}
+    if is_ajax(request):
+        return render(request, 'playlists/_playlist_cards.html', context)
+    return render(request, 'playlists/home.html', context)
 
 
 @login_required
 def playlist_detail(request, playlist_id):
+    """
+    Displays a playlist's songs with photos, one page at a time, and handles photo uploads.
+    Infinite scroll requests the following pages with the cursor and gets back only the cards.
+    """
     playlist = get_object_or_404(Playlist, id=playlist_id, user=request.user)
-    songs = playlist.songs.all().order_by('-added_at')
+    # Viewed playlists are synced with Spotify sooner by the background scheduler
+    mark_playlist_viewed(playlist)
 
     if request.method == 'POST' and 'photo' in request.FILES:
         song_id = request.POST.get('song_id')
         photo = request.FILES['photo']
         try:
             song = Song.objects.get(id=song_id, playlist=playlist)
-            song.photo = photo
-            song.save()
-            messages.success(request, 'Photo uploaded successfully.')
-        except Song.DoesNotExist:
+        except (Song.DoesNotExist, ValueError):
             messages.error(request, 'Song not found.')
+        else:
+            # Only stage the file here; the photo worker validates, resizes and places it
+            if song.photo_staging:
+                delete_staged(song.photo_staging)
+            song.photo_staging = stage_upload(photo)
+            song.photo_status = Song.PHOTO_PENDING
+            song.save(update_fields=['photo_staging', 'photo_status'])
+            # Saving the song bumped the playlist's version; render the grid with the new one
+            playlist.refresh_from_db(fields=['version'])
+            messages.success(request, 'Photo uploaded successfully. It will appear once it has been processed.')
+
+    song_cards = song_grid(playlist, request.GET.get('cursor'))
+
+    if is_ajax(request):
+        return HttpResponse(song_cards)
+    return render(request, 'playlists/playlist_detail.html', {'playlist': playlist, 'song_cards': song_cards})
 
-    return render(request, 'playlists/playlist_detail.html', {
-        'playlist': playlist,
-        'songs': songs
+
+@login_required
+def song_card(request, playlist_id, song_id):
+    """
+    Renders a single song's grid card, polled by placeholders until its photo is processed.
+    """
+    song = get_object_or_404(
+        Song.objects.select_related('track'), id=song_id, playlist__id=playlist_id, playlist__user=request.user
+    )
+    return render(request, 'playlists/_song_cards.html', {'songs': [song], 'next_cursor': None})
+
+
+@login_required
+def song_search(request, playlist_id):
+    """
+    Returns the playlist's songs whose title matches the query, for the upload song picker.
+    """
+    playlist = get_object_or_404(Playlist, id=playlist_id, user=request.user)
+    # playlist_id is read by the related manager for every row, so it must not be deferred
+    songs = playlist.songs.select_related('track').only('id', 'playlist_id', 'track__title').order_by('track__title')
+    query = request.GET.get('q', '').strip()
+    if query:
+        songs = songs.filter(track__title__icontains=query)
+    return JsonResponse({
+        'songs': [{'id': song.id, 'title': song.title} for song in songs[:SONG_SEARCH_LIMIT]]
     })
 
 @login_required
-def import_spotify_playlist(request):
+async def import_spotify_playlist(request):
     """
     Displays the user's Spotify playlists in a dropdown menu for selection.
+    Async, so a worker waiting on Spotify for one user keeps serving the others.
     """
-    spotify_client = get_spotify_client(request.user)
-    if not spotify_client:
+    # Loaded by login_required; request.user would query the database on the event loop
+    user = await request.auser()
+    if await aget_access_token(user) is None:
         messages.info(request, 'Connect Spotify to import playlists.')
         return redirect('playlists:spotify_login')
     else:
         messages.success(request, 'Spotify account connected successfully!')
 
     try:
-        spotify_playlists = []  # Initialize an empty list for playlists
-        offset = 0
-        while True:
-            playlists_data = spotify_client.current_user_playlists(limit=50, offset=offset)
-            print("Fetched Spotify playlists data:", playlists_data)  # Debugging line
-            if not playlists_data or not playlists_data.get('items'):
-                break
-            for pl in playlists_data['items']:
-                if pl is None:
-                    print("Warning: Found None in playlists_data['items']")
-                    continue
-                spotify_playlists.append({
-                    'id': pl.get('id', 'Unknown ID'),
-                    'name': pl.get('name', 'Unknown Name'),
-                    'tracks': pl.get('tracks', {}).get('total', 0)
-                })
-            if not playlists_data['next']:
-                break
-            offset += 50
+        if is_ajax(request):
+            # Fetched from Spotify if nothing is cached yet
+            spotify_playlists = await aget_playlists(user)
+        else:
+            # Render straight away; without a cached listing the page loads it with an XHR
+            spotify_playlists = await sync_to_async(get_cached_playlists)(user)
     except spotipy.SpotifyException as e:
         messages.error(request, f'Error fetching playlists: {e}')
         spotify_playlists = []
@@ -81,107 +226,152 @@ def import_spotify_playlist(request):
         messages.error(request, f'An unexpected error occurred: {e}')
         spotify_playlists = []
 
-    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        print("Returning Spotify playlists:", spotify_playlists)  # Debugging line
+    if is_ajax(request):
+        log_payload(logger, 'Returning Spotify playlists', spotify_playlists)
         return JsonResponse({'spotify_playlists': spotify_playlists})
 
-    return render(request, 'playlists/import_spotify_playlist.html', {
+    # Context processors may still load the session or messages from the database
+    return await sync_to_async(render)(request, 'playlists/import_spotify_playlist.html', {
         'spotify_playlists': spotify_playlists
     })
 
 @login_required
-def import_selected_playlist(request):
+async def stream_spotify_playlists(request):
     """
-    Handles the import action for the selected Spotify playlist.
+    Streams the user's Spotify playlists as NDJSON, one line per page, so the import
+    dropdown shows the first playlists before the last page has been fetched.
+    Each line is {"playlists": [...]}; a failure ends the stream with {"error": "..."}.
+    ASGI servers only send an async generator's lines as they are produced, and WSGI servers
+    a sync one's, so the body is made for the server the process runs under.
     """
-    logger = logging.getLogger(__name__)
-    logger.info('Received request to import selected playlist.')
+    user = await request.auser()
+    def error_line(e):
+        if isinstance(e, spotipy.SpotifyException):
+            return json.dumps({'error': f'Error fetching playlists: {e}'}) + '\n'
+        return json.dumps({'error': f'An unexpected error occurred: {e}'}) + '\n'
 
+    def lines():
+        try:
+            for playlists in stream_playlists(user):
+                yield json.dumps({'playlists': playlists}) + '\n'
+        except Exception as e:
+            yield error_line(e)
+
+    async def alines():
+        try:
+            async for playlists in astream_playlists(user):
+                yield json.dumps({'playlists': playlists}) + '\n'
+        except Exception as e:
+            yield error_line(e)
+
+    # SPOTIFY_ASYNC_CLIENT is set by asgi.py
+    body = alines() if settings.SPOTIFY_ASYNC_CLIENT else lines()
+    response = StreamingHttpResponse(body, content_type='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Ask nginx to pass each line on as it is written instead of buffering the response
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+async def import_selected_playlist(request):
+    """
+    Queues an import job for the selected Spotify playlist, or a batch import when several
+    playlist_id values are posted.
+    """
+    user = await request.auser()
     if request.method != 'POST':
         messages.error(request, 'Invalid request method.')
         return JsonResponse({'success': False, 'error': 'Invalid request method.'}, status=400)
 
-    playlist_id = request.POST.get('playlist_id')
-    logger.info(f'Received playlist ID: {playlist_id}')
-
-    if not playlist_id:
+    # Ignore repeated ids, keeping the order they were selected in
+    playlist_ids = list(dict.fromkeys(playlist_id for playlist_id in request.POST.getlist('playlist_id') if playlist_id))
+    if not playlist_ids:
         messages.error(request, 'No playlist selected.')
         return JsonResponse({'success': False, 'error': 'No playlist selected.'}, status=400)
+    if len(playlist_ids) > MAX_BATCH_PLAYLISTS:
+        return JsonResponse({'success': False, 'error': f'Select at most {MAX_BATCH_PLAYLISTS} playlists at a time.'}, status=400)
 
-    spotify_client = get_spotify_client(request.user)
-    if not spotify_client:
+    # Only check that Spotify is connected; the worker refreshes the token when it runs the job
+    if not await sync_to_async(SpotifyToken.objects.filter(user=user).exists)():
         messages.info(request, 'Connect Spotify to import playlists.')
         return JsonResponse({'success': False, 'error': 'Spotify client not available. Please connect your Spotify account.'}, status=400)
 
-    try:
-        # Fetch playlist details from Spotify
-        playlist_data = spotify_client.playlist(playlist_id)
-        playlist_name = playlist_data.get('name', 'Imported Playlist')
-
-        logger.info(f'Fetched playlist data from Spotify: {playlist_data}')
-
-        # Create or update Playlist in Django with the fetched name and description
-        playlist, created = Playlist.objects.update_or_create(
-            spotify_playlist_id=playlist_id,
-            defaults={
-                'title': playlist_name,
-                'user': request.user,
-                'description': playlist_data.get('description', '')
-            }
-        )
-        logger.info(f'Playlist "{playlist.title}" with ID "{playlist.spotify_playlist_id}" {"created" if created else "updated"} successfully.')
-
-        # **Add Songs to the Playlist**
-        tracks_data = playlist_data['tracks']
-        while True:
-            for item in tracks_data['items']:
-                track = item['track']
-                if track:
-                    Song.objects.update_or_create(
-                        spotify_track_id=track['id'],
-                        defaults={
-                            'title': track['name'],
-                            'playlist': playlist,
-                            'photo': None  # Initialize with no photo
-                            # Add more fields if necessary
-                        }
-                    )
-            if tracks_data['next']:
-                tracks_data = spotify_client.next(tracks_data)
-            else:
-                break
-
-        message = f'Playlist "{playlist.title}" imported successfully with {playlist.songs.count()} songs.'
-
-        logger.info(f'Returning success response for playlist "{playlist.title}".')
+    if len(playlist_ids) > 1:
+        # One batch for the worker to run as a single operation; the page polls its combined progress
+        batch = await sync_to_async(queue_import_batch)(user, playlist_ids)
+        logger.info(f'Queued import batch {batch.id} of {len(playlist_ids)} playlists.')
         return JsonResponse({
             'success': True,
-            'message': message,
-            'redirect_url': reverse('playlists:playlist_detail', args=[playlist.id])
-        })
-    except spotipy.SpotifyException as e:
-        logger.error(f'Spotify API error: {e}')
-        return JsonResponse({'success': False, 'error': f'Spotify API error: {e}'}, status=500)
-    except Exception as e:
-        logger.error(f'An unexpected error occurred: {e}')
-        return JsonResponse({'success': False, 'error': 'An unexpected error occurred.'}, status=500)
+            'batch_id': batch.id,
+            'status_url': reverse('playlists:import_batch_status', args=[batch.id])
+        }, status=202)
+
+    # Queue the import for the worker and return straight away; the page polls the status URL
+    playlist_id = playlist_ids[0]
+    job = await sync_to_async(ImportJob.objects.create)(user=user, spotify_playlist_id=playlist_id)
+    logger.info(f'Queued import job {job.id} for playlist {playlist_id}.')
+    return JsonResponse({
+        'success': True,
+        'job_id': job.id,
+        'status_url': reverse('playlists:import_job_status', args=[job.id])
+    }, status=202)
 
 
 @login_required
-def spotify_login(request):
+def import_job_status(request, job_id):
+    """
+    Reports the progress of an import job as JSON for the import page to poll.
+    """
+    job = get_object_or_404(ImportJob, id=job_id, user=request.user)
+    data = {
+        'job_id': job.id,
+        'state': job.state,
+        'finished': job.is_finished,
+        'tracks_done': job.tracks_done,
+        'tracks_total': job.tracks_total,
+        'message': job.message,
+        'error': job.error,
+    }
+    if job.state == ImportJob.SUCCEEDED and job.playlist_id:
+        data['redirect_url'] = reverse('playlists:playlist_detail', args=[job.playlist_id])
+    return JsonResponse(data)
+
+
+@login_required
+def import_batch_status(request, batch_id):
+    """
+    Reports the combined progress of a batch import as JSON for the import page to poll:
+    the number of playlists in each state, the tracks imported so far and the failures.
+    """
+    batch = get_object_or_404(ImportBatch, id=batch_id, user=request.user)
+    data = {'batch_id': batch.id, **batch.progress()}
+    failed = batch.jobs.filter(state=ImportJob.FAILED).order_by('id')
+    data['errors'] = [
+        {'playlist_id': job.spotify_playlist_id, 'error': job.error}
+        for job in failed.only('spotify_playlist_id', 'error')[:BATCH_ERRORS_SHOWN]
+    ]
+    if data['finished'] and data[ImportJob.SUCCEEDED]:
+        data['redirect_url'] = reverse('playlists:home')
+    return JsonResponse(data)
+
+
+@login_required
+async def spotify_login(request):
     """
     Initiates the Spotify OAuth authentication process.
     """
-    auth_manager = get_spotify_auth_manager(request.user)
+    user = await request.auser()
+    # Building the authorization URL makes no request, so this never leaves the event loop
+    auth_manager = get_spotify_auth_manager(user)
     auth_url = auth_manager.get_authorize_url()
     return redirect(auth_url)
 
 @login_required
-def spotify_callback(request):
+async def spotify_callback(request):
     """
     Handles the callback from Spotify after user authorization.
     """
-    auth_manager = get_spotify_auth_manager(request.user)
+    user = await request.auser()
     code = request.GET.get('code')
     error = request.GET.get('error')
 
@@ -189,20 +379,19 @@ def spotify_callback(request):
         messages.error(request, f'Spotify authentication failed: {error}')
         return redirect('playlists:import_spotify_playlist')
 
+    def store_token(token_info):
+        # Save or update the SpotifyToken model, including when the new token expires
+        token = SpotifyToken.objects.filter(user=user).first()
+        save_token_info(token or SpotifyToken(user=user), token_info)
+        # The cached listing may belong to a previously connected account
+        forget_playlist_listing(user)
+        return token is None
+
     if code:
         try:
-            token_info = auth_manager.get_access_token(code)
-            # Save or update the SpotifyToken model
-            token, created = SpotifyToken.objects.update_or_create(
-                user=request.user,
-                defaults={
-                    'access_token': token_info['access_token'],
-                    'refresh_token': token_info['refresh_token'],
-                    'token_type': token_info['token_type'],
-                    'expires_in': token_info['expires_in'],
-                    'scope': token_info['scope'],
-                }
-            )
+            # Always exchange the code; a cached token could belong to another user
+            token_info = await exchange_code(code)
+            created = await sync_to_async(store_token)(token_info)
             if created:
                 messages.success(request, 'New Spotify account connected successfully.')
             else:
@@ -216,3 +405,16 @@ def spotify_callback(request):
     return redirect('playlists:import_spotify_playlist')
 
 
+def prometheus_metrics(request):
+    """
+    Serves this process's performance metrics in the Prometheus text format:
+    per-view quantiles recorded by PerformanceMiddleware, fragment cache hit ratios,
+    Spotify HTTP pool statistics and the last cycle of each background sync scheduler.
+    """
+    if settings.METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {settings.METRICS_TOKEN}':
+        return HttpResponse(status=403)
+    lines = (
+        view_metrics.render() + fragment_cache_stats.render() + render_spotify_metrics(spotify_http_metrics())
+        + render_sync_metrics(latest_sync_cycles())
+    )
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')